@@ -89,6 +89,7 @@ KWARGS = {
     'entry_points' : {
         'console_scripts' : [
             "svb=svb.main:main",
+            "svb_benchmark=svb.benchmark.runner:main",
         ],
         'svb.models' : [
             "exp=svb.models.exp:ExpModel",
@@ -8,13 +8,16 @@ except ImportError:
     __timestamp__ = "Unknown timestamp"
 
 from .svb import SvbFit
-from .data import DataModel
+from .avb import AvbFit
+from .data import DataModel, StackedDataModel
 from .model import Model, get_model_class
 
 __all__ = [   "__version__",
     "__timestamp__",
     "SvbFit",
+    "AvbFit",
     "DataModel",
+    "StackedDataModel",
     "Model",
     "get_model_class",
 ]
@@ -0,0 +1,209 @@
+"""
+SVB - Automatic tuning of training throughput
+
+The batch size, sample size and number of threads have a large effect on how quickly
+training reduces the cost. Small batches and samples make each step cheaper but the
+gradient noisier, and the best number of threads depends on the size of the tensors
+and the machine. The tuner fits a subsample of the voxels with the real model for a
+few epochs with each candidate configuration and chooses the one which reduces the
+mean cost fastest.
+
+The first epoch of each trial is not timed as it includes one-off setup costs, so the
+cost reduction per second is measured from the end of the first epoch to the end of
+the trial. Each number of threads is tried in a fresh worker process since TensorFlow
+only sets the size of its thread pools once in each process.
+
+Tuned configurations can be saved in a JSON cache file, keyed by the model, the data
+shape and the number of CPUs, so later runs on similar data can skip tuning.
+"""
+import os
+import json
+import logging
+import multiprocessing
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from .svb import SvbFit
+from .chunk import voxel_tpts
+from .parallel import worker_options
+
+# Candidate batch and sample sizes. The full data and the requested batch size and
+# sample size are also tried
+BATCH_SIZES = (10, 20, 50, 100)
+SAMPLE_SIZES = (5, 10, 20, 50)
+
+# Default number of voxels in the subsample and epochs in each trial
+SUBSAMPLE_VOXELS = 1000
+TRIAL_EPOCHS = 5
+
+# Training options which are not used in trials
+_TRIAL_EXCLUDED = ("history_dir", "checkpoint_dir", "resume", "profile_steps", "profile_dir",
+                   "conv_tol", "time_limit", "voxel_conv_tol", "log_stream")
+
+def candidate_configs(n_tpts, **kwargs):
+    """
+    Generate the candidate configurations
+
+    :param n_tpts: Number of time points in the data
+
+    Optional keyword arguments:
+
+    :param batch_size: Requested batch size, which is also tried
+    :param sample_size: Requested sample size, which is also tried
+    :param optimizer: Optimizer. The SAA optimizer always uses the full data
+    :param workers: Number of worker processes. With more than one, the threads are
+                    divided between the workers and the number of threads is not tuned
+
+    :return: Tuple of sequence of the number of intra-op threads to try, sequence of
+             (batch size, sample size) to try. A batch size of None means the full data
+             and a number of threads of None lets TensorFlow choose
+    """
+    batch_sizes = [None]
+    if kwargs.get("optimizer", None) != "saa":
+        batch_sizes += sorted(set([size for size in BATCH_SIZES + (kwargs.get("batch_size", None) or n_tpts,) if size < n_tpts]))
+    sample_sizes = sorted(set(SAMPLE_SIZES + (kwargs.get("sample_size", None) or SAMPLE_SIZES[-1],)))
+
+    threads = [None]
+    if (kwargs.get("workers", None) or 1) <= 1:
+        cpus = multiprocessing.cpu_count()
+        threads = sorted(set([2**power for power in range(int(np.log2(cpus)) + 1)] + [cpus]))
+    return threads, [(batch_size, sample_size) for batch_size in batch_sizes for sample_size in sample_sizes]
+
+def subsample(n_voxels, n_subsample):
+    """
+    :param n_voxels: Number of unmasked voxels
+    :param n_subsample: Number of voxels in the subsample
+    :return: Indices of a contiguous block of unmasked voxels from the middle of the data.
+             Contiguous voxels keep their neighbours for spatial priors
+    """
+    n_subsample = min(n_subsample, n_voxels)
+    start = (n_voxels - n_subsample) // 2
+    return np.arange(start, start + n_subsample)
+
+def cache_key(model_name, n_voxels, n_tpts):
+    """
+    :return: Key of a tuned configuration in the cache
+    """
+    return "model=%s voxels=%i tpts=%i cpus=%i" % (model_name, n_voxels, n_tpts, multiprocessing.cpu_count())
+
+def autotune(data_model, model_class, tpts, cache=None, key=None, **kwargs):
+    """
+    Choose the batch size, sample size and number of threads which reduce the cost fastest
+
+    :param data_model: DataModel instance for the full data
+    :param model_class: Model class being fitted
+    :param tpts: Time points, shape [T] or [V, T]
+    :param cache: Optional JSON file name of a cache of tuned configurations. If it contains
+                  a configuration for ``key`` it is used without tuning, otherwise the tuned
+                  configuration is added to it
+    :param key: Key of the configuration in the cache, see ``cache_key``
+
+    Optional keyword arguments:
+
+    :param autotune_voxels: Number of voxels in the subsample
+    :param autotune_epochs: Number of epochs in each trial
+
+    All keyword arguments are passed to the model, ``SvbFit`` and ``SvbFit.train``
+
+    :return: Dictionary of the chosen ``batch_size``, ``sample_size`` and ``intra_op_threads``,
+             or an empty dictionary if no trial reduced the cost
+    """
+    log = logging.getLogger(__name__)
+    if cache and os.path.exists(cache):
+        with open(cache) as cache_file:
+            tuned = json.load(cache_file)
+        if key in tuned:
+            log.info("Using tuned configuration from %s: %s", cache, _config_str(tuned[key]))
+            return tuned[key]
+
+    n_tpts = data_model.n_tpts
+    epochs = max(2, kwargs.get("autotune_epochs", None) or TRIAL_EPOCHS)
+    indices = subsample(data_model.n_unmasked_voxels, kwargs.get("autotune_voxels", None) or SUBSAMPLE_VOXELS)
+    threads, sizes = candidate_configs(n_tpts, **kwargs)
+    log.info("Tuning batch size, sample size and threads on %i voxels: %i configurations of %i epochs",
+             len(indices), len(threads) * len(sizes), epochs)
+
+    worker_kwargs = worker_options(dict([(name, value) for name, value in kwargs.items() if name not in _TRIAL_EXCLUDED]))
+    worker_kwargs.update({
+        "epochs" : epochs,
+        "display_step" : epochs,
+        "history" : "mean",
+        "log_level" : "DEBUG" if log.isEnabledFor(logging.DEBUG) else "WARNING",
+        "v1_graph_mode" : not tf.executing_eagerly(),
+    })
+    subset_model = data_model.voxel_subset(indices)
+    subset_tpts = voxel_tpts(tpts, indices)
+
+    trials = []
+    for intra_op_threads in threads:
+        # TensorFlow is not safe to use after a fork so start a fresh worker process
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(1)
+        try:
+            trials += pool.apply(_run_trials, ((subset_model, model_class, subset_tpts, intra_op_threads, sizes, worker_kwargs),))
+        finally:
+            pool.close()
+            pool.join()
+
+    for trial in trials:
+        log.debug(" - %s: %s", _config_str(trial["config"]),
+                  "cost reduction %.4g/s" % trial["cost_rate"] if trial["cost_rate"] is not None else "cost did not decrease")
+    trials = [trial for trial in trials if trial["cost_rate"] is not None]
+    if not trials:
+        log.warning("No configuration reduced the cost during tuning - keeping the requested options")
+        return {}
+
+    best = max(trials, key=lambda trial: trial["cost_rate"])
+    log.info("Tuned configuration: %s (cost reduction %.4g/s)", _config_str(best["config"]), best["cost_rate"])
+    if cache:
+        tuned = {}
+        if os.path.exists(cache):
+            with open(cache) as cache_file:
+                tuned = json.load(cache_file)
+        tuned[key] = best["config"]
+        with open(cache, "w") as cache_file:
+            json.dump(tuned, cache_file, indent=2, sort_keys=True)
+        log.info("Tuned configuration saved to %s", cache)
+    return best["config"]
+
+def _run_trials(args):
+    """
+    Run the trials with a given number of threads in a worker process
+
+    :return: Sequence of dictionaries containing the ``config`` and the ``cost_rate``,
+             the cost reduction per second or None if the cost did not decrease
+    """
+    data_model, model_class, tpts, intra_op_threads, sizes, kwargs = args
+    logging.basicConfig(level=getattr(logging, kwargs["log_level"], logging.WARNING))
+    if kwargs["v1_graph_mode"] and hasattr(tf, "disable_v2_behavior"):
+        tf.disable_v2_behavior()
+
+    kwargs = dict(kwargs, intra_op_threads=intra_op_threads)
+    fwd_model = model_class(data_model, **kwargs)
+    svb = SvbFit(data_model, fwd_model, **kwargs)
+
+    # The graph does not depend on the batch size and sample size, and training
+    # re-initializes the variables, so each trial starts from the same posterior
+    trials = []
+    for batch_size, sample_size in sizes:
+        history = svb.train(tpts, data_model.data_flattened, post_init=data_model.post_init,
+                            **dict(kwargs, batch_size=batch_size, sample_size=sample_size))
+        # The history has an entry for each epoch followed by the final values
+        mean_cost, runtime = history["mean_cost"][:-1], history["runtime"][:-1]
+        reduction, elapsed = mean_cost[0] - mean_cost[-1], runtime[-1] - runtime[0]
+        cost_rate = None
+        if np.isfinite(reduction) and reduction > 0 and elapsed > 0:
+            cost_rate = float(reduction / elapsed)
+        trials.append({
+            "config" : {"batch_size" : batch_size, "sample_size" : sample_size, "intra_op_threads" : intra_op_threads},
+            "cost_rate" : cost_rate,
+        })
+    return trials
+
+def _config_str(config):
+    return "batch size %s, sample size %i, %s threads" % (
+        config["batch_size"] or "full", config["sample_size"], config["intra_op_threads"] or "default")
@@ -0,0 +1,405 @@
+"""
+Analytic (linearised) variational Bayesian inference of a nonlinear model
+
+This is the deterministic update scheme used by Fabber as an alternative to the stochastic
+optimization in ``SvbFit``. At each iteration the model is linearised about the current
+posterior mean using the Jacobian of ``Model.evaluate``, which is calculated by automatic
+differentiation. For the linearised model the optimal Gaussian posterior of the parameters
+and Gamma posterior of the noise precision are given in closed form, so each iteration
+updates the full posterior of every voxel with no learning rate or sampling.
+
+The posterior of the model parameters is a full multivariate Gaussian in the underlying
+Gaussian space of each parameter's distribution, as for ``SvbFit`` with covariance
+inference. The noise precision has a Gamma posterior which is reported as the model-space
+noise variance and a log-normal approximation to it in the full posterior output, so the
+results can be written out, or used to initialize ``SvbFit``, in the same way.
+
+Voxels are fitted independently so spatial priors, ARD priors and global posteriors
+are not supported.
+"""
+import time
+import math
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from .history import TrainingHistory
+from .noise import NoiseParameter
+from .precision import set_precision, float_dtype, compute_dtype
+from .profiling import StepProfiler
+from .prior import PRIOR_TYPE_NONSPATIAL
+from .dist import Normal
+from .utils import LogBase
+
+# Gamma prior on the noise precision with shape ``NOISE_PRIOR_SHAPE`` and scale
+# ``NOISE_PRIOR_SCALE``. This is uninformative with a mean of 1, as in Fabber
+NOISE_PRIOR_SHAPE = 1e-6
+NOISE_PRIOR_SCALE = 1e6
+
+class AvbFit(LogBase):
+    """
+    Analytic variational Bayesian model fitting using a linearised model
+
+    :ivar model: Model instance to be fitted to some data
+    :ivar params: Sequence of Parameter instances of parameters to infer. This includes the model
+                  parameters and the noise parameter
+    """
+    def __init__(self, data_model, fwd_model, **kwargs):
+        LogBase.__init__(self)
+
+        self.data_model = data_model
+        self.model = fwd_model
+        self.params = list(fwd_model.params) + [NoiseParameter()]
+        self._nparams = len(fwd_model.params)
+        for param in fwd_model.params:
+            if param.prior_type != PRIOR_TYPE_NONSPATIAL or param.post_type != "vertexwise":
+                raise ValueError("Linearised VB only supports vertexwise posteriors with non-spatial priors: %s" % param)
+            if not isinstance(param.prior_dist, Normal) or not isinstance(param.post_dist, Normal):
+                raise ValueError("Linearised VB only supports Gaussian-based parameter distributions: %s" % param)
+
+        # The posterior update inverts precision matrices which may be badly conditioned in
+        # single precision. The model is still evaluated in single precision with ``mixed``
+        self._precision = kwargs.get("precision", None) or "float32"
+        if self._precision == "float32":
+            self.log.warning("Linearised VB requires posterior updates in double precision - using mixed precision")
+            self._precision = "mixed"
+        set_precision(self._precision)
+
+        # Data the fit is currently targeted at, see train()
+        self._data, self._tpts = None, None
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._create_input_tensors()
+            self._create_prior_post()
+            self._create_linearisation()
+            self._create_update()
+            self._create_outputs()
+            self.init = tf.global_variables_initializer()
+
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads=kwargs.get("intra_op_threads", None) or 0,
+                inter_op_parallelism_threads=kwargs.get("inter_op_threads", None) or 0,
+            )
+            self.sess = tf.Session(config=config)
+
+    def _create_input_tensors(self):
+        """
+        Placeholders for the data [V, T] and time points [V, T] or [1, T]
+        """
+        self.feed_dict = {}
+        self.nvoxels = self.data_model.n_unmasked_voxels
+        self.data = tf.placeholder(compute_dtype(), [self.nvoxels, None], name="data")
+        self.tpts = tf.placeholder(compute_dtype(), [None, None], name="tpts")
+        self.nt = tf.cast(tf.shape(self.data)[1], float_dtype())
+
+        # Optional initial posterior mean [W, P] and covariance [W, P, P], which may
+        # include the noise parameter. These default to the values provided by the data model
+        self.post_init = None
+        if self.data_model.post_init is not None:
+            init_mean, init_cov = self.data_model.post_init
+            self.post_init = (
+                tf.placeholder_with_default(np.asarray(init_mean, dtype=float_dtype().as_numpy_dtype),
+                                            np.shape(init_mean), name="post_init_mean"),
+                tf.placeholder_with_default(np.asarray(init_cov, dtype=float_dtype().as_numpy_dtype),
+                                            np.shape(init_cov), name="post_init_cov"),
+            )
+
+    def _create_prior_post(self):
+        """
+        Create the prior and the posterior variables
+
+        The posterior of the model parameters is initialized in the same way as ``SvbFit``
+        from the parameter's initial posterior or the data model's initial posterior. The
+        noise precision is initialized from the variance of the data
+        """
+        dtype = float_dtype()
+        nparams = self._nparams
+        data = tf.cast(self.data, dtype)
+        prior_mean = [param.prior_dist.mean for param in self.model.params]
+        prior_var = [param.prior_dist.var for param in self.model.params]
+        self.prior_mean = tf.constant(prior_mean, dtype=dtype, name="prior_mean")
+        self.prior_prec = tf.constant(np.diag(1 / np.array(prior_var)), dtype=dtype, name="prior_prec")
+
+        if self.post_init is not None:
+            init_mean = self.post_init[0][:, :nparams]
+            init_cov = self.post_init[1][:, :nparams, :nparams]
+        else:
+            means, variances = [], []
+            for param in self.model.params:
+                mean, var = None, None
+                if param.post_init is not None:
+                    mean, var = param.post_init(param, self.tpts, data)
+                if mean is None:
+                    mean = tf.fill([self.nvoxels], param.post_dist.mean)
+                else:
+                    mean = param.post_dist.transform.int_values(mean)
+                if var is None:
+                    var = tf.fill([self.nvoxels], param.post_dist.var)
+                else:
+                    var = param.post_dist.transform.int_values(var)
+                means.append(tf.cast(mean, dtype))
+                variances.append(tf.cast(var, dtype))
+            init_mean = tf.stack(means, axis=1)
+            init_cov = tf.matrix_diag(tf.stack(variances, axis=1))
+
+        self.mean = tf.Variable(tf.cast(init_mean, dtype), name="post_mean") # [V, P]
+        self.cov = tf.Variable(tf.cast(init_cov, dtype), name="post_cov") # [V, P, P]
+
+        # Gamma posterior of the noise precision with shape ``noise_shape`` and scale ``noise_scale``
+        _data_mean, data_var = tf.nn.moments(data, axes=1)
+        data_var = tf.where(tf.equal(data_var, 0), tf.ones_like(data_var), data_var)
+        self.noise_shape = tf.Variable(tf.fill([self.nvoxels], tf.constant(NOISE_PRIOR_SHAPE, dtype=dtype)), name="noise_shape")
+        self.noise_scale = tf.Variable(1 / (NOISE_PRIOR_SHAPE * data_var), name="noise_scale")
+
+    def _create_linearisation(self):
+        """
+        Create tensors for the model prediction [V, T] and its Jacobian [V, T, P] with respect
+        to the underlying Gaussian parameters at the posterior mean
+
+        TensorFlow only has reverse mode differentiation, so the Jacobian is built from
+        forward mode derivatives for each parameter. These are obtained by differentiating
+        the gradient with respect to the output weights, which it is linear in
+        """
+        dtype = float_dtype()
+        pred = self._evaluate(self.mean)
+        weights = tf.zeros_like(pred)
+        grad = tf.gradients(pred, self.mean, grad_ys=weights)[0]
+        jacobian = []
+        for idx in range(self._nparams):
+            tangent = tf.one_hot(tf.fill([self.nvoxels], idx), self._nparams, dtype=dtype)
+            deriv = tf.gradients(grad, weights, grad_ys=tangent)[0] if grad is not None else None
+            if deriv is None:
+                # The model does not depend on this parameter
+                deriv = tf.zeros_like(pred)
+            jacobian.append(tf.cast(deriv, dtype))
+        self.pred = tf.cast(pred, dtype)
+        self.jacobian = tf.stack(jacobian, axis=-1)
+
+    def _evaluate(self, mean):
+        """
+        :param mean: Underlying Gaussian parameter values [V, P]
+        :return: Model prediction [V, T]
+        """
+        model_params = []
+        for idx, param in enumerate(self.model.params):
+            value = param.post_dist.transform.ext_values(tf.cast(mean[:, idx], compute_dtype()))
+            model_params.append(tf.expand_dims(value, -1))
+        return self.model.evaluate(model_params, self.tpts)
+
+    def _create_update(self):
+        """
+        Create the operation which carries out one iteration of the closed form updates
+
+        The parameter posterior is updated first using the current noise, then the noise
+        posterior using the new parameter posterior. The free energy is calculated for the
+        linearised model after the update and the cost is its negative, so it can be compared
+        with the cost minimized by ``SvbFit``
+        """
+        dtype = float_dtype()
+        nparams = self._nparams
+        jacobian = self.jacobian
+        jtj = tf.matmul(jacobian, jacobian, transpose_a=True) # [V, P, P]
+        residual = tf.cast(self.data, dtype) - self.pred # [V, T]
+        noise_prec = self.noise_shape * self.noise_scale # [V]
+
+        # Parameter posterior: precision and mean of the Gaussian which is optimal for the
+        # linearised model. The mean solves the normal equations about the linearisation point
+        prec = self.prior_prec + noise_prec[:, tf.newaxis, tf.newaxis] * jtj
+        chol = tf.cholesky(prec)
+        target = (tf.linalg.matvec(self.prior_prec, self.prior_mean)[tf.newaxis, :] +
+                  noise_prec[:, tf.newaxis] * tf.linalg.matvec(jacobian, residual + tf.linalg.matvec(jacobian, self.mean), transpose_a=True))
+        mean = tf.cholesky_solve(chol, target[..., tf.newaxis])[..., 0]
+        cov = tf.cholesky_solve(chol, tf.eye(nparams, batch_shape=[self.nvoxels], dtype=dtype))
+        log_det_prec = 2 * tf.reduce_sum(tf.log(tf.matrix_diag_part(chol)), axis=-1)
+
+        # Residual of the linearised model at the new mean
+        residual = residual - tf.linalg.matvec(jacobian, mean - self.mean)
+        ssq = tf.reduce_sum(tf.square(residual), axis=-1) + tf.trace(tf.matmul(cov, jtj))
+
+        # Noise posterior
+        noise_shape = NOISE_PRIOR_SHAPE + 0.5 * self.nt * tf.ones_like(ssq)
+        noise_scale = 1 / (1 / NOISE_PRIOR_SCALE + 0.5 * ssq)
+
+        # Free energy of the linearised model
+        noise_prec = noise_shape * noise_scale
+        expected_log_prec = tf.digamma(noise_shape) + tf.log(noise_scale)
+        log_likelihood = 0.5 * (self.nt * (expected_log_prec - math.log(2 * math.pi)) - noise_prec * ssq)
+        diff = mean - self.prior_mean[tf.newaxis, :]
+        kl_params = 0.5 * (tf.trace(tf.matmul(self.prior_prec[tf.newaxis, ...], cov)) +
+                           tf.reduce_sum(diff * tf.linalg.matvec(self.prior_prec, diff), axis=-1) -
+                           nparams + log_det_prec - tf.linalg.logdet(self.prior_prec))
+        kl_noise = ((noise_shape - NOISE_PRIOR_SHAPE) * tf.digamma(noise_shape) - tf.lgamma(noise_shape) +
+                    math.lgamma(NOISE_PRIOR_SHAPE) + NOISE_PRIOR_SHAPE * (math.log(NOISE_PRIOR_SCALE) - tf.log(noise_scale)) +
+                    noise_shape * (noise_scale / NOISE_PRIOR_SCALE - 1))
+        cost = kl_params + kl_noise - log_likelihood
+
+        # Voxels where the update fails numerically keep their previous posterior
+        valid = tf.logical_and(tf.reduce_all(tf.is_finite(mean), axis=-1), tf.is_finite(cost))
+        values = [
+            tf.where(valid, mean, self.mean),
+            tf.where(valid, cov, self.cov),
+            tf.where(valid, noise_shape, self.noise_shape),
+            tf.where(valid, noise_scale, self.noise_scale),
+        ]
+        with tf.control_dependencies(values):
+            self.update = tf.group(*[tf.assign(var, value) for var, value in
+                                     zip((self.mean, self.cov, self.noise_shape, self.noise_scale), values)])
+        self.update_cost = cost
+
+    def _create_outputs(self):
+        """
+        Create tensors for the model-space posterior means and variances of the parameters and
+        the noise variance, the model prediction at the posterior mean and the full posterior
+        """
+        model_means, model_vars = [], []
+        post_var = tf.matrix_diag_part(self.cov)
+        for idx, param in enumerate(self.model.params):
+            ext_mean, ext_var = param.post_dist.transform.ext_moments(self.mean[:, idx], post_var[:, idx])
+            model_means.append(ext_mean)
+            model_vars.append(ext_var)
+
+        # The noise variance has an inverse Gamma posterior
+        shape = tf.maximum(self.noise_shape, 2 + 1e-6)
+        model_means.append(1 / (self.noise_scale * (shape - 1)))
+        model_vars.append(1 / (tf.square(self.noise_scale * (shape - 1)) * (shape - 2)))
+        self.model_means = tf.stack(model_means)
+        self.model_vars = tf.stack(model_vars)
+        self.modelfit = self.model.evaluate(tf.expand_dims(tf.cast(self.model_means[:-1], compute_dtype()), -1), self.tpts)
+
+        # Full posterior including the log noise variance, whose mean and variance are those
+        # of the log of an inverse Gamma variable
+        log_noise_mean = -tf.digamma(self.noise_shape) - tf.log(self.noise_scale)
+        log_noise_var = tf.polygamma(tf.ones_like(self.noise_shape), self.noise_shape)
+        self.post_mean = tf.concat([self.mean, log_noise_mean[:, tf.newaxis]], axis=1)
+        self.post_cov = (tf.pad(self.cov, [[0, 0], [0, 1], [0, 1]]) +
+                         tf.matrix_diag(tf.concat([tf.zeros_like(self.mean), log_noise_var[:, tf.newaxis]], axis=1)))
+
+    def evaluate(self, *tensors):
+        """
+        Evaluate tensor values
+
+        :param tensors: Sequence of tensors
+        :return: If single tensor requested, it's value as Numpy array. Otherwise tuple of Numpy arrays
+        """
+        out = self.sess.run(list(tensors), feed_dict=self.feed_dict)
+        if len(out) == 1:
+            return out[0]
+        else:
+            return tuple(out)
+
+    def results(self):
+        """
+        Get the output of the fit
+
+        :return: Dictionary of Numpy arrays in the same format as ``SvbFit.results``
+        """
+        mean, var, modelfit, post_mean, post_cov = self.evaluate(
+            self.model_means, self.model_vars, self.modelfit, self.post_mean, self.post_cov
+        )
+        return {
+            "mean" : mean,
+            "var" : var,
+            "modelfit" : modelfit,
+            "post_mean" : post_mean,
+            "post_cov" : post_cov,
+        }
+
+    def train(self, tpts=None, data=None, epochs=10, display_step=1, conv_tol=None, time_limit=None,
+              history="full", history_step=1, history_dir=None, profile_steps=None, profile_dir=None, **kwargs):
+        """
+        Fit the posterior distribution to timeseries data
+
+        :param tpts: Time series values. Should have shape [T] or [V, T] depending on whether timeseries is
+                  constant or varies voxelwise
+        :param data: Full timeseries data, shape [V, T]. If the data and time points are not given, the
+                     data from the last call is used
+
+        Optional arguments:
+
+        :param epochs: Maximum number of update iterations
+        :param display_step: How many iterations to execute for each display line
+        :param conv_tol: If specified, training stops once the relative change in the mean cost and
+                         mean parameters between iterations is within this tolerance
+        :param time_limit: If specified, training stops after the first iteration which ends this
+                           number of seconds after the start of training
+        :param history: Training history to record: ``full`` for voxelwise and mean history, ``mean``
+                         for the mean history only or ``off``. The final values are always recorded
+        :param history_step: Record the history every ``history_step`` iterations
+        :param history_dir: If specified, directory to stream the voxelwise history to rather than
+                            keeping it in memory
+        :param profile_steps: If specified, sequence of indices of iterations, starting at 0, to run with
+                              full tracing, see ``svb.profiling``
+        :param profile_dir: Directory to write the profile to
+
+        Other keyword arguments, e.g. options for ``SvbFit.train``, are ignored
+
+        :return: Training history dictionary, see ``svb.history.TrainingHistory.close``
+        """
+        if data is None and tpts is None:
+            if self._data is None:
+                raise ValueError("No data given and train() has not been called")
+            data, tpts = self._data, self._tpts
+        elif data is None or tpts is None:
+            raise ValueError("Data and time points must be given together")
+        if tpts.ndim == 1:
+            tpts = tpts.reshape(1, -1)
+        n_voxels, n_timepoints = tuple(data.shape)
+        if n_voxels != self.nvoxels:
+            raise ValueError("Data has %i voxels, but the fit was created for %i voxels" % (n_voxels, self.nvoxels))
+        if tpts.shape[0] > 1 and tpts.shape[0] != n_voxels:
+            raise ValueError("Time points has %i voxels, but data has %i" % (tpts.shape[0], n_voxels))
+        if tpts.shape[1] != n_timepoints:
+            raise ValueError("Time points has length %i, but data has %i volumes" % (tpts.shape[1], n_timepoints))
+
+        self.feed_dict = {self.data : data, self.tpts : tpts}
+        self.evaluate(self.init)
+        self._data, self._tpts = data, tpts
+
+        training_history = TrainingHistory(n_voxels, len(self.params), epochs, mode=history,
+                                           step=history_step, outdir=history_dir)
+        if profile_steps and not profile_dir:
+            raise ValueError("Profiling training steps requires a profile directory")
+        profiler = StepProfiler(profile_dir, profile_steps) if profile_steps else None
+        start_time = time.time()
+        prev_cost, prev_params = None, None
+        last_epoch, stop_reason = epochs - 1, "epochs"
+        for epoch in range(epochs):
+            if profiler is not None:
+                cost, _update = profiler.run(self.sess, [self.update_cost, self.update], self.feed_dict)
+            else:
+                cost, _update = self.sess.run([self.update_cost, self.update], feed_dict=self.feed_dict)
+            params = self.evaluate(self.model_means)
+            mean_cost, mean_params = np.mean(cost), np.mean(params, axis=1)
+
+            outcome = ""
+            if epoch == last_epoch:
+                pass
+            elif (conv_tol is not None and prev_cost is not None and
+                  np.abs(mean_cost - prev_cost) <= conv_tol * np.abs(prev_cost) and
+                  np.all(np.abs(mean_params - prev_params) <= conv_tol * np.abs(prev_params))):
+                outcome = " - Converged"
+                last_epoch, stop_reason = epoch, "converged"
+            elif time_limit is not None and time.time() - start_time >= time_limit:
+                outcome = " - Time limit"
+                last_epoch, stop_reason = epoch, "time_limit"
+            prev_cost, prev_params = mean_cost, mean_params
+
+            if epoch % display_step == 0 or last_epoch == epoch:
+                self.log.info(" - Iteration %04d: mean cost=%f mean params=%s%s", (epoch+1), mean_cost, mean_params, outcome)
+            training_history.record(epoch, cost, params, float(time.time() - start_time),
+                                    last=(last_epoch == epoch))
+            if last_epoch == epoch:
+                break
+
+        if profiler is not None:
+            profiler.close()
+        self.log.info(" - Final cost: %f", np.mean(cost))
+        self.log.info(" - Final params: %s", np.mean(params, axis=1))
+        if last_epoch < epochs - 1:
+            self.log.info(" - Training stopped after %i iterations: %s", last_epoch+1, stop_reason)
+        training_history.final(cost, params, float(time.time() - start_time), stop_reason=stop_reason)
+        return training_history.close()
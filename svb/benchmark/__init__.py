@@ -0,0 +1,24 @@
+"""
+SVB - Benchmarks
+
+Performance benchmarks of SVB on synthetic data. These measure throughput, memory use
+and convergence rather than correctness, which is covered by the tests in ``svb.test``.
+Results are written in a machine readable form so they can be compared between versions.
+
+ - ``svb.benchmark.data`` generates synthetic exponential and biexponential data sets
+ - ``svb.benchmark.scaling`` runs end-to-end fits over a sweep of problem sizes and options
+ - ``svb.benchmark.components`` times individual posterior, prior and noise kernels
+ - ``svb.benchmark.runner`` is the ``svb_benchmark`` command line tool
+"""
+from .data import synthetic_data
+from .scaling import sweep_configs, run_benchmarks, compare_results
+from .components import component_configs, run_components
+
+__all__ = [
+    "synthetic_data",
+    "sweep_configs",
+    "run_benchmarks",
+    "compare_results",
+    "component_configs",
+    "run_components",
+]
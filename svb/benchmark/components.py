@@ -0,0 +1,259 @@
+"""
+SVB - Component micro-benchmarks
+
+Each benchmark times repeated session calls of a single posterior, prior or noise
+kernel in isolation, so that when a configuration gets slow the kernel responsible
+can be identified. The kernels are run over a grid of problem sizes:
+
+ - ``n_vertices`` - W, the number of parameter vertices
+ - ``n_params`` - P, the number of model parameters
+ - ``sample_size`` - S, the number of posterior samples
+ - ``batch_size`` - B, the number of time points in a data batch
+
+Each kernel only depends on some of these, so it is only run over the sizes it uses.
+The inputs of each kernel are variables so that the kernel itself is not constant
+folded and the time per call covers the kernel alone. The scaling of each kernel is
+summarised as the exponent ``k`` in ``time ~ size ** k`` for each size, fitted to
+the runs in which only that size varies.
+"""
+import time
+import logging
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+from .. import DataModel
+from ..posterior import NormalPosterior, FactorisedPosterior, MVNPosterior
+from ..prior import NormalPrior, FactorisedPrior, MRFSpatialPrior, MRF2SpatialPrior, FabberMRFSpatialPrior
+from ..noise import NoiseParameter
+from ..precision import float_dtype
+from .data import synthetic_data
+from .scaling import sweep_configs, benchmark_info, config_str
+
+# Sizes run by default. The first value is the base configuration
+DEFAULT_GRID = [
+    ("n_vertices", [100, 1000, 10000]),
+    ("n_params", [2, 4, 8]),
+    ("sample_size", [5, 20, 100]),
+    ("batch_size", [10, 50, 200]),
+]
+
+def _normal_posterior(sizes, idx=0):
+    return NormalPosterior(idx, tf.zeros([sizes["n_vertices"]]), tf.ones([sizes["n_vertices"]]), name="post%i" % idx)
+
+def _posteriors(sizes):
+    return [_normal_posterior(sizes, idx) for idx in range(sizes["n_params"])]
+
+def _samples(sizes):
+    return tf.Variable(tf.random_normal([sizes["n_vertices"], 1, sizes["sample_size"]], dtype=float_dtype()), name="samples")
+
+def _neighbours(sizes):
+    """
+    :return: Sparse tensors of shape [W, W] containing the nearest and second nearest
+             neighbours of vertices in a 2D slice, as used by the spatial priors
+    """
+    data, mask, _dt, _params = synthetic_data("exp", sizes["n_vertices"], 1)
+    data_model = DataModel(data, mask)
+    sparse = []
+    for indices in (data_model.indices_nn, data_model.indices_n2):
+        sparse.append(tf.SparseTensor(
+            indices=np.reshape(np.array(indices, dtype=np.int64), (-1, 2)),
+            values=np.ones((len(indices),), dtype=float_dtype().as_numpy_dtype),
+            dense_shape=[data_model.n_unmasked_voxels, data_model.n_unmasked_voxels]
+        ))
+    return sparse
+
+def _normal_sample(sizes):
+    return _normal_posterior(sizes).sample(sizes["sample_size"])
+
+def _mvn_sample(sizes):
+    return MVNPosterior(_posteriors(sizes)).sample(sizes["sample_size"])
+
+def _mvn_log_det_cov(sizes):
+    return MVNPosterior(_posteriors(sizes)).log_det_cov()
+
+def _latent_loss(sizes):
+    prior = FactorisedPrior([NormalPrior(sizes["n_vertices"], 0.0, 1e6) for _idx in range(sizes["n_params"])])
+    return FactorisedPosterior(_posteriors(sizes)).latent_loss(prior)
+
+def _mrf_log_pdf(sizes):
+    nn, n2 = _neighbours(sizes)
+    prior = MRFSpatialPrior(sizes["n_vertices"], 0.0, 1e6, nn=nn, n2=n2)
+    return prior.mean_log_pdf(_samples(sizes))
+
+def _mrf2_log_pdf(sizes):
+    nn, n2 = _neighbours(sizes)
+    prior = MRF2SpatialPrior(sizes["n_vertices"], 0.0, 1e6, nn=nn, n2=n2, sample_size=sizes["sample_size"])
+    return prior.mean_log_pdf(_samples(sizes))
+
+def _fabber_ak(sizes):
+    nn, n2 = _neighbours(sizes)
+    post = FactorisedPosterior(_posteriors(sizes))
+    return FabberMRFSpatialPrior(sizes["n_vertices"], 0.0, 1e6, idx=0, post=post, nn=nn, n2=n2).ak
+
+def _noise_log_likelihood(sizes):
+    shape = [sizes["n_vertices"], sizes["sample_size"], sizes["batch_size"]]
+    data = tf.Variable(tf.random_normal(shape[::2], dtype=float_dtype()), name="data")
+    pred = tf.Variable(tf.random_normal(shape, dtype=float_dtype()), name="pred")
+    noise_var = tf.Variable(tf.ones(shape[:2], dtype=float_dtype()), name="noise_var")
+    return NoiseParameter().log_likelihood(data, pred, noise_var, sizes["batch_size"])
+
+# Kernels which can be benchmarked: name : (description, sizes used, graph builder)
+COMPONENTS = {
+    "normal_sample" : ("NormalPosterior.sample", ("n_vertices", "sample_size"), _normal_sample),
+    "mvn_sample" : ("MVNPosterior.sample", ("n_vertices", "n_params", "sample_size"), _mvn_sample),
+    "mvn_log_det_cov" : ("MVNPosterior.log_det_cov", ("n_vertices", "n_params"), _mvn_log_det_cov),
+    "latent_loss" : ("FactorisedPosterior.latent_loss", ("n_vertices", "n_params"), _latent_loss),
+    "mrf_log_pdf" : ("MRFSpatialPrior.mean_log_pdf", ("n_vertices", "sample_size"), _mrf_log_pdf),
+    "mrf2_log_pdf" : ("MRF2SpatialPrior.mean_log_pdf", ("n_vertices", "sample_size"), _mrf2_log_pdf),
+    "fabber_ak" : ("FabberMRFSpatialPrior ak setup", ("n_vertices", "n_params"), _fabber_ak),
+    "noise_log_likelihood" : ("NoiseParameter.log_likelihood", ("n_vertices", "sample_size", "batch_size"), _noise_log_likelihood),
+}
+
+def time_component(name, sizes, calls=20, warmup=2, gradients=False):
+    """
+    Time a single kernel in a fresh graph in the current process
+
+    :param name: Name of the kernel, one of ``COMPONENTS``
+    :param sizes: Dictionary of problem sizes, see ``DEFAULT_GRID``
+    :param calls: Number of timed session calls
+    :param warmup: Number of untimed session calls made first
+    :param gradients: If True, time the kernel and the gradient of its sum with respect to
+                      its input variables, as in a training step
+
+    :return: Dictionary of metrics
+    """
+    if name not in COMPONENTS:
+        raise ValueError("Unknown component: %s (supported: %s)" % (name, ", ".join(sorted(COMPONENTS))))
+    _desc, _sizes_used, builder = COMPONENTS[name]
+    with tf.Graph().as_default():
+        start_time = time.time()
+        output = builder(sizes)
+        fetches = [output]
+        if gradients:
+            grads = tf.gradients(tf.reduce_sum(output), tf.trainable_variables())
+            fetches += [grad for grad in grads if grad is not None]
+        # Group the outputs so they are computed but not copied out of the session. The
+        # dependency optimizer would otherwise prune the kernel as its outputs are unused
+        step = tf.group(*fetches)
+        build_time = time.time() - start_time
+        config = tf.ConfigProto()
+        config.graph_options.rewrite_options.dependency_optimization = rewriter_config_pb2.RewriterConfig.OFF
+
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _idx in range(warmup):
+                sess.run(step)
+            call_times = []
+            for _idx in range(calls):
+                start_time = time.time()
+                sess.run(step)
+                call_times.append(time.time() - start_time)
+
+    return {
+        "build_time" : build_time,
+        "time_per_call" : float(np.median(call_times)),
+        "min_time_per_call" : float(np.min(call_times)),
+    }
+
+def component_configs(components=None, grid=None, mode="axis"):
+    """
+    Generate the configurations for a set of kernels over a grid of sizes
+
+    :param components: Sequence of kernel names, defaults to all of ``COMPONENTS``
+    :param grid: Sequence of (size name, sequence of values). Sizes which are not given
+                 take the values in ``DEFAULT_GRID``
+    :param mode: ``axis`` or ``grid``, see ``svb.benchmark.scaling.sweep_configs``
+
+    :return: Sequence of configuration dictionaries containing the ``component`` name
+             and the sizes it uses
+    """
+    values = dict(DEFAULT_GRID)
+    for size, size_values in (grid or []):
+        if size not in values:
+            raise ValueError("Unknown component benchmark size: %s" % size)
+        values[size] = list(size_values)
+
+    configs = []
+    for name in (components or sorted(COMPONENTS)):
+        if name not in COMPONENTS:
+            raise ValueError("Unknown component: %s (supported: %s)" % (name, ", ".join(sorted(COMPONENTS))))
+        sizes_used = COMPONENTS[name][1]
+        sweep = [(size, values[size]) for size in sizes_used]
+        for sizes in sweep_configs(sweep, mode, options=sweep):
+            config = {"component" : name}
+            config.update(sizes)
+            configs.append(config)
+    return configs
+
+def component_scaling(runs):
+    """
+    Fit the scaling of the time per call of each kernel with each size
+
+    :param runs: Sequence of runs as in the results of ``run_components``
+
+    :return: Dictionary of kernel name : dictionary of size name : exponent ``k``
+             where time per call ~ size ** k. The exponent is fitted to the runs in
+             which the other sizes take their values in the first run of the kernel,
+             and is only given if there are at least two such runs
+    """
+    by_component = {}
+    for run in runs:
+        if "error" not in run["metrics"]:
+            by_component.setdefault(run["config"]["component"], []).append(run)
+
+    scaling = {}
+    for name, component_runs in by_component.items():
+        scaling[name] = {}
+        sizes_used = COMPONENTS[name][1]
+        # The first run of each kernel is at the base values of all its sizes
+        base = component_runs[0]["config"]
+        for size in sizes_used:
+            others = [other for other in sizes_used if other != size]
+            points = {}
+            for run in component_runs:
+                if all([run["config"][other] == base[other] for other in others]):
+                    points.setdefault(run["config"][size], []).append(run["metrics"]["time_per_call"])
+            if len(points) >= 2:
+                sizes = sorted(points)
+                times = [np.mean(points[value]) for value in sizes]
+                scaling[name][size] = float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+    return scaling
+
+def run_components(configs, repeats=1, **kwargs):
+    """
+    Run a set of component micro-benchmarks in the current process
+
+    :param configs: Sequence of configuration dictionaries, see ``component_configs``
+    :param repeats: Number of times to run each configuration
+
+    Keyword arguments are passed to ``time_component``
+
+    :return: Dictionary containing a description of the system and software versions,
+             ``runs``, a sequence of dictionaries containing the ``config``, the ``repeat``
+             index and the ``metrics`` of each run, and ``scaling``, the fitted scaling
+             exponents as returned by ``component_scaling``
+    """
+    log = logging.getLogger(__name__)
+    results = benchmark_info(**kwargs)
+    for idx, config in enumerate(configs):
+        sizes = dict([(size, value) for size, value in config.items() if size != "component"])
+        for repeat in range(repeats):
+            log.info("Component benchmark %i of %i (repeat %i): %s", idx+1, len(configs), repeat+1, config_str(config))
+            try:
+                metrics = time_component(config["component"], sizes, **kwargs)
+            except Exception as exc: # pylint: disable=broad-except
+                log.exception("Component benchmark failed")
+                metrics = {"error" : str(exc)}
+            else:
+                log.info(" - %.3f ms per call", metrics["time_per_call"] * 1000)
+            results["runs"].append({"config" : dict(config), "repeat" : repeat, "metrics" : metrics})
+
+    results["scaling"] = component_scaling(results["runs"])
+    for name, exponents in sorted(results["scaling"].items()):
+        log.info("%s: %s", COMPONENTS[name][0], ", ".join(["time ~ %s^%.2f" % (size, exponent) for size, exponent in sorted(exponents.items())]))
+    return results
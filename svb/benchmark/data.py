@@ -0,0 +1,51 @@
+"""
+SVB - Synthetic data for benchmarks
+"""
+import math
+
+import numpy as np
+
+# True parameter values for each model. The noise standard deviation is the same for all
+TRUE_PARAMS = {
+    "exp" : {"amp1" : 10.0, "r1" : 1.0},
+    "biexp" : {"amp1" : 10.0, "r1" : 1.0, "amp2" : 10.0, "r2" : 10.0},
+}
+NOISE_SD = 1.0
+
+def synthetic_data(model_name, n_voxels, n_tpts, noise_sd=NOISE_SD, seed=0):
+    """
+    Generate noisy exponential or biexponential decay data
+
+    The voxels are laid out in a 2D slice which is as close to square as possible, so
+    spatial priors have realistic neighbourhoods. The slice is masked to give exactly
+    the requested number of voxels. The time points span 5 times the slowest decay time.
+
+    :param model_name: ``exp`` or ``biexp``
+    :param n_voxels: Number of unmasked voxels
+    :param n_tpts: Number of time points
+    :param noise_sd: Standard deviation of the Gaussian noise
+    :param seed: Random seed for the noise
+
+    :return: Tuple of data [X, Y, 1, T], mask [X, Y, 1], time separation ``dt``
+             for the model and dictionary of true parameter values
+    """
+    if model_name not in TRUE_PARAMS:
+        raise ValueError("Unknown benchmark model: %s (supported: %s)" % (model_name, ", ".join(sorted(TRUE_PARAMS))))
+    params = TRUE_PARAMS[model_name]
+    n_exps = len(params) // 2
+    dt = 5.0 / (params["r1"] * n_tpts)
+    tpts = np.arange(n_tpts) * dt
+    signal = np.zeros([n_tpts])
+    for idx in range(n_exps):
+        signal += params["amp%i" % (idx+1)] * np.exp(-params["r%i" % (idx+1)] * tpts)
+
+    nx = int(math.ceil(math.sqrt(n_voxels)))
+    ny = int(math.ceil(float(n_voxels) / nx))
+    mask = np.zeros([nx * ny])
+    mask[:n_voxels] = 1
+    mask = mask.reshape([nx, ny, 1])
+
+    rng = np.random.RandomState(seed)
+    data = signal + rng.normal(0, noise_sd, size=[nx, ny, 1, n_tpts])
+    data *= mask[..., np.newaxis]
+    return data.astype(np.float32), mask, dt, dict(params)
@@ -0,0 +1,110 @@
+"""
+Command line tool for SVB benchmarks
+
+Examples::
+
+    svb_benchmark --output benchmark.json
+    svb_benchmark --voxels 1000,10000,100000 --sample-size 20 --output voxels.json
+    svb_benchmark --compare old.json new.json
+    svb_benchmark --components all --output components.json
+    svb_benchmark --components mrf_log_pdf,mrf2_log_pdf --grid-vertices 100,1000,10000,100000
+"""
+import sys
+import logging
+import argparse
+
+from .. import __version__
+from ..utils import ValueList
+from .scaling import DEFAULT_SWEEP, SWEEP_MODES, COMPARED_METRICS, sweep_configs, run_benchmarks, write_results, read_results, compare_results, config_str
+from .components import DEFAULT_GRID, COMPONENTS, component_configs, run_components
+
+USAGE = "svb_benchmark <options>"
+
+def _bool(value):
+    return value.lower() in ("1", "true", "yes", "y")
+
+class BenchmarkArgumentParser(argparse.ArgumentParser):
+    """
+    ArgumentParser for SVB benchmark options
+    """
+
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="svb_benchmark", usage=USAGE, **kwargs)
+        defaults = dict(DEFAULT_SWEEP)
+
+        group = self.add_argument_group("Sweep options - comma separated lists of values. The first value of each is the base configuration")
+        group.add_argument("--model", help="Models to fit: exp, biexp", type=ValueList(str), default=defaults["model"])
+        group.add_argument("--voxels", dest="n_voxels", help="Number of voxels", type=ValueList(int), default=defaults["n_voxels"])
+        group.add_argument("--tpts", dest="n_tpts", help="Number of time points", type=ValueList(int), default=defaults["n_tpts"])
+        group.add_argument("--batch-size", help="Batch sizes, 0 for no mini-batches", type=ValueList(int), default=defaults["batch_size"])
+        group.add_argument("--sample-size", help="Sample sizes", type=ValueList(int), default=defaults["sample_size"])
+        group.add_argument("--infer-covar", help="Whether to infer the posterior covariance: true, false", type=ValueList(_bool), default=defaults["infer_covar"])
+        group.add_argument("--prior-type", help="Prior types of the model parameters: N, M, M2, Mfab, A", type=ValueList(str), default=defaults["prior_type"])
+        group.add_argument("--optimizer", help="Optimizers: adam, natgrad, saa", type=ValueList(str), default=defaults["optimizer"])
+        group.add_argument("--engine", help="Training engines: session, xla", type=ValueList(str), default=defaults["engine"])
+        group.add_argument("--voxel-conv-tol", help="Per-voxel convergence tolerances, 0 to train all voxels to the end", type=ValueList(float), default=defaults["voxel_conv_tol"])
+        group.add_argument("--sweep", help="axis to vary each option in turn from the base configuration, grid for all combinations",
+                           choices=SWEEP_MODES, default="axis")
+
+        grid = dict(DEFAULT_GRID)
+        group = self.add_argument_group("Component micro-benchmark options - comma separated lists of values")
+        group.add_argument("--components", help="Run micro-benchmarks of individual kernels rather than end-to-end fits: all or %s" % ", ".join(sorted(COMPONENTS)),
+                           type=ValueList(str))
+        group.add_argument("--grid-vertices", help="Number of parameter vertices", type=ValueList(int), default=grid["n_vertices"])
+        group.add_argument("--grid-params", help="Number of parameters", type=ValueList(int), default=grid["n_params"])
+        group.add_argument("--grid-samples", help="Sample sizes", type=ValueList(int), default=grid["sample_size"])
+        group.add_argument("--grid-batch", help="Batch sizes", type=ValueList(int), default=grid["batch_size"])
+        group.add_argument("--calls", help="Number of timed calls of each kernel", type=int, default=20)
+        group.add_argument("--gradients", help="Time kernels together with their gradients, as in a training step", action="store_true", default=False)
+
+        group = self.add_argument_group("Run options")
+        group.add_argument("--epochs", help="Number of training epochs", type=int, default=50)
+        group.add_argument("--learning-rate", "--lr", help="Learning rate", type=float, default=0.1)
+        group.add_argument("--cost-tol", help="Relative tolerance on the mean cost for the time to tolerance", type=float, default=0.01)
+        group.add_argument("--repeats", help="Number of times to run each configuration", type=int, default=1)
+        group.add_argument("--seed", help="Random seed for the data and posterior samples", type=int, default=0)
+        group.add_argument("--no-isolate", dest="isolate", help="Run benchmarks in this process rather than a fresh process for each. "
+                                                                "The peak memory is then the peak over all runs so far",
+                           action="store_false", default=True)
+        group.add_argument("--output", help="JSON file to write results to", default="svb_benchmark.json")
+        group.add_argument("--compare", help="Compare two results files rather than running benchmarks", nargs=2, metavar=("OLD", "NEW"))
+        group.add_argument("--log-level", help="Logging level - defaults to INFO", default="info")
+
+def main():
+    """
+    Command line tool entry point
+    """
+    options = BenchmarkArgumentParser().parse_args()
+    logging.basicConfig(level=getattr(logging, options.log_level.upper(), logging.INFO), format="%(levelname)s : %(message)s")
+
+    if options.compare:
+        for config, changes in compare_results(read_results(options.compare[0]), read_results(options.compare[1])):
+            print(config_str(config))
+            for name in COMPARED_METRICS:
+                if name in changes:
+                    old_value, new_value, ratio, better = changes[name]
+                    print("  %-22s %12.4g -> %12.4g (x%.3f)%s" % (name, old_value, new_value, ratio, "" if better else " *"))
+        return
+
+    print("SVB %s benchmarks" % __version__)
+    if options.components:
+        components = None if options.components == ["all"] else options.components
+        grid = [("n_vertices", options.grid_vertices), ("n_params", options.grid_params),
+                ("sample_size", options.grid_samples), ("batch_size", options.grid_batch)]
+        configs = component_configs(components, grid, options.sweep)
+        results = run_components(configs, repeats=options.repeats, calls=options.calls, gradients=options.gradients)
+        write_results(results, options.output)
+        for name, exponents in sorted(results["scaling"].items()):
+            print("%-22s %s" % (name, " ".join(["%s^%.2f" % (size, exponent) for size, exponent in sorted(exponents.items())])))
+        print("Results of %i runs written to %s" % (len(results["runs"]), options.output))
+        return
+
+    sweep = [(name, getattr(options, name)) for name, _default in DEFAULT_SWEEP]
+    configs = sweep_configs(sweep, options.sweep)
+    results = run_benchmarks(configs, repeats=options.repeats, isolate=options.isolate, epochs=options.epochs,
+                             learning_rate=options.learning_rate, cost_tol=options.cost_tol, seed=options.seed)
+    write_results(results, options.output)
+    print("Results of %i runs written to %s" % (len(results["runs"]), options.output))
+
+if __name__ == "__main__":
+    main()
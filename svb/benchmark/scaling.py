@@ -0,0 +1,337 @@
+"""
+SVB - End-to-end scaling benchmarks
+
+Each benchmark run fits synthetic data with ``SvbFit`` for a fixed number of epochs and
+records:
+
+ - ``steps_per_sec`` - training steps (batches) per second
+ - ``voxel_samples_per_sec`` - voxels times posterior samples processed per second
+ - ``peak_memory_mb`` - peak resident memory of the process, and ``baseline_memory_mb``
+   the resident memory before the data was generated and the graph built
+ - ``time_to_tol`` and ``epochs_to_tol`` - training time and epochs until the mean cost
+   is within a relative tolerance of the best mean cost of the run
+
+By default each run is in a fresh worker process, so the peak memory is that of the run
+alone and TensorFlow state does not carry over between runs.
+
+Runs are defined by configuration dictionaries with the keys of ``DEFAULT_SWEEP``.
+A batch size of 0 means no mini-batches and a per-voxel convergence tolerance of 0 means
+voxels are not frozen when they converge. Options which are not supported together, e.g.
+the SAA optimizer with the XLA engine, fall back as they do in ``SvbFit``.
+"""
+import sys
+import time
+import json
+import platform
+import logging
+import resource
+import datetime
+import itertools
+import multiprocessing
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from .. import __version__, DataModel, SvbFit
+from ..models.exp import ExpModel, BiExpModel
+from .data import synthetic_data
+
+MODELS = {
+    "exp" : ExpModel,
+    "biexp" : BiExpModel,
+}
+
+# Values of each option swept by default. The first value is the base configuration
+DEFAULT_SWEEP = [
+    ("model", ["exp", "biexp"]),
+    ("n_voxels", [100, 1000, 10000]),
+    ("n_tpts", [50, 200]),
+    ("batch_size", [0, 10]),
+    ("sample_size", [5, 20, 100]),
+    ("infer_covar", [False, True]),
+    ("prior_type", ["N", "M", "M2", "Mfab", "A"]),
+    ("optimizer", ["adam", "natgrad", "saa"]),
+    ("engine", ["session", "xla"]),
+    ("voxel_conv_tol", [0, 0.01]),
+]
+
+SWEEP_MODES = ("axis", "grid")
+
+# Metrics compared between benchmark results and whether a larger value is better
+COMPARED_METRICS = {
+    "steps_per_sec" : True,
+    "voxel_samples_per_sec" : True,
+    "peak_memory_mb" : False,
+    "time_to_tol" : False,
+    "time_per_call" : False,
+}
+
+def sweep_configs(sweep=None, mode="axis", options=None):
+    """
+    Generate the configurations for a sweep of options
+
+    :param sweep: Sequence of (option name, sequence of values). Options which are not given
+                  take the first of their default values
+    :param mode: ``axis`` to vary each option in turn from the base configuration given by
+                 the first value of each option, or ``grid`` for every combination of values
+    :param options: Sequence of (option name, sequence of default values) defining the
+                    options of a configuration. Defaults to ``DEFAULT_SWEEP``
+
+    :return: Sequence of configuration dictionaries
+    """
+    if mode not in SWEEP_MODES:
+        raise ValueError("Unknown sweep mode: %s (supported: %s)" % (mode, ", ".join(SWEEP_MODES)))
+    options = options or DEFAULT_SWEEP
+    values = dict([(name, [default[0]]) for name, default in options])
+    for name, option_values in (sweep or options):
+        if name not in values:
+            raise ValueError("Unknown benchmark option: %s" % name)
+        values[name] = list(option_values)
+    names = [name for name, _default in options]
+
+    if mode == "grid":
+        return [dict(zip(names, combination)) for combination in itertools.product(*[values[name] for name in names])]
+
+    base = dict([(name, values[name][0]) for name in names])
+    configs = [base]
+    for name in names:
+        for value in values[name][1:]:
+            config = dict(base)
+            config[name] = value
+            configs.append(config)
+    return configs
+
+def run_config(config, epochs=50, learning_rate=0.1, cost_tol=0.01, seed=0):
+    """
+    Run a single benchmark in the current process
+
+    :param config: Configuration dictionary, see ``sweep_configs``
+    :param epochs: Number of training epochs
+    :param learning_rate: Learning rate
+    :param cost_tol: Relative tolerance on the mean cost for ``time_to_tol``
+    :param seed: Random seed for the data and the posterior samples
+
+    :return: Dictionary of metrics
+    """
+    baseline_memory = _peak_memory_mb()
+    data, mask, dt, _true_params = synthetic_data(config["model"], config["n_voxels"], config["n_tpts"], seed=seed)
+    model_class = MODELS[config["model"]]
+    options = {
+        "dt" : dt,
+        "infer_covar" : config["infer_covar"],
+        "optimizer" : config["optimizer"],
+        "engine" : config["engine"],
+        "voxel_conv_tol" : config["voxel_conv_tol"] or None,
+        "seed" : seed,
+    }
+
+    start_time = time.time()
+    data_model = DataModel(data, mask)
+    param_names = [param.name for param in model_class(data_model, **options).params]
+    options["param_overrides"] = dict([(name, {"prior_type" : config["prior_type"]}) for name in param_names])
+    fwd_model = model_class(data_model, **options)
+    svb = SvbFit(data_model, fwd_model, **options)
+    build_time = time.time() - start_time
+
+    batch_size = config["batch_size"] or None
+    history = svb.train(fwd_model.tpts(), data_model.data_flattened, epochs=epochs, learning_rate=learning_rate,
+                        batch_size=batch_size, sample_size=config["sample_size"], history="mean",
+                        voxel_conv_tol=options["voxel_conv_tol"], display_step=epochs)
+    # The SAA optimizer always uses the full data
+    n_batches = 1
+    if batch_size and config["optimizer"] != "saa":
+        n_batches = int(np.ceil(float(config["n_tpts"]) / batch_size))
+
+    # The history has an entry for each epoch followed by the final values
+    epoch_runtime = history["runtime"][:-1]
+    runtime = float(epoch_runtime[-1])
+    steps = epochs * n_batches
+    epochs_to_tol = _epochs_to_tol(history["mean_cost"][:-1], cost_tol)
+    return {
+        "build_time" : build_time,
+        "runtime" : runtime,
+        "steps" : steps,
+        "steps_per_sec" : steps / runtime,
+        "voxel_samples_per_sec" : config["n_voxels"] * config["sample_size"] * steps / runtime,
+        "baseline_memory_mb" : baseline_memory,
+        "peak_memory_mb" : _peak_memory_mb(),
+        "epochs_to_tol" : epochs_to_tol,
+        "time_to_tol" : float(epoch_runtime[epochs_to_tol-1]) if epochs_to_tol is not None else None,
+        "final_cost" : float(history["mean_cost"][-1]),
+        "final_params" : [float(value) for value in history["mean_params"][-1]],
+    }
+
+def _epochs_to_tol(mean_cost, tol):
+    """
+    :param mean_cost: Mean cost at the end of each epoch
+    :param tol: Relative tolerance
+    :return: Number of epochs until the mean cost is within the tolerance of the best mean
+             cost, or None if the cost is never finite
+    """
+    finite = np.isfinite(mean_cost)
+    if not np.any(finite):
+        return None
+    best = np.min(mean_cost[finite])
+    within = finite & (mean_cost <= best + tol * np.abs(best))
+    return int(np.argmax(within)) + 1
+
+def _peak_memory_mb():
+    """
+    :return: Peak resident memory of the current process in Mb
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the peak in kilobytes, macOS in bytes
+    if sys.platform == "darwin":
+        peak /= 1024.0
+    return peak / 1024.0
+
+def _run_worker(args):
+    """
+    Run a single benchmark in a worker process
+
+    :return: Dictionary of metrics
+    """
+    config, kwargs = args
+    logging.basicConfig(level=getattr(logging, kwargs.pop("log_level"), logging.WARNING))
+    if kwargs.pop("v1_graph_mode") and hasattr(tf, "disable_v2_behavior"):
+        tf.disable_v2_behavior()
+    return run_config(config, **kwargs)
+
+def benchmark_info(**kwargs):
+    """
+    :return: Dictionary describing the system and software versions for benchmark results,
+             the benchmark options given as keyword arguments and an empty list of ``runs``
+    """
+    return {
+        "svb_version" : __version__,
+        "tensorflow_version" : tf.__version__,
+        "numpy_version" : np.__version__,
+        "python_version" : platform.python_version(),
+        "platform" : platform.platform(),
+        "processor" : platform.processor(),
+        "cpu_count" : multiprocessing.cpu_count(),
+        "timestamp" : datetime.datetime.now().isoformat(),
+        "options" : dict(kwargs),
+        "runs" : [],
+    }
+
+def run_benchmarks(configs, repeats=1, isolate=True, **kwargs):
+    """
+    Run a set of benchmarks
+
+    :param configs: Sequence of configuration dictionaries, see ``sweep_configs``
+    :param repeats: Number of times to run each configuration
+    :param isolate: If True, run each benchmark in a fresh worker process
+
+    Keyword arguments are passed to ``run_config``
+
+    :return: Dictionary containing a description of the system and software versions
+             and ``runs``, a sequence of dictionaries containing the ``config``, the
+             ``repeat`` index and the ``metrics`` of each run
+    """
+    log = logging.getLogger(__name__)
+    results = benchmark_info(**kwargs)
+
+    # The training output of each run is only logged from worker processes when debugging
+    worker_kwargs = dict(kwargs)
+    worker_kwargs.update({
+        "log_level" : "DEBUG" if logging.getLogger().isEnabledFor(logging.DEBUG) else "WARNING",
+        "v1_graph_mode" : not tf.executing_eagerly(),
+    })
+    for idx, config in enumerate(configs):
+        for repeat in range(repeats):
+            log.info("Benchmark %i of %i (repeat %i): %s", idx+1, len(configs), repeat+1, config_str(config))
+            try:
+                if isolate:
+                    # TensorFlow is not safe to use after a fork so start a fresh worker process
+                    context = multiprocessing.get_context("spawn")
+                    pool = context.Pool(1)
+                    try:
+                        metrics = pool.apply(_run_worker, ((config, dict(worker_kwargs)),))
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    metrics = run_config(config, **kwargs)
+            except Exception as exc: # pylint: disable=broad-except
+                # Record failures, e.g. running out of memory, and carry on with the other runs
+                log.exception("Benchmark failed")
+                metrics = {"error" : str(exc)}
+            else:
+                log.info(" - %.1f steps/s, %.3g voxel samples/s, peak memory %.0f Mb, %s epochs to tolerance",
+                         metrics["steps_per_sec"], metrics["voxel_samples_per_sec"], metrics["peak_memory_mb"],
+                         metrics["epochs_to_tol"])
+            results["runs"].append({"config" : dict(config), "repeat" : repeat, "metrics" : metrics})
+    return results
+
+def write_results(results, fname):
+    """
+    Write benchmark results to a JSON file
+    """
+    with open(fname, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+def read_results(fname):
+    """
+    Read benchmark results from a JSON file
+    """
+    with open(fname) as results_file:
+        return json.load(results_file)
+
+def compare_results(old, new):
+    """
+    Compare the metrics of two sets of benchmark results, e.g. from different versions
+
+    Runs are matched by their configuration and the metrics of repeated runs are averaged.
+    Failed runs and configurations which are only in one of the results are skipped
+
+    :param old: Benchmark results as returned by ``run_benchmarks``
+    :param new: Benchmark results to compare with ``old``
+
+    :return: Sequence of (configuration, dictionary of metric name : (old value, new value,
+             ratio of new to old value, True if the new value is better))
+    """
+    old_metrics, new_metrics = _mean_metrics(old), _mean_metrics(new)
+    comparison = []
+    for key, (config, metrics) in new_metrics.items():
+        if key not in old_metrics:
+            continue
+        changes = {}
+        for name, larger_better in COMPARED_METRICS.items():
+            old_value, new_value = old_metrics[key][1].get(name, None), metrics.get(name, None)
+            if old_value is None or new_value is None or old_value == 0:
+                continue
+            changes[name] = (old_value, new_value, new_value / old_value,
+                             new_value >= old_value if larger_better else new_value <= old_value)
+        comparison.append((config, changes))
+    return comparison
+
+def _mean_metrics(results):
+    """
+    :return: Dictionary of configuration key : (configuration, mean of each metric over repeats)
+    """
+    runs = {}
+    for run in results["runs"]:
+        if "error" in run["metrics"]:
+            continue
+        key = json.dumps(run["config"], sort_keys=True)
+        runs.setdefault(key, (run["config"], []))[1].append(run["metrics"])
+
+    means = {}
+    for key, (config, repeats) in runs.items():
+        metrics = {}
+        for name in COMPARED_METRICS:
+            values = [repeat[name] for repeat in repeats if repeat.get(name, None) is not None]
+            if values:
+                metrics[name] = float(np.mean(values))
+        means[key] = (config, metrics)
+    return means
+
+def config_str(config):
+    """
+    :return: Description of a benchmark configuration
+    """
+    return " ".join(["%s=%s" % (name, value) for name, value in config.items()])
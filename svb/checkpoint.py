@@ -0,0 +1,93 @@
+"""
+SVB - Checkpoints
+
+A checkpoint contains the full state of the optimization so that training can be
+resumed, e.g. after a batch job has been pre-empted. The graph variables, including
+the prior variables, optimizer moments and global step, are saved using a TensorFlow
+``Saver``. The state of the training loop - epoch, best cost, convergence
+state and the number of rows of the streamed training history - is saved alongside
+in a pickle file.
+
+The training state is written before the graph variables, and the graph variables are
+only registered as the latest checkpoint once they are complete, so an interrupted save
+leaves the previous checkpoint in place.
+"""
+import os
+import glob
+import pickle
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from .utils import LogBase
+
+class Checkpoint(LogBase):
+    """
+    Saves and restores checkpoints in a directory
+    """
+
+    def __init__(self, checkpoint_dir, saver):
+        """
+        :param checkpoint_dir: Directory containing the checkpoints
+        :param saver: ``tf.train.Saver`` for the graph variables
+        """
+        LogBase.__init__(self)
+        self.checkpoint_dir = checkpoint_dir
+        self._saver = saver
+        self._prefix = os.path.join(checkpoint_dir, "ckpt")
+
+    def save(self, sess, epoch, train_state):
+        """
+        Save a checkpoint
+
+        :param sess: Session containing the graph variables
+        :param epoch: Index of the last epoch trained
+        :param train_state: Picklable training loop state
+        """
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        # Checkpoints are numbered by the number of epochs trained
+        state_fname = "%s-%i.pkl" % (self._prefix, epoch+1)
+        with open(state_fname + ".tmp", "wb") as state_file:
+            pickle.dump(train_state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        _replace(state_fname + ".tmp", state_fname)
+        self._saver.save(sess, self._prefix, global_step=epoch+1)
+
+        # Remove training state of checkpoints which the saver no longer keeps
+        keep = set(["%s.pkl" % path for path in self._saver.last_checkpoints])
+        for fname in glob.glob("%s-*.pkl" % self._prefix):
+            if fname not in keep:
+                os.remove(fname)
+        self.log.debug("Saved checkpoint after epoch %i", epoch+1)
+
+    def restore(self, sess):
+        """
+        Restore the latest checkpoint
+
+        :param sess: Session containing the graph variables
+        :return: Training loop state of the latest checkpoint, or None if there is no checkpoint
+        """
+        path = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if path is None:
+            return None
+
+        self._saver.restore(sess, path)
+        self._saver.recover_last_checkpoints(tf.train.get_checkpoint_state(self.checkpoint_dir).all_model_checkpoint_paths)
+        with open("%s.pkl" % path, "rb") as state_file:
+            train_state = pickle.load(state_file)
+        self.log.info(" - Restored checkpoint %s", path)
+        return train_state
+
+def _replace(src, dst):
+    """
+    Rename a file, replacing any existing file. ``os.replace`` is not available in Python 2
+    """
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
@@ -0,0 +1,219 @@
+"""
+SVB - Fitting of independent voxel chunks
+
+When no spatial priors or global posteriors are used, the parameters at each voxel
+are independent of each other, so the data can be divided into chunks of voxels which
+are fitted one after another. The size of the ``[V, S, B]`` tensors used during training
+is then set by the chunk size rather than the number of unmasked voxels.
+
+All chunks are padded to the same size so a single graph can be used for every chunk.
+"""
+import os
+import time
+import shutil
+import logging
+
+import numpy as np
+
+from .svb import SvbFit
+from .history import concatenate_voxel_history
+
+# Voxel axis of each output returned by SvbFit.results()
+RESULTS_VOXEL_AXIS = {
+    "mean" : 1,
+    "var" : 1,
+    "modelfit" : 0,
+    "post_mean" : 0,
+    "post_cov" : 0,
+}
+
+def voxel_chunks(n_voxels, chunk_size):
+    """
+    Divide voxels into chunks of fixed size
+
+    :param n_voxels: Number of unmasked voxels
+    :param chunk_size: Number of voxels in each chunk
+
+    :return: Sequence of tuples of (indices, n_real). ``indices`` contains the unmasked
+             voxel indices in the chunk. The final chunk is padded to ``chunk_size`` by
+             repeating its last voxel, ``n_real`` is the number of voxels which are not
+             padding
+    """
+    chunks = []
+    for start in range(0, n_voxels, chunk_size):
+        indices = np.arange(start, min(start + chunk_size, n_voxels))
+        n_real = len(indices)
+        if n_real < chunk_size:
+            indices = np.concatenate([indices, np.full(chunk_size - n_real, indices[-1])])
+        chunks.append((indices, n_real))
+    return chunks
+
+def voxel_tpts(tpts, indices):
+    """
+    :param tpts: Time points with shape [T], [1, T] or [V, T]
+    :param indices: Unmasked voxel indices
+    :return: Time points for the selected voxels
+    """
+    if tpts.ndim > 1 and tpts.shape[0] > 1:
+        return tpts[indices]
+    else:
+        return tpts
+
+def select_voxels(training_history, results, n_real):
+    """
+    Remove padding voxels from training history and results
+
+    :return: Tuple of training history, results
+    """
+    training_history = dict(training_history)
+    training_history["voxel_cost"] = training_history["voxel_cost"][:n_real]
+    training_history["voxel_params"] = training_history["voxel_params"][:n_real]
+    results = dict([
+        (key, np.take(value, np.arange(n_real), axis=RESULTS_VOXEL_AXIS[key]))
+        for key, value in results.items()
+    ])
+    return training_history, results
+
+def merge(histories, results, parallel=False, history_dir=None):
+    """
+    Merge training histories and results from consecutive sets of voxels
+
+    Mean cost and parameter histories are recalculated from the merged voxelwise
+    histories. If only the mean history was recorded, the means of each set of voxels
+    are combined weighted by the number of voxels.
+
+    :param histories: Sequence of training history dictionaries, in voxel order
+    :param results: Sequence of results dictionaries, in voxel order
+    :param parallel: If True, the sets of voxels were fitted in parallel so the
+                     runtime of each epoch is the maximum over the sets of voxels.
+                     Otherwise the runtimes are summed
+    :param history_dir: If specified, the merged voxelwise history is written to this
+                        directory rather than being held in memory
+
+    :return: Tuple of merged training history, merged results. The stop reason is the
+             comma-separated set of reasons the sets of voxels stopped training
+    """
+    training_history = concatenate_voxel_history(histories, history_dir)
+    voxel_cost, voxel_params = training_history["voxel_cost"], training_history["voxel_params"]
+    if voxel_cost.shape[1] == len(histories[0]["mean_cost"]):
+        mean_cost = np.mean(voxel_cost, axis=0)
+        mean_params = np.mean(voxel_params, axis=0)
+    else:
+        weights = [history["voxel_cost"].shape[0] for history in histories]
+        mean_cost = np.average([history["mean_cost"] for history in histories], axis=0, weights=weights)
+        mean_params = np.average([history["mean_params"] for history in histories], axis=0, weights=weights)
+        mean_cost[-1] = np.mean(voxel_cost[:, -1])
+        mean_params[-1] = np.mean(voxel_params[:, -1], axis=0)
+
+    training_history.update({
+        "epochs" : histories[0]["epochs"],
+        "mean_cost" : mean_cost,
+        "mean_params" : mean_params,
+        "runtime" : (np.max if parallel else np.sum)([history["runtime"] for history in histories], axis=0),
+        "stop_reason" : ",".join(sorted(set([history.get("stop_reason", "epochs") for history in histories]))),
+    })
+    merged_results = dict([
+        (key, np.concatenate([result[key] for result in results], axis=axis))
+        for key, axis in RESULTS_VOXEL_AXIS.items()
+    ])
+    return training_history, merged_results
+
+def split(training_history, results, n_voxels):
+    """
+    Split training history and results into consecutive sets of voxels
+
+    This is the inverse of ``merge``, e.g. to separate the output of stacked data sets.
+    Mean cost and parameter histories are recalculated for each set of voxels from the
+    voxelwise history. If only the mean history was recorded, only the final values
+    can be recalculated and the earlier entries are the means over all voxels.
+
+    :param training_history: Training history dictionary
+    :param results: Results dictionary
+    :param n_voxels: Sequence containing the number of voxels in each set
+
+    :return: Sequence of tuples of training history, results for each set of voxels
+    """
+    offsets = np.cumsum(n_voxels)[:-1]
+    voxel_cost = np.split(training_history["voxel_cost"], offsets, axis=0)
+    voxel_params = np.split(training_history["voxel_params"], offsets, axis=0)
+    split_results = dict([
+        (key, np.split(value, offsets, axis=RESULTS_VOXEL_AXIS[key]))
+        for key, value in results.items()
+    ])
+    full_history = training_history["voxel_cost"].shape[1] == len(training_history["mean_cost"])
+
+    outputs = []
+    for idx in range(len(n_voxels)):
+        if full_history:
+            mean_cost = np.mean(voxel_cost[idx], axis=0)
+            mean_params = np.mean(voxel_params[idx], axis=0)
+        else:
+            mean_cost = np.array(training_history["mean_cost"])
+            mean_params = np.array(training_history["mean_params"])
+            mean_cost[-1] = np.mean(voxel_cost[idx][:, -1])
+            mean_params[-1] = np.mean(voxel_params[idx][:, -1], axis=0)
+
+        history = dict(training_history)
+        history.update({
+            "mean_cost" : mean_cost,
+            "mean_params" : mean_params,
+            "voxel_cost" : voxel_cost[idx],
+            "voxel_params" : voxel_params[idx],
+        })
+        outputs.append((history, dict([(key, value[idx]) for key, value in split_results.items()])))
+    return outputs
+
+def train_chunked(data_model, model_class, tpts, chunk_size, **kwargs):
+    """
+    Fit the data in independent chunks of voxels using a single graph
+
+    :param data_model: DataModel instance for the full data
+    :param model_class: Model class being fitted
+    :param tpts: Time points, shape [T] or [V, T]
+    :param chunk_size: Number of voxels in each chunk
+
+    Keyword arguments are passed to the model, ``SvbFit`` and ``SvbFit.train``
+
+    :return: Tuple of SvbFit instance used for fitting, training history, results.
+             The training history and results are in the same format as ``SvbFit.train``
+             and ``SvbFit.results`` and cover all the unmasked voxels
+    """
+    log = logging.getLogger(__name__)
+    chunks = voxel_chunks(data_model.n_unmasked_voxels, chunk_size)
+    log.info("Fitting %i voxels in %i chunks of %i voxels", data_model.n_unmasked_voxels, len(chunks), chunk_size)
+
+    # Streamed voxelwise history is written to a separate directory for each chunk
+    # and merged at the end
+    history_dir = kwargs.pop("history_dir", None)
+    chunk_dirs = []
+
+    # The time limit applies to fitting all of the chunks
+    time_limit = kwargs.pop("time_limit", None)
+    start_time = time.time()
+
+    svb, histories, results = None, [], []
+    for chunk_idx, (indices, n_real) in enumerate(chunks):
+        log.info("Chunk %i of %i: voxels %i-%i", chunk_idx+1, len(chunks), indices[0], indices[n_real-1])
+        chunk_model = data_model.voxel_subset(indices)
+        if svb is None:
+            fwd_model = model_class(chunk_model, **kwargs)
+            svb = SvbFit(chunk_model, fwd_model, **kwargs)
+
+        if history_dir:
+            chunk_dirs.append(os.path.join(history_dir, "chunk%04i" % chunk_idx))
+            kwargs["history_dir"] = chunk_dirs[-1]
+        if time_limit is not None:
+            kwargs["time_limit"] = max(0, time_limit - (time.time() - start_time))
+        chunk_history = svb.train(voxel_tpts(tpts, indices), chunk_model.data_flattened,
+                                  post_init=chunk_model.post_init, **kwargs)
+        chunk_history, chunk_results = select_voxels(chunk_history, svb.results(), n_real)
+        histories.append(chunk_history)
+        results.append(chunk_results)
+
+        # All chunks run the same graph so only the first chunk is profiled
+        kwargs["profile_steps"] = None
+
+    training_history, results = merge(histories, results, history_dir=history_dir)
+    for chunk_dir in chunk_dirs:
+        shutil.rmtree(chunk_dir)
+    return svb, training_history, results
@@ -2,7 +2,11 @@
 SVB - Data model
 """
 import math
-import collections
+import copy
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 
 import six
 import numpy as np
@@ -30,7 +34,7 @@ class DataModel(LogBase):
         self.data_flattened = self.data_vol.reshape(-1, self.n_tpts)
 
         # If there is a mask load it and use it to mask the data
-        if mask:
+        if mask is not None:
             mask_nii, self.mask_vol = self._get_data(mask)
             self.mask_flattened = self.mask_vol.flatten()
             self.data_flattened = self.data_flattened[self.mask_flattened > 0]
@@ -70,6 +74,42 @@ class DataModel(LogBase):
         """
         return tensor
 
+    def voxel_subset(self, indices):
+        """
+        Get a data model containing a subset of the unmasked voxels
+
+        This is used when subsets of voxels are fitted independently of each other.
+        Note that the subset does not correspond to a volume so it cannot be used
+        to generate output images.
+
+        :param indices: Sequence of unmasked voxel indices to include. Indices may
+                        be repeated, e.g. to pad the subset to a fixed size
+
+        :return: DataModel instance for the voxel subset
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        subset = copy.copy(self)
+        subset.nii = None
+        subset.data_vol = None
+        subset.mask_vol = None
+        subset.data_flattened = self.data_flattened[indices]
+        subset.n_unmasked_voxels = len(indices)
+        subset.n_vertices = subset.n_unmasked_voxels
+        if self.post_init is not None:
+            mean, cov = self.post_init
+            subset.post_init = (mean[indices], cov[indices])
+
+        # Neighbour lists are restricted to the subset and re-indexed. Repeated
+        # voxels take the index of their first occurrence
+        subset_idx = {}
+        for new_idx, old_idx in enumerate(indices):
+            subset_idx.setdefault(old_idx, new_idx)
+        subset.indices_nn = [[subset_idx[v1], subset_idx[v2]] for v1, v2 in self.indices_nn
+                             if v1 in subset_idx and v2 in subset_idx]
+        subset.indices_n2 = [[subset_idx[v1], subset_idx[v2]] for v1, v2 in self.indices_n2
+                             if v1 in subset_idx and v2 in subset_idx]
+        return subset
+
     def nifti_image(self, data):
         """
         :return: A nibabel.Nifti1Image for some, potentially masked, output data
@@ -119,7 +159,7 @@ class DataModel(LogBase):
     def _get_posterior_data(self, post_data):
         if isinstance(post_data, six.string_types):
             return self._posterior_from_file(post_data)
-        elif isinstance(post_data, collections.Sequence):
+        elif isinstance(post_data, Sequence):
             return tuple(post_data)
         else:
             raise TypeError("Invalid data type for initial posterior: should be filename or tuple of mean, covariance")
@@ -149,8 +189,10 @@ class DataModel(LogBase):
             raise ValueError("Posterior input file '%s' has %i volumes - not consistent with upper triangle of square matrix" % (fname, nvols))
         self.log.info("Posterior image contains %i parameters", n_params)
         
-        cov = np.zeros((self.n_unmasked_voxels, n_params, n_params), dtype=np.float32)
-        mean = np.zeros((self.n_unmasked_voxels, n_params), dtype=np.float32)
+        # Keep the precision of the file - the arrays are converted to the precision
+        # policy of the fit when the graph is built
+        cov = np.zeros((self.n_unmasked_voxels, n_params, n_params), dtype=post_data.dtype)
+        mean = np.zeros((self.n_unmasked_voxels, n_params), dtype=post_data.dtype)
         vol_idx = 0
         for row in range(n_params):
             for col in range(row+1):
@@ -230,3 +272,87 @@ class DataModel(LogBase):
             voxel_n2s[voxel_idx] = [v for v in voxel_n2s[voxel_idx] if v != voxel_idx]
             for n2 in voxel_n2s[voxel_idx]:
                 self.indices_n2.append([voxel_idx, n2])
+
+class StackedDataModel(DataModel):
+    """
+    Several data sets stacked along the voxel axis so they can be fitted in a single graph
+
+    Each data set has its own mask. The neighbour lists are block-diagonal so voxels in
+    different data sets are never neighbours. However the data sets are still coupled
+    through any quantity which is shared between voxels - the spatial smoothing parameter
+    ``ak`` of spatial priors is inferred from all voxels of all data sets, and a global
+    posterior has a single value for all of them. Data sets are only fitted independently
+    if all parameters have non-spatial or ARD priors and voxelwise posteriors. All data sets
+    must have the same number of time points, however the time values may differ.
+    """
+
+    def __init__(self, data, mask=None, **kwargs):
+        """
+        :param data: Sequence of data sets, each a file name or Numpy array as for ``DataModel``
+        :param mask: Optional sequence of masks, one for each data set
+
+        Keyword arguments are passed to the ``DataModel`` of each data set
+        """
+        LogBase.__init__(self)
+        if mask is None:
+            mask = [None] * len(data)
+        if len(mask) != len(data):
+            raise ValueError("%i masks given for %i data sets" % (len(mask), len(data)))
+
+        self.subjects = [DataModel(subject_data, subject_mask, **kwargs) for subject_data, subject_mask in zip(data, mask)]
+        n_tpts = set([subject.n_tpts for subject in self.subjects])
+        if len(n_tpts) != 1:
+            raise ValueError("Stacked data sets must have the same number of time points: %s" % sorted(n_tpts))
+        self.n_tpts = n_tpts.pop()
+
+        # There is no single volume for the stacked data
+        self.nii, self.data_vol, self.mask_vol, self.mask_flattened = None, None, None, None
+        self.shape = None
+
+        self.n_subject_voxels = [subject.n_unmasked_voxels for subject in self.subjects]
+        self.data_flattened = np.concatenate([subject.data_flattened for subject in self.subjects], axis=0)
+        self.n_unmasked_voxels = self.data_flattened.shape[0]
+        self.n_vertices = self.n_unmasked_voxels
+        self.log.info("Stacked %i data sets with %s voxels", len(self.subjects), self.n_subject_voxels)
+
+        post_inits = [subject.post_init for subject in self.subjects]
+        if all([post_init is not None for post_init in post_inits]):
+            self.post_init = (
+                np.concatenate([mean for mean, _cov in post_inits], axis=0),
+                np.concatenate([cov for _mean, cov in post_inits], axis=0),
+            )
+        elif any([post_init is not None for post_init in post_inits]):
+            raise ValueError("Initial posterior must be given for all stacked data sets or none")
+        else:
+            self.post_init = None
+
+        # Neighbour lists of each data set offset by the index of its first voxel
+        self.indices_nn, self.indices_n2 = [], []
+        for offset, subject in zip(self._offsets(), self.subjects):
+            self.indices_nn += [[v1 + offset, v2 + offset] for v1, v2 in subject.indices_nn]
+            self.indices_n2 += [[v1 + offset, v2 + offset] for v1, v2 in subject.indices_n2]
+
+    def stack_tpts(self, tpts):
+        """
+        Stack the time points of each data set
+
+        :param tpts: Sequence of time points for each data set, each with shape [T] or [V, T]
+
+        :return: Time points with shape [T] if they are the same for all voxels, otherwise [V, T]
+        """
+        tpts = [np.array(subject_tpts) for subject_tpts in tpts]
+        if len(tpts) != len(self.subjects):
+            raise ValueError("%i sets of time points given for %i data sets" % (len(tpts), len(self.subjects)))
+        if all([subject_tpts.ndim == 1 for subject_tpts in tpts]) and all([np.array_equal(subject_tpts, tpts[0]) for subject_tpts in tpts]):
+            return tpts[0]
+
+        return np.concatenate([
+            np.broadcast_to(np.reshape(subject_tpts, (-1, self.n_tpts)), (n_voxels, self.n_tpts))
+            for subject_tpts, n_voxels in zip(tpts, self.n_subject_voxels)
+        ], axis=0)
+
+    def nifti_image(self, data):
+        raise ValueError("Stacked data has no single volume - split the output and use the data model of each data set")
+
+    def _offsets(self):
+        return list(np.cumsum([0] + self.n_subject_voxels[:-1]))
@@ -0,0 +1,314 @@
+"""
+SVB - Training history
+
+The training history records the cost and parameter values at the end of each
+training epoch. The amount of detail recorded can be chosen:
+
+ - ``full`` records the voxelwise cost and parameters as well as their means
+ - ``mean`` records only the mean cost and parameters over all voxels
+ - ``off`` records no epoch history
+
+The history may also be recorded only every k epochs. The values after the final
+epoch, evaluated on the full data, are always recorded including the voxelwise
+values.
+
+The voxelwise history can be streamed to memory-mapped ``.npy`` files rather than
+being held in memory. These are written by a background thread so training does
+not have to wait for the disk. The mean history is streamed alongside it, so the
+state of streamed history is just the number of rows recorded.
+"""
+import os
+import threading
+
+import numpy as np
+from six.moves import queue
+
+from .utils import LogBase
+
+HISTORY_MODES = ("off", "mean", "full")
+
+# Mean history arrays, which are also streamed with the voxelwise history
+MEAN_HISTORY = ("mean_cost", "mean_params", "runtime")
+
+def load_voxel_history(outdir):
+    """
+    Open voxelwise history which has been streamed to disk
+
+    :param outdir: History directory
+    :return: Dictionary containing ``voxel_cost`` [V, E] and ``voxel_params`` [V, E, P]
+             as read-only memory-mapped arrays
+    """
+    voxel_cost = np.load(os.path.join(outdir, "voxel_cost.npy"), mmap_mode="r")
+    voxel_params = np.load(os.path.join(outdir, "voxel_params.npy"), mmap_mode="r")
+    return {
+        "voxel_cost" : np.transpose(voxel_cost),
+        "voxel_params" : np.transpose(voxel_params, (1, 0, 2)),
+    }
+
+def concatenate_voxel_history(histories, outdir=None):
+    """
+    Concatenate the voxelwise history of consecutive sets of voxels
+
+    :param histories: Sequence of training history dictionaries, in voxel order
+    :param outdir: If specified, the concatenated history is written to this directory
+                   rather than being held in memory
+
+    :return: Dictionary containing ``voxel_cost`` [V, E] and ``voxel_params`` [V, E, P]
+    """
+    names = ("voxel_cost", "voxel_params")
+    if not outdir:
+        return dict([(name, np.concatenate([history[name] for history in histories], axis=0)) for name in names])
+
+    # Written one set of voxels at a time in the same layout as HistoryWriter
+    n_voxels = sum([history["voxel_cost"].shape[0] for history in histories])
+    n_rows, n_params = histories[0]["voxel_params"].shape[1:]
+    writer = HistoryWriter(outdir, {
+        "voxel_cost" : [n_rows, n_voxels],
+        "voxel_params" : [n_rows, n_voxels, n_params],
+    })
+    start = 0
+    for history in histories:
+        end = start + history["voxel_cost"].shape[0]
+        writer.arrays["voxel_cost"][:, start:end] = np.transpose(history["voxel_cost"])
+        writer.arrays["voxel_params"][:, start:end] = np.transpose(history["voxel_params"], (1, 0, 2))
+        start = end
+    writer.close()
+    return load_voxel_history(outdir)
+
+class HistoryWriter(LogBase):
+    """
+    Writes voxelwise history to memory-mapped ``.npy`` files in a background thread
+
+    Arrays are stored with the epoch as the first dimension so each epoch is written
+    to a contiguous block of the file
+    """
+
+    def __init__(self, outdir, shapes, max_queued=16, resume=False):
+        """
+        :param outdir: Directory to write the history files to
+        :param shapes: Mapping of array name to shape. The first dimension is the epoch
+        :param max_queued: Maximum number of epoch slices waiting to be written. If
+                           the disk cannot keep up training waits for it
+        :param resume: If True, existing history files of the same shape are opened
+                       for update rather than being overwritten
+        """
+        LogBase.__init__(self)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        self.arrays = {}
+        for name, shape in shapes.items():
+            fname = os.path.join(outdir, "%s.npy" % name)
+            array = None
+            if resume and os.path.exists(fname):
+                array = np.lib.format.open_memmap(fname, mode="r+")
+                if array.shape != tuple(shape):
+                    self.log.warning("Existing history %s has shape %s - expected %s", fname, array.shape, tuple(shape))
+                    array = None
+            if array is None:
+                array = np.lib.format.open_memmap(fname, mode="w+", dtype=np.float32, shape=tuple(shape))
+            self.arrays[name] = array
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name="HistoryWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, name, rows, value):
+        """
+        Queue an epoch slice to be written
+
+        :param name: Array name
+        :param rows: Epoch index or sequence of indices to write the value to
+        :param value: Value for the epoch slice. This is copied so the caller may reuse it
+        """
+        self._queue.put((name, rows, np.array(value, dtype=np.float32)))
+
+    def flush(self):
+        """
+        Wait for all queued slices to be written and flush the files
+        """
+        self._queue.join()
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        """
+        Wait for all queued slices to be written and flush the files
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        for array in self.arrays.values():
+            array.flush()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            name, rows, value = item
+            try:
+                self.arrays[name][rows] = value
+            except Exception as exc: # pylint: disable=broad-except
+                # Keep consuming the queue so training does not block, and report
+                # the error on close
+                self.log.exception("Failed to write training history")
+                self._error = exc
+            self._queue.task_done()
+
+class TrainingHistory(LogBase):
+    """
+    Records the cost and parameter history of training
+    """
+
+    def __init__(self, n_voxels, n_params, epochs, mode="full", step=1, outdir=None, resume=False):
+        """
+        :param n_voxels: Number of voxels
+        :param n_params: Number of parameters including noise
+        :param epochs: Number of training epochs
+        :param mode: One of ``HISTORY_MODES``
+        :param step: Record history every ``step`` epochs
+        :param outdir: If specified, directory to stream the voxelwise history to
+        :param resume: If True, history already streamed to ``outdir`` is kept so
+                       that it can be continued after ``set_state``
+        """
+        LogBase.__init__(self)
+        if mode not in HISTORY_MODES:
+            raise ValueError("Unknown history mode: %s (supported: %s)" % (mode, ", ".join(HISTORY_MODES)))
+        if step < 1:
+            raise ValueError("History step must be at least 1: %i" % step)
+
+        self.mode = mode
+        recorded = list(range(0, epochs, step)) if mode != "off" else []
+        self._rows = dict([(epoch, row) for row, epoch in enumerate(recorded)])
+        self._n_recorded = 0
+        n_rows = len(recorded) + 1
+        self._history = {
+            "epochs" : np.array(recorded + [epochs]),
+            "mean_cost" : np.zeros([n_rows]),
+            "mean_params" : np.zeros([n_rows, n_params]),
+            "runtime" : np.zeros([n_rows]),
+            "stop_reason" : "epochs",
+        }
+
+        # Voxelwise history is stored with the epoch as the first dimension and
+        # transposed on output
+        n_voxel_rows = n_rows if mode == "full" else 1
+        shapes = {
+            "voxel_cost" : [n_voxel_rows, n_voxels],
+            "voxel_params" : [n_voxel_rows, n_voxels, n_params],
+        }
+        self._outdir = outdir
+        if outdir:
+            shapes.update([(key, self._history[key].shape) for key in MEAN_HISTORY])
+            self._writer = HistoryWriter(outdir, shapes, resume=resume)
+            self._voxel = self._writer.arrays
+        else:
+            self._writer = None
+            self._voxel = dict([(name, np.zeros(shape, dtype=np.float32)) for name, shape in shapes.items()])
+
+    def record(self, epoch, cost, params=None, runtime=0, last=False):
+        """
+        Record the values at the end of an epoch
+
+        :param epoch: Epoch index
+        :param cost: Voxelwise cost [V]
+        :param params: Voxelwise model parameter means [P, V]. If not specified, parameters
+                       are not recorded
+        :param runtime: Time since the start of training
+        :param last: If True, this is the last epoch of training and the values are also
+                     used for any remaining epochs
+        """
+        if last:
+            rows = [row for recorded_epoch, row in self._rows.items() if recorded_epoch >= epoch]
+        elif epoch in self._rows:
+            rows = self._rows[epoch]
+        else:
+            return
+
+        self._write(rows, cost, params, runtime, voxelwise=self.mode == "full")
+        if np.size(rows):
+            self._n_recorded = max(self._n_recorded, int(np.max(rows)) + 1)
+
+    def final(self, cost, params, runtime=0, stop_reason="epochs"):
+        """
+        Record the final values after training
+
+        :param cost: Voxelwise cost [V]
+        :param params: Voxelwise model parameter means [P, V]
+        :param runtime: Time since the start of training
+        :param stop_reason: Why training stopped: ``epochs`` if all epochs were run,
+                            ``converged`` or ``time_limit``
+        """
+        self._write(-1, cost, params, runtime, voxelwise=True)
+        self._history["stop_reason"] = stop_reason
+
+    def state(self):
+        """
+        :return: Picklable state of the history recorded so far. Streamed history is
+                 flushed to disk and only the number of rows recorded is included, so
+                 the size of the state does not grow with the number of epochs
+        """
+        state = {"rows" : self._n_recorded}
+        if self._writer is not None:
+            self._writer.flush()
+        else:
+            state["history"] = dict([(key, np.copy(value)) for key, value in self._history.items()])
+            state["voxel"] = dict([(key, np.copy(value)) for key, value in self._voxel.items()])
+        return state
+
+    def set_state(self, state):
+        """
+        Continue from a previously recorded state
+
+        :param state: State returned by ``state()``. Streamed history is read back from
+                      the files, which must have been opened with ``resume``
+        """
+        self._n_recorded = state["rows"]
+        if self._writer is not None:
+            for key in MEAN_HISTORY:
+                self._history[key][:self._n_recorded] = self._writer.arrays[key][:self._n_recorded]
+        else:
+            self._history.update(state["history"])
+            for key, value in state["voxel"].items():
+                self._voxel[key][...] = value
+
+    def close(self):
+        """
+        :return: Training history dictionary. ``epochs`` contains the index of the epoch
+                 recorded in each entry, where the last entry is the final value after
+                 training. ``mean_cost`` [E], ``mean_params`` [E, P] and ``runtime`` [E]
+                 contain the mean history, ``voxel_cost`` [V, E] and ``voxel_params`` [V, E, P]
+                 the voxelwise history. In ``mean`` or ``off`` mode the voxelwise history
+                 only contains the final values. ``stop_reason`` records why training stopped
+        """
+        history = dict(self._history)
+        if self._writer is not None:
+            self._writer.close()
+            history.update(load_voxel_history(self._outdir))
+        else:
+            history["voxel_cost"] = np.transpose(self._voxel["voxel_cost"])
+            history["voxel_params"] = np.transpose(self._voxel["voxel_params"], (1, 0, 2))
+        return history
+
+    def _write(self, rows, cost, params, runtime, voxelwise):
+        self._history["mean_cost"][rows] = np.mean(cost)
+        self._history["runtime"][rows] = runtime
+        if params is not None:
+            self._history["mean_params"][rows] = np.mean(params, axis=1)
+        if self._writer is not None:
+            for key in MEAN_HISTORY:
+                self._writer.write(key, rows, self._history[key][rows])
+        if voxelwise:
+            self._write_voxel("voxel_cost", rows, cost)
+            if params is not None:
+                self._write_voxel("voxel_params", rows, np.transpose(params))
+
+    def _write_voxel(self, name, rows, value):
+        if self._writer is not None:
+            self._writer.write(name, rows, value)
+        else:
+            self._voxel[name][rows] = value
@@ -0,0 +1,139 @@
+"""
+SVB - Batched L-BFGS minimization
+
+Minimizes a set of independent functions, one for each voxel, at the same time. Each
+voxel has its own L-BFGS memory and backtracking line search, but the functions and their
+gradients are evaluated for all voxels at once, so each evaluation is a single TensorFlow
+session call.
+
+This is used to minimize the sample average approximation of the cost, in which the
+posterior samples are generated from a fixed set of random draws so the cost is a
+deterministic function of the posterior.
+"""
+import numpy as np
+
+class BatchedLbfgs(object):
+    """
+    Limited memory BFGS minimization of independent functions of each voxel
+    """
+
+    def __init__(self, fun, memory=10, max_line_search=10, c1=1e-4):
+        """
+        :param fun: Callable taking positions [V, N] and returning a sequence of arrays whose
+                    first two entries are the function values [V] and gradients [V, N]. Any
+                    further arrays [V, ...] are returned with the function values at the
+                    accepted positions, e.g. components of the cost
+        :param memory: Number of previous steps used to approximate the inverse Hessian
+        :param max_line_search: Maximum number of function evaluations in each line search.
+                                The step length is halved after each evaluation
+        :param c1: Sufficient decrease parameter for the line search
+        """
+        self._fun = fun
+        self._memory = memory
+        self._max_line_search = max_line_search
+        self._c1 = c1
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the memory, e.g. when the function being minimized changes
+        """
+        self._x, self._values = None, None
+        self._s, self._y, self._rho = [], [], []
+        self._gamma = None
+
+    def step(self, x):
+        """
+        Take one L-BFGS iteration for all voxels
+
+        If the position is not where the previous iteration finished, e.g. because the
+        variables were changed externally, the memory is cleared
+
+        :param x: Current positions [V, N]
+
+        :return: Sequence of the new positions [V, N] followed by the arrays returned by
+                 ``fun`` at the new positions
+        """
+        if self._x is None or self._x.shape != x.shape or not np.array_equal(self._x, x):
+            self.reset()
+            self._x, self._values = x, [np.array(value) for value in self._fun(x)]
+        f, g = self._values[:2]
+
+        # Voxels where the direction is not a descent direction use steepest descent
+        direction = self._direction(g)
+        slope = np.sum(g * direction, axis=1)
+        uphill = ~(slope < 0)
+        direction[uphill] = -g[uphill] * self._initial_scale(g[uphill])[:, np.newaxis]
+        slope = np.sum(g * direction, axis=1)
+
+        # Backtracking line search with a separate step length for each voxel. Voxels
+        # which do not find a sufficient decrease stay where they are
+        new_x, new_values = np.copy(x), [np.copy(value) for value in self._values]
+        pending = slope < 0
+        step_length = np.ones(len(x))
+        for _idx in range(self._max_line_search):
+            if not np.any(pending):
+                break
+            trial = np.where(pending[:, np.newaxis], x + step_length[:, np.newaxis] * direction, new_x)
+            values = self._fun(trial)
+            accept = pending & np.isfinite(values[0]) & (values[0] <= f + self._c1 * step_length * slope)
+            accept &= np.all(np.isfinite(values[1]), axis=1)
+            new_x[accept] = trial[accept]
+            for new_value, value in zip(new_values, values):
+                new_value[accept] = value[accept]
+            pending &= ~accept
+            step_length[pending] *= 0.5
+
+        self._update_memory(new_x - x, new_values[1] - g)
+        self._x, self._values = new_x, new_values
+        return [new_x] + new_values
+
+    def _initial_scale(self, g):
+        """
+        :return: Scale for the gradient [V] so that the first step has at most unit length
+        """
+        return 1 / np.maximum(1, np.linalg.norm(g, axis=1))
+
+    def _direction(self, g):
+        """
+        Two-loop recursion for the product of the inverse Hessian approximation and the gradient
+
+        :return: Search direction [V, N]
+        """
+        q = np.copy(g)
+        alphas = []
+        for s, y, rho in reversed(list(zip(self._s, self._y, self._rho))):
+            alpha = rho * np.sum(s * q, axis=1)
+            q -= alpha[:, np.newaxis] * y
+            alphas.insert(0, alpha)
+
+        # Voxels with no curvature information yet take a scaled steepest descent step
+        gamma = self._initial_scale(g) if self._gamma is None else np.where(np.isnan(self._gamma), self._initial_scale(g), self._gamma)
+        r = gamma[:, np.newaxis] * q
+        for s, y, rho, alpha in zip(self._s, self._y, self._rho, alphas):
+            beta = rho * np.sum(y * r, axis=1)
+            r += (alpha - beta)[:, np.newaxis] * s
+        return -r
+
+    def _update_memory(self, s, y):
+        """
+        Add a step to the memory. Voxels which did not move or where the curvature condition
+        does not hold have zero weight for this step
+        """
+        sy = np.sum(s * y, axis=1)
+        valid = sy > 1e-10 * np.linalg.norm(s, axis=1) * np.linalg.norm(y, axis=1)
+        valid &= sy > 0
+        rho = np.where(valid, 1 / np.where(valid, sy, 1), 0)
+        self._s.append(s)
+        self._y.append(y)
+        self._rho.append(rho)
+        if len(self._s) > self._memory:
+            self._s.pop(0)
+            self._y.pop(0)
+            self._rho.pop(0)
+
+        gamma = np.where(valid, sy / np.maximum(np.sum(y * y, axis=1), 1e-300), np.nan)
+        if self._gamma is None:
+            self._gamma = gamma
+        else:
+            self._gamma = np.where(valid, gamma, self._gamma)
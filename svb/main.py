@@ -16,7 +16,17 @@ import re
 import numpy as np
 import nibabel as nib
 
-from . import __version__, DataModel, SvbFit, get_model_class
+from . import __version__, DataModel, SvbFit, AvbFit, get_model_class
+from .chunk import train_chunked, split
+from .data import StackedDataModel
+from .parameter import voxels_independent
+from .parallel import train_parallel
+from .noise import NoiseParameter
+from .history import HISTORY_MODES
+from .memory import estimate_memory, fit_memory_budget
+from .autotune import autotune, cache_key
+from .precision import PRECISIONS
+from .sampling import SAMPLING_MODES
 from .utils import ValueList
 
 USAGE = "svb <options>"
@@ -40,9 +50,11 @@ class SvbArgumentParser(argparse.ArgumentParser):
 
         group = self.add_argument_group("Main Options")
         group.add_argument("--data",
-                         help="Timeseries input data")
+                         help="Timeseries input data. Several data sets may be given which are stacked and fitted together",
+                         nargs="+")
         group.add_argument("--mask",
-                         help="Optional voxel mask")
+                         help="Optional voxel mask, one for each data set",
+                         nargs="+")
         group.add_argument("--post-init", dest="post_init_fname",
                          help="Initialize posterior from data file saved using --output-post")
         group.add_argument("--model", dest="model_name",
@@ -58,6 +70,10 @@ class SvbArgumentParser(argparse.ArgumentParser):
                          help="Display help")
         
         group = self.add_argument_group("Inference options")
+        group.add_argument("--method",
+                         help="Inference method: svb for stochastic optimization or avb for Fabber-style analytic updates of a linearised model, "
+                              "one iteration per epoch. avb is not possible with spatial priors",
+                         choices=("svb", "avb"), default="svb")
         group.add_argument("--no-covar", 
                          dest="infer_covar",
                          help="Do not infer a full covariance matrix",
@@ -77,21 +93,101 @@ class SvbArgumentParser(argparse.ArgumentParser):
         group.add_argument("--learning-rate", "--lr",
                          help="Initial learning rate",
                          type=float, default=0.1)
+        group.add_argument("--optimizer",
+                         help="Optimizer: adam, natgrad for natural gradient steps on the posterior which usually need fewer epochs, "
+                              "or saa to minimize the cost for fixed posterior sample draws using L-BFGS, one iteration per epoch",
+                         choices=("adam", "natgrad", "saa"), default="adam")
+        group.add_argument("--saa-redraw",
+                         help="With --optimizer saa, redraw the posterior sample draws every N epochs",
+                         type=int)
+        group.add_argument("--saa-memory",
+                         help="With --optimizer saa, number of previous steps used by L-BFGS",
+                         type=int, default=10)
         group.add_argument("--batch-size", "--bs",
                          help="Batch size. If not specified data will not be processed in batches",
                          type=int)
         group.add_argument("--sample-size", "--ss",
                          help="Sample size for drawing samples from posterior",
                          type=int, default=20)
+        group.add_argument("--adaptive-ss",
+                         help="Share the total sample budget (sample size per voxel) between voxels according to the variance of their cost",
+                         action="store_true", default=False)
+        group.add_argument("--ss-min",
+                         help="Minimum number of samples for each voxel with --adaptive-ss",
+                         type=int, default=2)
+        group.add_argument("--ss-max",
+                         help="Maximum number of samples for each voxel with --adaptive-ss. Samples are drawn for all voxels up to the largest number of samples, so this also limits the cost of sampling",
+                         type=int)
         group.add_argument("--max-trials",
-                         help="Number of epochs without improvement in the cost before reducing the learning rate",
-                         type=int, default=50)
+                         help="Number of epochs without improvement in the cost before reducing the learning rate. Must be less than the number of epochs without improvement before the posterior is reverted (50). By default the learning rate is not quenched",
+                         type=int)
         group.add_argument("--lr-quench",
-                         help="Quench factor for learning rate when cost does not improve after <conv-trials> epochs",
+                         help="Quench factor for learning rate when cost does not improve after <max-trials> epochs",
                          type=float, default=0.99)
         group.add_argument("--lr-min",
                          help="Minimum learning rate",
                          type=float, default=0.00001)
+        group.add_argument("--voxel-chunk-size",
+                         help="Fit voxels in independent chunks of this size to limit memory use. Not possible with spatial priors",
+                         type=int)
+        group.add_argument("--memory-budget",
+                         help="Approximate memory budget in Mb. The voxel chunk size, batch size and sample size are reduced if necessary so the estimated peak memory use fits",
+                         type=float)
+        group.add_argument("--autotune",
+                         help="Choose the batch size, sample size and number of threads which reduce the cost fastest by timing short fits of a voxel subsample",
+                         action="store_true", default=False)
+        group.add_argument("--autotune-voxels",
+                         help="Number of voxels in the subsample used by --autotune",
+                         type=int)
+        group.add_argument("--autotune-epochs",
+                         help="Number of epochs in each configuration tried by --autotune",
+                         type=int)
+        group.add_argument("--autotune-cache",
+                         help="JSON file to save the configuration chosen by --autotune in, keyed by the model and data shape. A configuration already in the file is used without tuning")
+        group.add_argument("--voxel-conv-tol",
+                         help="Relative tolerance on the change in voxel cost and parameters for per-voxel convergence. Converged voxels are excluded from further training",
+                         type=float)
+        group.add_argument("--voxel-conv-trials",
+                         help="Number of consecutive epochs within the convergence tolerance for a voxel to be considered converged",
+                         type=int, default=5)
+        group.add_argument("--conv-tol",
+                         help="Stop training when the relative change in the mean cost and parameters over the convergence window is within this tolerance",
+                         type=float)
+        group.add_argument("--conv-window",
+                         help="Number of epochs over which the change in mean cost and parameters is measured for --conv-tol",
+                         type=int, default=10)
+        group.add_argument("--time-limit",
+                         help="Stop training after this number of seconds, keeping the best posterior found",
+                         type=float)
+        group.add_argument("--checkpoint-dir",
+                         help="Directory to save checkpoints of the training state to. Defaults to <output>/checkpoint if --resume is given")
+        group.add_argument("--checkpoint-step",
+                         help="Save a checkpoint every N epochs",
+                         type=int, default=10)
+        group.add_argument("--resume",
+                         help="Resume training from the latest checkpoint",
+                         action="store_true", default=False)
+        group.add_argument("--engine",
+                         help="Training engine: session runs each training step as a TensorFlow graph, xla compiles it with XLA",
+                         choices=("session", "xla"), default="session")
+        group.add_argument("--precision",
+                         help="Numeric precision. mixed keeps the data, samples and model predictions in float32 and the posterior, variances and costs in float64",
+                         choices=PRECISIONS, default="float32")
+        group.add_argument("--loop-epochs",
+                         help="Number of epochs to run in each session call using an in-graph training loop",
+                         type=int)
+        group.add_argument("--workers",
+                         help="Number of worker processes for fitting voxel shards in parallel. Not possible with spatial priors",
+                         type=int, default=1)
+        group.add_argument("--threads",
+                         help="Total number of threads shared between worker processes - defaults to number of CPUs",
+                         type=int)
+        group.add_argument("--sampling",
+                         help="How posterior samples are drawn: random, qmc (scrambled Sobol), antithetic pairs or crn (common random numbers fixed over training)",
+                         choices=SAMPLING_MODES, default="random")
+        group.add_argument("--seed",
+                         help="Random seed for reproducible sampling",
+                         type=int)
 
         group = self.add_argument_group("Output options")
         group.add_argument("--save-var",
@@ -118,6 +214,22 @@ class SvbArgumentParser(argparse.ArgumentParser):
         group.add_argument("--save-post", "--save-posterior",
                          help="Save full posterior distribution",
                          action="store_true", default=False)
+        group.add_argument("--history",
+                         help="Training history to record: full (voxelwise), mean or off",
+                         choices=HISTORY_MODES, default="full")
+        group.add_argument("--history-step",
+                         help="Record training history every N epochs",
+                         type=int, default=1)
+        group.add_argument("--history-dir",
+                         help="Directory to stream voxelwise training history to rather than keeping it in memory. "
+                              "Defaults to <output>/history if cost or parameter history is being saved")
+        group.add_argument("--profile", dest="profile_steps",
+                         help="Comma separated list of training steps (batches) to trace, starting at 0. A timeline of each step "
+                              "and a summary of the time spent in each operation are written to <output>/profile",
+                         type=ValueList(int))
+        group.add_argument("--disable-diagnostics",
+                         help="Comma separated list of training diagnostics not to calculate: initial, params, var, lr, ss",
+                         type=ValueList(str))
 
     def parse_args(self, argv=None, namespace=None):
         # Parse built-in fixed options but skip unrecognized options as they may be
@@ -197,6 +309,10 @@ def main():
             raise ValueError("Input data not specified")
         if not options.model_name:
             raise ValueError("Model name not specified")
+        if len(options.data) == 1:
+            options.data = options.data[0]
+            if options.mask:
+                options.mask = options.mask[0]
 
         # Fixed for CL tool
         options.save_mean = True
@@ -217,13 +333,28 @@ def run(data, model_name, output, mask=None, **kwargs):
     """
     Run model fitting on a data set
 
-    :param data: File name of 4D NIFTI data set containing data to be fitted
+    :param data: File name of 4D NIFTI data set containing data to be fitted. May also be a
+                 sequence of data sets which are stacked and fitted together in a single graph.
+                 In this case the output of each data set is written to a subdirectory
+                 ``subjectNNN`` of the output directory
     :param model_name: Name of model we are fitting to
     :param output: output directory, will be created if it does not exist
-    :param mask: Optional file name of 3D Nifti data set containing data voxel mask
+    :param mask: Optional file name of 3D Nifti data set containing data voxel mask, or a
+                 sequence of masks for stacked data sets
 
     All keyword arguments are passed to constructor of the model, the ``SvbFit``
-    object and the ``SvbFit.train`` method.
+    object and the ``SvbFit.train`` method. If ``method`` is ``avb`` an ``AvbFit`` object
+    is used instead, see ``svb.avb``.
+
+    If ``voxel_chunk_size`` is given, voxels are fitted in independent chunks of this
+    size. In this case the returned ``SvbFit`` object is the one used to fit the chunks
+    and only contains the final chunk. If ``workers`` is greater than 1, shards of voxels
+    are fitted in parallel worker processes and the returned ``SvbFit`` object is None.
+
+    If ``autotune`` is True, the batch size, sample size and number of threads are chosen
+    by timing short fits of a voxel subsample, see ``svb.autotune``. If ``memory_budget``
+    is given, the voxel chunk size, batch size and sample size are
+    reduced if necessary so the estimated peak memory use fits, see ``svb.memory``.
     """
     # Create output directory
     _makedirs(output, exist_ok=True)
@@ -234,31 +365,141 @@ def run(data, model_name, output, mask=None, **kwargs):
 
     # Initialize the data model which contains data dimensions, number of time
     # points, list of unmasked voxels, etc
-    data_model = DataModel(data, mask, **kwargs)
+    if isinstance(data, (list, tuple)):
+        data_model = StackedDataModel(data, mask, **kwargs)
+    else:
+        data_model = DataModel(data, mask, **kwargs)
     
     # Create the generative model
-    fwd_model = get_model_class(model_name)(data_model, **kwargs)
+    model_class = get_model_class(model_name)
+    fwd_model = model_class(data_model, **kwargs)
     fwd_model.log_config()
 
-    # Get the time points from the model
-    tpts = fwd_model.tpts()
-    if tpts.ndim > 1 and tpts.shape[0] > 1:
-        tpts = tpts[data_model.mask_flattened > 0]
+    # Get the time points from the model. Stacked data sets may each have their own time points
+    if isinstance(data_model, StackedDataModel):
+        tpts = data_model.stack_tpts([_model_tpts(model_class(subject, **kwargs), subject)
+                                      for subject in data_model.subjects])
+    else:
+        tpts = _model_tpts(fwd_model, data_model)
+
+    if kwargs.get("save_param_history", False) and "params" in (kwargs.get("disable_diagnostics", None) or ()):
+        log.warning("Parameter history is only recorded for the final epoch when the params diagnostic is disabled")
+    if kwargs.get("save_cost_history", False) or kwargs.get("save_param_history", False):
+        if kwargs.get("history", "full") != "full":
+            log.warning("Voxelwise history is only recorded for the final epoch with history mode: %s", kwargs["history"])
+        if not kwargs.get("history_dir", None):
+            # Stream the voxelwise history to disk rather than holding it in memory
+            kwargs["history_dir"] = os.path.join(output, "history")
 
     # Train model
-    svb = SvbFit(data_model, fwd_model, **kwargs)
-    runtime, training_history = _runtime(svb.train, tpts, data_model.data_flattened, **kwargs)
+    method = kwargs.get("method", None) or "svb"
+    if method == "avb" and not voxels_independent(fwd_model.params):
+        log.warning("Linearised VB does not support spatial priors or global posteriors - using svb")
+        method = "svb"
+    if method == "avb" and (kwargs.get("voxel_chunk_size", None) or (kwargs.get("workers", None) or 1) > 1 or kwargs.get("resume", False)):
+        log.warning("Linearised VB does not support voxel chunks, multiple workers or checkpoints - fitting all voxels together")
+        kwargs = dict(kwargs, voxel_chunk_size=None, workers=1, checkpoint_dir=None, resume=False)
+
+    if method == "avb" and kwargs.get("autotune", False):
+        log.warning("Tuning is not used with linearised VB")
+    elif kwargs.get("autotune", False):
+        key = cache_key(model_name, data_model.n_unmasked_voxels, data_model.n_tpts)
+        kwargs.update(autotune(data_model, model_class, tpts, cache=kwargs.get("autotune_cache", None), key=key, **kwargs))
+
+    if method == "avb" and kwargs.get("memory_budget", None):
+        log.warning("Memory budget is not used with linearised VB")
+    elif method == "svb":
+        # Estimate the peak memory use before the graph is built and choose options to fit the budget
+        n_voxels, n_tpts = data_model.n_unmasked_voxels, data_model.n_tpts
+        if kwargs.get("memory_budget", None):
+            changes, estimate = fit_memory_budget(kwargs["memory_budget"], n_voxels, n_tpts, fwd_model.params, **kwargs)
+            if changes:
+                log.info("Options chosen for memory budget of %.0f Mb: %s", kwargs["memory_budget"],
+                         ", ".join(["%s=%s" % (name, value) for name, value in sorted(changes.items())]))
+                kwargs.update(changes)
+        else:
+            estimate = estimate_memory(n_voxels, n_tpts, fwd_model.params, **kwargs)
+        log.info("Estimated peak memory use: %.0f Mb (samples and predictions %.0f Mb)", estimate["total"],
+                 estimate["samples"] + estimate["predictions"])
+
+    voxel_chunk_size = kwargs.get("voxel_chunk_size", None)
+    workers = kwargs.get("workers", None) or 1
+    if (voxel_chunk_size or workers > 1) and not voxels_independent(fwd_model.params):
+        log.warning("Voxels cannot be fitted independently with spatial priors or global posteriors - fitting all voxels together")
+        voxel_chunk_size, workers = None, 1
+
+    if kwargs.get("profile_steps", None):
+        if workers > 1:
+            log.warning("Profiling is not supported with multiple workers")
+            kwargs["profile_steps"] = None
+        elif not kwargs.get("profile_dir", None):
+            kwargs["profile_dir"] = os.path.join(output, "profile")
+
+    if kwargs.get("resume", False) and not kwargs.get("checkpoint_dir", None):
+        kwargs["checkpoint_dir"] = os.path.join(output, "checkpoint")
+    if (voxel_chunk_size or workers > 1) and kwargs.get("checkpoint_dir", None):
+        log.warning("Checkpoints are not supported when fitting voxel chunks or with multiple workers")
+        kwargs["checkpoint_dir"], kwargs["resume"] = None, False
+
+    if method == "avb":
+        svb = AvbFit(data_model, fwd_model, **kwargs)
+        runtime, training_history = _runtime(svb.train, tpts, data_model.data_flattened, **kwargs)
+        results = svb.results()
+    elif workers > 1:
+        svb = None
+        runtime, (training_history, results) = _runtime(train_parallel, data_model, model_class, tpts, workers, **kwargs)
+    elif voxel_chunk_size:
+        runtime, (svb, training_history, results) = _runtime(train_chunked, data_model, model_class, tpts, voxel_chunk_size, **kwargs)
+    else:
+        svb = SvbFit(data_model, fwd_model, **kwargs)
+        runtime, training_history = _runtime(svb.train, tpts, data_model.data_flattened, **kwargs)
+        results = svb.results()
     log.info("DONE: %.3fs", runtime)
+    if training_history["stop_reason"] != "epochs":
+        log.info("Training stopped early: %s", training_history["stop_reason"])
 
     _makedirs(output, exist_ok=True)
+    params = list(fwd_model.params)
     if kwargs.get("save_noise", False):
-        params = svb.params
+        params.append(NoiseParameter())
+
+    if isinstance(data_model, StackedDataModel):
+        # Outputs of each stacked data set are written to a separate subdirectory
+        subject_outputs = split(training_history, results, data_model.n_subject_voxels)
+        for idx, (subject, (subject_history, subject_results)) in enumerate(zip(data_model.subjects, subject_outputs)):
+            subject_dir = os.path.join(output, "subject%03i" % idx)
+            _makedirs(subject_dir, exist_ok=True)
+            _write_output(subject_dir, subject, params, runtime, subject_history, subject_results, **kwargs)
     else:
-        params = fwd_model.params
+        _write_output(output, data_model, params, runtime, training_history, results, **kwargs)
+
+    log.info("Output written to: %s", output)
+    return runtime, svb, training_history
+
+def _model_tpts(fwd_model, data_model):
+    """
+    :return: Time points of the model for the unmasked voxels, shape [T] or [V, T]
+    """
+    tpts = fwd_model.tpts()
+    if tpts.ndim > 1 and tpts.shape[0] > 1:
+        tpts = tpts[data_model.mask_flattened > 0]
+    return tpts
 
+def _write_output(output, data_model, params, runtime, training_history, results, **kwargs):
+    """
+    Write the output images and files of a fit
+
+    :param output: Output directory
+    :param data_model: DataModel instance for the data that was fitted
+    :param params: Sequence of parameters to write output for
+    :param runtime: Total runtime
+    :param training_history: Training history dictionary
+    :param results: Results dictionary
+    """
+    log = logging.getLogger(__name__)
     # Write out parameter mean and variance images
-    means = svb.evaluate(svb.model_means)
-    variances = svb.evaluate(svb.model_vars)
+    means = results["mean"]
+    variances = results["var"]
     for idx, param in enumerate(params):
         if kwargs.get("save_mean", False):
             data_model.nifti_image(means[idx]).to_filename(os.path.join(output, "mean_%s.nii.gz" % param.name))
@@ -282,12 +523,11 @@ def run(data, model_name, output, mask=None, **kwargs):
 
     # Write out modelfit
     if kwargs.get("save_model_fit", False):
-        modelfit = svb.evaluate(svb.modelfit)
-        data_model.nifti_image(modelfit).to_filename(os.path.join(output, "modelfit.nii.gz"))
+        data_model.nifti_image(results["modelfit"]).to_filename(os.path.join(output, "modelfit.nii.gz"))
 
     # Write out posterior
     if kwargs.get("save_post", False):
-        post_data = data_model.posterior_data(svb.evaluate(svb.post.mean), svb.evaluate(svb.post.cov))
+        post_data = data_model.posterior_data(results["post_mean"], results["post_cov"])
         log.info("Posterior data shape: %s", post_data.shape)
         data_model.nifti_image(post_data).to_filename(os.path.join(output, "posterior.nii.gz"))
 
@@ -305,8 +545,6 @@ def run(data, model_name, output, mask=None, **kwargs):
     if kwargs.get("save_input_data", False):
         data_model.nifti_image(data_model.data_flattened).to_filename(os.path.join(output, "input_data.nii.gz"))
 
-    log.info("Output written to: %s", output)
-    return runtime, svb, training_history
 
 def setup_logging(outdir=".", **kwargs):
     """
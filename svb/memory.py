@@ -0,0 +1,224 @@
+"""
+SVB - Estimation of memory use before training
+
+The peak memory of a fit is dominated by tensors of shape [V, S, B] - the model
+predictions for each voxel, posterior sample and time point in a batch, and the
+intermediate values and gradients derived from them. Since the sample size may
+grow during training through ``ss_increase_factor``, this peak may only be reached
+late in training. The estimate here is made from the problem dimensions and the
+training options before the graph is built, so it can be used to choose options
+which fit a memory budget rather than running out of memory part way through.
+
+The estimate is approximate. The number of tensors of each shape which are live at
+the peak was calibrated on the exponential models with ``svb_benchmark``, and models
+with more intermediate values will use more memory.
+"""
+import logging
+
+from .parameter import voxels_independent
+
+# Number of live tensors of shape [V, S, B] at the peak, i.e. the model prediction,
+# tiled data, residuals and their gradients, in the compute precision. This is about
+# 4 for the single exponential model and 6 for the biexponential model
+VSB_TENSORS = 5
+
+# Number of live tensors of shape [V, P, S] - the posterior samples, standard normal
+# draws, transformed model parameters and their gradients
+SAMPLE_TENSORS = 4
+
+# Copies of each posterior variable - the variable, two Adam moments and the saved
+# best state
+POSTERIOR_COPIES = 4
+
+# Live tensors of shape [V, S] for each parameter with an MRF spatial prior, and
+# entries in sparse tensors of shape [V, V, S] for each parameter with an MRF2 prior
+MRF_TENSORS = 4
+MRF2_TENSORS = 4
+
+# Upper limit on the number of nearest neighbours of a voxel (3D volume)
+NEIGHBOURS = 6
+
+# Bytes in each entry of a sparse tensor of rank 3 - three int64 indices and the value
+SPARSE_INDEX_BYTES = 24
+
+# With adaptive sample size and no maximum number of samples per voxel, the number of
+# samples of the voxel with the most samples relative to the mean sample size
+ADAPTIVE_SS_SPREAD = 4
+
+# Memory used by the Python interpreter, TensorFlow runtime and session in Mb,
+# independent of the size of the problem
+RUNTIME_MB = 512
+
+# Smallest values chosen when fitting a memory budget
+MIN_CHUNK_SIZE = 1000
+MIN_BATCH_SIZE = 10
+MIN_SAMPLE_SIZE = 2
+
+_BYTES = {
+    # Precision : (bytes of float type, bytes of compute type)
+    "float32" : (4, 4),
+    "float64" : (8, 8),
+    "mixed" : (8, 4),
+}
+
+MB = 1024.0 * 1024.0
+
+def peak_sample_size(**kwargs):
+    """
+    :return: Largest number of samples drawn for a voxel during training, given the
+             initial sample size, its increase over the epochs and the adaptive sample
+             size options
+    """
+    sample_size = kwargs.get("sample_size", None) or kwargs["batch_size"]
+    ss_increase_factor = kwargs.get("ss_increase_factor", None) or 1.0
+    sample_size = max(sample_size, int(round(sample_size * ss_increase_factor)))
+    if kwargs.get("adaptive_ss", False):
+        sample_size = kwargs.get("ss_max", None) or sample_size * ADAPTIVE_SS_SPREAD
+    return sample_size
+
+def estimate_memory(n_voxels, n_tpts, params, **kwargs):
+    """
+    Estimate the peak memory use of training
+
+    :param n_voxels: Number of voxels being fitted
+    :param n_tpts: Number of time points in the data
+    :param params: Sequence of model Parameter instances. The noise parameter is added to these
+
+    Keyword arguments are the options of ``SvbFit`` and ``SvbFit.train`` which affect the
+    memory use: ``batch_size``, ``sample_size``, ``ss_increase_factor``, ``adaptive_ss``,
+    ``ss_max``, ``infer_covar``, ``precision`` and ``voxel_chunk_size``
+
+    :return: Dictionary of memory use in Mb of the ``data``, ``posterior``, ``samples``,
+             ``predictions``, spatial ``priors`` and ``runtime``, and the ``total``
+    """
+    batch_size = min(kwargs.get("batch_size", None) or n_tpts, n_tpts)
+    sample_size = peak_sample_size(**dict(kwargs, batch_size=batch_size))
+    n_params = len(params) + 1
+    float_bytes, compute_bytes = _BYTES[kwargs.get("precision", None) or "float32"]
+
+    # The full data is held for all voxels. Other tensors are for the voxels being
+    # fitted at once
+    chunk_size = min(kwargs.get("voxel_chunk_size", None) or n_voxels, n_voxels)
+    post_size = n_params * (n_params + 1) if kwargs.get("infer_covar", False) else n_params * 2
+    vsb_bytes = VSB_TENSORS * compute_bytes
+
+    prior_bytes = 0
+    for param in params:
+        if param.prior_type == "M":
+            prior_bytes += MRF_TENSORS * chunk_size * sample_size * float_bytes
+        elif param.prior_type == "M2":
+            prior_bytes += MRF2_TENSORS * NEIGHBOURS * chunk_size * sample_size * (SPARSE_INDEX_BYTES + float_bytes)
+
+    estimate = {
+        "data" : 2 * n_voxels * n_tpts * compute_bytes / MB,
+        "posterior" : POSTERIOR_COPIES * chunk_size * post_size * float_bytes / MB,
+        "samples" : SAMPLE_TENSORS * chunk_size * n_params * sample_size * compute_bytes / MB,
+        "predictions" : chunk_size * sample_size * batch_size * vsb_bytes / MB,
+        "priors" : prior_bytes / MB,
+        "runtime" : RUNTIME_MB,
+    }
+    estimate["total"] = sum(estimate.values())
+    return estimate
+
+def fit_memory_budget(budget, n_voxels, n_tpts, params, **kwargs):
+    """
+    Choose training options so the estimated peak memory is within a budget
+
+    Options are reduced in turn until the estimate fits:
+
+     1. The voxel chunk size, if the voxels can be fitted independently. This does
+        not change the result of the fit, but chunks smaller than ``MIN_CHUNK_SIZE``
+        are not used as the fixed cost of each chunk then dominates
+     2. The batch size, down to ``MIN_BATCH_SIZE``
+     3. The peak sample size, down to ``MIN_SAMPLE_SIZE``. The initial sample size
+        and ``ss_increase_factor`` are reduced so the sample size schedule does not
+        exceed this cap, and with adaptive sample size ``ss_max`` is set to it
+
+    Each option is set to the largest value which fits, or its smallest value if none
+    does. If the estimate does not fit with the smallest values a warning is logged.
+
+    :param budget: Memory budget in Mb
+    :param n_voxels: Number of voxels being fitted
+    :param n_tpts: Number of time points in the data
+    :param params: Sequence of model Parameter instances
+
+    Keyword arguments are the training options, see ``estimate_memory``
+
+    :return: Tuple of dictionary of the options which were changed, memory estimate
+             with the chosen options
+    """
+    log = logging.getLogger(__name__)
+    options = dict(kwargs)
+    options["batch_size"] = min(options.get("batch_size", None) or n_tpts, n_tpts)
+    options["sample_size"] = options.get("sample_size", None) or options["batch_size"]
+
+    # Options which can be reduced: (function returning the option values for a setting,
+    # smallest setting, current setting)
+    knobs = []
+    chunk_size = min(options.get("voxel_chunk_size", None) or n_voxels, n_voxels)
+    if voxels_independent(params) and (options.get("workers", None) or 1) <= 1:
+        knobs.append((lambda value: {"voxel_chunk_size" : value}, min(MIN_CHUNK_SIZE, chunk_size), chunk_size))
+    knobs.append((lambda value: {"batch_size" : value}, min(MIN_BATCH_SIZE, options["batch_size"]), options["batch_size"]))
+    peak_ss = peak_sample_size(**options)
+    knobs.append((lambda value: _cap_sample_size(options, value), min(MIN_SAMPLE_SIZE, peak_ss), peak_ss))
+
+    def _fits(values):
+        return estimate_memory(n_voxels, n_tpts, params, **dict(options, **values))["total"] <= budget
+
+    changes = {}
+    fits = _fits({})
+    for knob_options, smallest, largest in knobs:
+        if fits:
+            break
+        fits, value = _largest_value(lambda value, knob_options=knob_options: _fits(knob_options(value)), smallest, largest)
+        values = knob_options(value)
+        options.update(values)
+        changes.update(values)
+
+    estimate = estimate_memory(n_voxels, n_tpts, params, **options)
+    if not fits:
+        log.warning("Estimated memory use %.0f Mb exceeds the budget of %.0f Mb with the smallest voxel chunk size, "
+                    "batch size and sample size", estimate["total"], budget)
+    return changes, estimate
+
+def _largest_value(fits, smallest, largest):
+    """
+    Find the largest value of an option which fits a budget by bisection
+
+    :param fits: Function of the option value which returns True if it fits the budget.
+                 Larger values are assumed to use more memory
+    :param smallest: Smallest value of the option
+    :param largest: Largest value of the option
+
+    :return: Tuple of True if the budget was met, largest value which fits or the
+             smallest value if none does
+    """
+    if fits(largest):
+        return True, largest
+    if not fits(smallest):
+        return False, smallest
+    while largest - smallest > 1:
+        middle = (smallest + largest) // 2
+        if fits(middle):
+            smallest = middle
+        else:
+            largest = middle
+    return True, smallest
+
+def _cap_sample_size(options, cap):
+    """
+    :return: Dictionary of the sample size options which limit the peak sample size to ``cap``
+    """
+    values = {}
+    sample_size = options["sample_size"]
+    if options.get("adaptive_ss", False):
+        values["ss_max"] = cap
+        if sample_size > cap:
+            values["sample_size"] = cap
+    elif sample_size >= cap:
+        values["sample_size"] = cap
+        if (options.get("ss_increase_factor", None) or 1.0) > 1:
+            values["ss_increase_factor"] = 1.0
+    elif peak_sample_size(**options) > cap:
+        values["ss_increase_factor"] = float(cap) / sample_size
+    return values
@@ -49,7 +49,13 @@ class Model(LogBase):
 
     :attr params: Sequence of ``Parameter`` objects
     :attr nparams: Number of model parameters
+    :attr linear: True if the model output is a linear function of its parameters,
+                  i.e. ``evaluate`` returns ``X . params`` for a design matrix ``X``
+                  which depends only on the time points. The expected log-likelihood
+                  of linear models with Gaussian parameters can be calculated analytically
     """
+    linear = False
+
     OPTIONS = [
         ModelOption("dt", "Time separation between volumes", type=float, default=1.0),
         ModelOption("t0", "Time offset for first volume", type=float, default=0.0),
@@ -113,6 +119,26 @@ class Model(LogBase):
         """
         raise NotImplementedError("evaluate")
 
+    def design_matrix(self, tpts):
+        """
+        Get the design matrix of a linear model
+
+        The default implementation evaluates the model for each unit parameter vector,
+        so linear models need only set ``linear = True``
+
+        :param tpts: Time values tensor of shape [V x B] or [1 x B]
+
+        :return: [V x B x P] or [1 x B x P] tensor ``X`` such that the model output is
+                 ``X . params``
+        """
+        if not self.linear:
+            raise NotImplementedError("Model is not linear")
+        basis = tf.eye(self.nparams, dtype=tpts.dtype)
+        params = [tf.reshape(basis[idx], [1, self.nparams, 1]) for idx in range(self.nparams)]
+        # [V x P x B] evaluating the model for each basis vector
+        output = self.evaluate(params, tf.expand_dims(tpts, 1))
+        return tf.transpose(output * tf.ones([1, self.nparams, 1], dtype=output.dtype), (0, 2, 1))
+
     def ievaluate(self, params, tpts):
         """
         Evaluate the model outside of a TensorFlow session
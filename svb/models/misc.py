@@ -14,6 +14,7 @@ class ConstantModel(Model):
     """
     Model which generates a constant signal
     """
+    linear = True
 
     def __init__(self, data_model, **options):
         Model.__init__(self, data_model, **options)
@@ -33,6 +34,7 @@ class PolyModel(Model):
     """
     Model which generates a signal from a polynomial
     """
+    linear = True
 
     def __init__(self, data_model, **options):
         Model.__init__(self, data_model, **options)
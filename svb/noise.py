@@ -7,6 +7,7 @@ except ImportError:
     import tensorflow as tf
    
 from .parameter import Parameter
+from .precision import float_dtype
 from . import dist
 
 class NoiseParameter(Parameter):
@@ -22,7 +23,7 @@ class NoiseParameter(Parameter):
                            **kwargs)
 
     def _init_noise(self, _param, _t, data):
-        data_mean, data_var = tf.nn.moments(tf.constant(data), axes=1)
+        data_mean, data_var = tf.nn.moments(tf.convert_to_tensor(data), axes=1)
         return tf.where(tf.equal(data_var, 0), tf.ones_like(data_var), data_var), None
 
     def log_likelihood(self, data, pred, noise_var, nt):
@@ -34,29 +35,53 @@ class NoiseParameter(Parameter):
         :param noise: Noise parameter samples tensor with shape [V, S]
         :return: Tensor of shape [V] containing mean log likelihood of the 
                  data at each voxel with respect to the noise parameters
+
+        The data and prediction may be in lower precision than the noise and the
+        result - the squared differences are summed over the batch in the precision
+        of the prediction and only the [V, S] sums are converted to the precision of
+        the result, so no higher precision copy of the [V, S, B] tensor is made
         """
+        dtype = float_dtype()
         nvoxels = tf.shape(data)[0]
         batch_size = tf.shape(data)[1]
         sample_size = tf.shape(pred)[1]
 
-        # Possible to get zeros when using surface projection
-        noise_var = tf.where(tf.equal(noise_var, 0), tf.ones_like(noise_var), noise_var)
-        log_noise_var = self.log_tf(tf.log(noise_var, name="log_noise_var"))
-
         data = self.log_tf(tf.tile(tf.reshape(data, [nvoxels, 1, batch_size]), [1, sample_size, 1], name="data"), force=False)
         pred = self.log_tf(pred, force=False)
 
         # Square_diff has shape [NV, S, B]
         square_diff = self.log_tf(tf.square(data - pred, name="square_diff"), force=False)
-        sum_square_diff = self.log_tf(tf.reduce_sum(square_diff, axis=-1), name="ssq", force=False)
+        sum_square_diff = self.log_tf(tf.cast(tf.reduce_sum(square_diff, axis=-1), dtype), name="ssq", force=False)
+        return self.ssq_log_likelihood(sum_square_diff, noise_var, nt, batch_size)
+
+    def ssq_log_likelihood(self, sum_square_diff, noise_var, nt, batch_size):
+        """
+        Calculate the log-likelihood of the data from the sum of squared differences
+        between the data and the model prediction
+
+        :param sum_square_diff: Tensor of shape [V, S] containing the sum of squared
+                                differences over the data batch for each sample, or its
+                                expected value given the noise sample
+        :param noise_var: Noise parameter samples tensor with shape [V, S]
+        :param nt: Number of time points in the full data
+        :param batch_size: Number of time points in the data batch
+        :return: Tensor of shape [V] containing mean log likelihood of the
+                 data at each voxel with respect to the noise parameters
+        """
+        dtype = float_dtype()
+
+        # Possible to get zeros when using surface projection
+        noise_var = tf.cast(noise_var, dtype)
+        noise_var = tf.where(tf.equal(noise_var, 0), tf.ones_like(noise_var), noise_var)
+        log_noise_var = self.log_tf(tf.log(noise_var, name="log_noise_var"))
 
         # Since we are processing only a batch of the data at a time, we need to scale the 
         # sum of squared differences term correctly. Note that 'nt' is already the full data
         # size
-        scale = self.log_tf(tf.divide(tf.to_float(nt), tf.to_float(batch_size), name="scale"))
+        scale = self.log_tf(tf.divide(tf.cast(nt, dtype), tf.cast(batch_size, dtype), name="scale"))
 
         # Log likelihood has shape [NV, S]
-        log_likelihood = 0.5 * (log_noise_var * tf.to_float(nt) +
+        log_likelihood = 0.5 * (log_noise_var * tf.cast(nt, dtype) +
                                 scale * sum_square_diff / noise_var)
         log_likelihood = self.log_tf(tf.identity(log_likelihood, name="log_likelihood"), force=False)
 
@@ -0,0 +1,161 @@
+"""
+SVB - Parallel fitting of voxel shards
+
+When voxels can be fitted independently, the unmasked voxels can be divided into
+contiguous shards which are each fitted by an ``SvbFit`` instance in a separate
+worker process. The outputs are merged back in mask order.
+
+Each worker has its own random seed, derived from the base seed and the shard index
+so that results are reproducible. The available threads are divided between the
+workers so that the shards do not oversubscribe the CPU cores.
+"""
+import os
+import shutil
+import logging
+import pickle
+import multiprocessing
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from .svb import SvbFit
+from .chunk import voxel_tpts, train_chunked, merge
+from .history import load_voxel_history
+
+def shards(n_voxels, n_shards):
+    """
+    Divide voxels into contiguous shards of approximately equal size
+
+    :param n_voxels: Number of unmasked voxels
+    :param n_shards: Number of shards
+    :return: Sequence of arrays of unmasked voxel indices, one for each non-empty shard
+    """
+    return [indices for indices in np.array_split(np.arange(n_voxels), n_shards) if len(indices) > 0]
+
+def thread_budget(workers, threads=None):
+    """
+    :param workers: Number of worker processes
+    :param threads: Total number of threads to use. Defaults to the number of CPUs
+
+    :return: Number of intra-op threads for each worker
+    """
+    if not threads:
+        threads = multiprocessing.cpu_count()
+    return max(1, threads // workers)
+
+def worker_options(kwargs):
+    """
+    Options are sent to worker processes so only picklable options can be used,
+    e.g. not the log stream
+
+    :param kwargs: Dictionary of options
+    :return: Dictionary of the options which can be sent to a worker process
+    """
+    log = logging.getLogger(__name__)
+    worker_kwargs = {}
+    for key, value in kwargs.items():
+        try:
+            pickle.dumps(value)
+            worker_kwargs[key] = value
+        except Exception:
+            log.debug("Not passing option to worker processes: %s", key)
+    return worker_kwargs
+
+def train_parallel(data_model, model_class, tpts, n_workers, **kwargs):
+    """
+    Fit the data in parallel shards of voxels using a pool of worker processes
+
+    :param data_model: DataModel instance for the full data
+    :param model_class: Model class being fitted
+    :param tpts: Time points, shape [T] or [V, T]
+    :param n_workers: Number of worker processes. The data is divided into this number of shards
+
+    Optional keyword arguments:
+
+    :param seed: Base random seed. Each shard uses the base seed plus the shard index
+    :param threads: Total number of threads to share between the workers
+
+    All keyword arguments are passed to the model, ``SvbFit`` and ``SvbFit.train``
+
+    :return: Tuple of training history, results. These are in the same format as
+             ``SvbFit.train`` and ``SvbFit.results`` and cover all the unmasked voxels
+    """
+    log = logging.getLogger(__name__)
+    voxel_shards = shards(data_model.n_unmasked_voxels, n_workers)
+    intra_op_threads = thread_budget(len(voxel_shards), kwargs.get("threads", None))
+    base_seed = kwargs.get("seed", None) or 0
+    log.info("Fitting %i voxels in %i parallel shards with %i threads each",
+             data_model.n_unmasked_voxels, len(voxel_shards), intra_op_threads)
+
+    worker_kwargs = worker_options(kwargs)
+    worker_kwargs.update({
+        "intra_op_threads" : intra_op_threads,
+        "inter_op_threads" : 1,
+        "log_level" : logging.getLevelName(logging.getLogger().getEffectiveLevel()),
+        "v1_graph_mode" : not tf.executing_eagerly(),
+    })
+
+    # Streamed voxelwise history is written to a separate directory for each shard
+    # and merged at the end
+    history_dir = worker_kwargs.pop("history_dir", None)
+    shard_dirs = []
+
+    shard_args = []
+    for shard_idx, indices in enumerate(voxel_shards):
+        shard_kwargs = dict(worker_kwargs)
+        shard_kwargs["seed"] = base_seed + shard_idx
+        if history_dir:
+            shard_dirs.append(os.path.join(history_dir, "shard%04i" % shard_idx))
+            shard_kwargs["history_dir"] = shard_dirs[-1]
+        shard_args.append((shard_idx, data_model.voxel_subset(indices), model_class,
+                           voxel_tpts(tpts, indices), shard_kwargs))
+
+    # TensorFlow is not safe to use after a fork so start fresh worker processes
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(len(voxel_shards))
+    try:
+        outputs = pool.map(_fit_shard, shard_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    histories = [history for history, _results in outputs]
+    results = [shard_results for _history, shard_results in outputs]
+    for history, shard_dir in zip(histories, shard_dirs):
+        history.update(load_voxel_history(shard_dir))
+    training_history, results = merge(histories, results, parallel=True, history_dir=history_dir)
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    return training_history, results
+
+def _fit_shard(args):
+    """
+    Fit a single shard of voxels in a worker process
+
+    :return: Tuple of training history, results
+    """
+    shard_idx, data_model, model_class, tpts, kwargs = args
+    logging.basicConfig(level=getattr(logging, kwargs["log_level"], logging.WARNING),
+                        format="%%(levelname)s : shard %i : %%(message)s" % shard_idx)
+    if kwargs["v1_graph_mode"] and hasattr(tf, "disable_v2_behavior"):
+        tf.disable_v2_behavior()
+    np.random.seed(kwargs["seed"])
+
+    log = logging.getLogger(__name__)
+    log.info("Fitting shard %i (%i voxels) in process %i", shard_idx, data_model.n_unmasked_voxels, os.getpid())
+    voxel_chunk_size = kwargs.get("voxel_chunk_size", None)
+    if voxel_chunk_size and voxel_chunk_size < data_model.n_unmasked_voxels:
+        _svb, history, results = train_chunked(data_model, model_class, tpts, voxel_chunk_size, **kwargs)
+    else:
+        fwd_model = model_class(data_model, **kwargs)
+        svb = SvbFit(data_model, fwd_model, **kwargs)
+        history = svb.train(tpts, data_model.data_flattened, **kwargs)
+        results = svb.results()
+
+    if kwargs.get("history_dir", None):
+        # Streamed history is read from disk by the parent process rather than being sent back
+        del history["voxel_cost"], history["voxel_params"]
+    return history, results
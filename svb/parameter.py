@@ -13,6 +13,7 @@ except ImportError:
     import tensorflow as tf
    
 from .utils import LogBase
+from .prior import PRIOR_TYPES_VERTEXWISE
 from . import dist
 
 def get_parameter(name, **kwargs):
@@ -32,6 +33,17 @@ def get_parameter(name, **kwargs):
 
     return Parameter(name, desc=desc, prior=prior_dist, prior_type=prior_type, post=post_dist, post_init=post_init, post_type=post_type)
 
+def voxels_independent(params):
+    """
+    :param params: Sequence of Parameter instances being inferred
+    :return: True if the parameters at each voxel can be inferred independently
+             of other voxels, i.e. there are no spatial priors or global posteriors
+    """
+    for param in params:
+        if param.prior_type not in PRIOR_TYPES_VERTEXWISE or param.post_type == "global":
+            return False
+    return True
+
 class Parameter(LogBase):
     """
     A standard model parameter
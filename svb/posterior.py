@@ -9,19 +9,23 @@ except ImportError:
 import numpy as np
 
 from .utils import LogBase
+from .precision import float_dtype
+from .sampling import SAMPLING_MODES, standard_normal
 from . import dist
 
-def get_posterior(idx, param, t, data_model, **kwargs):
+def get_posterior(idx, param, t, data, data_model, **kwargs):
     """
     Factory method to return a posterior
 
     :param param: svb.parameter.Parameter instance
-    :
+    :param t: Tensor containing time points
+    :param data: Tensor of shape [V, T] containing the full data, used for
+                 data-driven initialization of the posterior
     """
     nvertices = data_model.n_vertices
     initial_mean, initial_var = None, None
     if param.post_init is not None:
-        initial_mean, initial_var = param.post_init(param, t, data_model.data_flattened)
+        initial_mean, initial_var = param.post_init(param, t, data)
 
     if initial_mean is None:
         initial_mean = tf.fill([nvertices], param.post_dist.mean)
@@ -49,6 +53,18 @@ class Posterior(LogBase):
     def __init__(self, idx, **kwargs):
         LogBase.__init__(self, **kwargs)
         self._idx = idx
+        self._sampling = kwargs.get("sampling", None) or "random"
+        if self._sampling not in SAMPLING_MODES:
+            raise ValueError("Unknown sampling mode: %s (supported: %s)" % (self._sampling, ", ".join(SAMPLING_MODES)))
+        self._seed = kwargs.get("seed", None)
+
+    def _eps(self, nvertices, nparams, nsamples, dim):
+        """
+        :return: Standard normal draws [W, P, S] generated using the sampling mode, see
+                 ``svb.sampling.standard_normal``
+        """
+        return standard_normal(nvertices, nparams, nsamples, mode=self._sampling, dim=dim,
+                               seed=self._seed, dtype=float_dtype())
 
     def _get_mean_var(self, mean, var, init_post):
         if init_post is not None:
@@ -64,8 +80,8 @@ class Posterior(LogBase):
             mean = mean[:, self._idx]
             var = cov[:, self._idx, self._idx]
             self.log.info(" - Initializing posterior mean and variance from input posterior")
-            self.log.info("     means=%s", np.mean(mean))
-            self.log.info("     vars=%s", np.mean(var))
+            mean = self.log_tf(mean, name="init_mean")
+            var = self.log_tf(var, name="init_var")
         return mean, var
 
     def sample(self, nsamples):
@@ -108,9 +124,52 @@ class Posterior(LogBase):
         """
         raise NotImplementedError()
 
+    def natural_gradient_step(self, grads, learning_rate):
+        """
+        Natural gradient step for the variables of this posterior
+
+        For a Gaussian posterior a natural gradient step moves the precision towards the
+        expected Hessian of the cost, estimated from the gradient with respect to the
+        covariance, and preconditions the gradient with respect to the mean by the
+        updated covariance. A learning rate of 1 is then a Newton step
+
+        :param grads: Mapping from variable name to the vertexwise gradient of the cost
+                      with respect to the variable. Variables with no gradient are omitted
+        :param learning_rate: Learning rate, at most 1
+
+        :return Sequence of tuples of (new value, variable)
+        """
+        raise NotImplementedError()
+
     def log_det_cov(self):
         raise NotImplementedError()
 
+def _clip_precision_scale(scale, learning_rate):
+    """
+    Clip the factor by which a natural gradient step multiplies the precision
+
+    The new precision is ``(1 - lr) * precision + lr * H`` for the estimate ``H`` of the
+    expected Hessian of the cost. The estimate is clipped at zero so the precision
+    remains positive
+    """
+    return tf.maximum(scale, tf.maximum(1 - learning_rate, 1e-3))
+
+def _normal_natural_gradient_step(mean, log_var, grads, learning_rate):
+    """
+    Natural gradient step for a normal distribution parameterized by its mean and log variance
+
+    The gradient ``g`` with respect to the log variance multiplies the precision by ``1 + 2 lr g``
+    """
+    ret = []
+    var = tf.exp(log_var)
+    if log_var.name in grads:
+        scale = _clip_precision_scale(1 + 2 * learning_rate * grads[log_var.name], learning_rate)
+        ret.append((log_var - tf.log(scale), log_var))
+        var = var / scale
+    if mean.name in grads:
+        ret.append((mean - learning_rate * var * grads[mean.name], mean))
+    return ret
+
 class NormalPosterior(Posterior):
     """
     Posterior distribution for a single vertexwise parameter with a normal
@@ -127,8 +186,8 @@ class NormalPosterior(Posterior):
         self.name = kwargs.get("name", "NormPost")
         
         mean, var = self._get_mean_var(mean, var, kwargs.get("init", None))
-        mean = tf.cast(mean, tf.float32)
-        var = tf.cast(var, tf.float32)
+        mean = tf.cast(mean, float_dtype())
+        var = tf.cast(var, float_dtype())
         mean = self.log_tf(tf.where(tf.is_finite(mean), mean, tf.zeros_like(mean)))
         var = tf.where(tf.is_nan(var), tf.ones_like(var), var)
 
@@ -148,7 +207,7 @@ class NormalPosterior(Posterior):
         self.std = self.log_tf(tf.sqrt(self.var, name="%s_std" % self.name))
 
     def sample(self, nsamples):
-        eps = tf.random_normal((self.nvertices, 1, nsamples), 0, 1, dtype=tf.float32)
+        eps = self._eps(self.nvertices, 1, nsamples, self._idx)
         tiled_mean = tf.tile(tf.reshape(self.mean, [self.nvertices, 1, 1]), [1, 1, nsamples])
         sample = self.log_tf(tf.add(tiled_mean, tf.multiply(tf.reshape(self.std, [self.nvertices, 1, 1]), eps),
                                     name="%s_sample" % self.name))
@@ -167,6 +226,9 @@ class NormalPosterior(Posterior):
             tf.assign(self.log_var, state[1])
         ]
 
+    def natural_gradient_step(self, grads, learning_rate):
+        return _normal_natural_gradient_step(self.mean_variable, self.log_var, grads, learning_rate)
+
     def __str__(self):
         return "Vertexwise posterior"
 
@@ -188,12 +250,12 @@ class GaussianGlobalPosterior(Posterior):
         
         # Take the mean of the mean and variance across vertices as the initial value
         # in case there is a vertexwise initialization function
-        initial_mean_global = tf.reshape(tf.reduce_mean(mean), [1])
-        initial_var_global = tf.reshape(tf.reduce_mean(var), [1])
+        initial_mean_global = tf.cast(tf.reshape(tf.reduce_mean(mean), [1]), float_dtype())
+        initial_var_global = tf.cast(tf.reshape(tf.reduce_mean(var), [1]), float_dtype())
         self.mean_variable = tf.Variable(initial_mean_global, 
-                                         dtype=tf.float32, validate_shape=False,
+                                         dtype=float_dtype(), validate_shape=False,
                                          name="%s_mean" % self.name)
-        self.log_var = tf.Variable(tf.log(tf.cast(initial_var_global, dtype=tf.float32)), validate_shape=False,
+        self.log_var = tf.Variable(tf.log(initial_var_global), validate_shape=False,
                                    name="%s_log_var" % self.name)
         self.var_variable = self.log_tf(tf.exp(self.log_var, name="%s_var" % self.name))
         if kwargs.get("suppress_nan", True):
@@ -211,7 +273,7 @@ class GaussianGlobalPosterior(Posterior):
         """
         FIXME should each parameter vertex get the same sample? Currently YES
         """
-        eps = tf.random_normal((1, 1, nsamples), 0, 1, dtype=tf.float32)
+        eps = self._eps(1, 1, nsamples, self._idx)
         tiled_mean = tf.tile(tf.reshape(self.mean, [self.nvertices, 1, 1]), [1, 1, nsamples])
         sample = self.log_tf(tf.add(tiled_mean, tf.multiply(tf.reshape(self.std, [self.nvertices, 1, 1]), eps),
                                     name="%s_sample" % self.name))
@@ -230,6 +292,9 @@ class GaussianGlobalPosterior(Posterior):
             tf.assign(self.log_var, state[1])
         ]
 
+    def natural_gradient_step(self, grads, learning_rate):
+        return _normal_natural_gradient_step(self.mean_variable, self.log_var, grads, learning_rate)
+
     def __str__(self):
         return "Global posterior"
 
@@ -260,7 +325,7 @@ class FactorisedPosterior(Posterior):
         # Regularisation to make sure cov is invertible. Note that we do not
         # need this for a diagonal covariance matrix but it is useful for
         # the full MVN covariance which shares some of the calculations
-        self.cov_reg = 1e-5*tf.eye(self.nparams)
+        self.cov_reg = 1e-5*tf.eye(self.nparams, dtype=float_dtype())
 
     def sample(self, nsamples):
         samples = [post.sample(nsamples) for post in self.posts]
@@ -268,7 +333,7 @@ class FactorisedPosterior(Posterior):
         return self.log_tf(sample)
 
     def entropy(self, _samples=None):
-        entropy = tf.zeros([self.nvertices], dtype=tf.float32)
+        entropy = tf.zeros([self.nvertices], dtype=float_dtype())
         for post in self.posts:
             entropy = tf.add(entropy, post.entropy(), name="%s_entropy" % self.name)
         return self.log_tf(entropy)
@@ -285,6 +350,12 @@ class FactorisedPosterior(Posterior):
             ops += post.set_state(state[idx*2:idx*2+2])
         return ops
 
+    def natural_gradient_step(self, grads, learning_rate):
+        ret = []
+        for post in self.posts:
+            ret += post.natural_gradient_step(grads, learning_rate)
+        return ret
+
     def log_det_cov(self):
         """
         Determinant of diagonal matrix is product of diagonal entries
@@ -336,7 +407,7 @@ class MVNPosterior(FactorisedPosterior):
             _mean, cov = kwargs["init"]
             covar_init = tf.cholesky(cov)
         else:
-            covar_init = tf.zeros([self.nvertices, self.nparams, self.nparams], dtype=tf.float32)
+            covar_init = tf.zeros([self.nvertices, self.nparams, self.nparams], dtype=float_dtype())
 
         self.off_diag_vars_base = self.log_tf(tf.Variable(covar_init, validate_shape=False,
                                                      name='%s_off_diag_vars' % self.name))
@@ -345,7 +416,7 @@ class MVNPosterior(FactorisedPosterior):
         else:
             self.off_diag_vars = self.off_diag_vars_base
         self.off_diag_cov_chol = tf.matrix_set_diag(tf.matrix_band_part(self.off_diag_vars, -1, 0),
-                                                    tf.zeros([self.nvertices, self.nparams]),
+                                                    tf.zeros([self.nvertices, self.nparams], dtype=float_dtype()),
                                                     name='%s_off_diag_cov_chol' % self.name)
 
         # Combine diagonal and off-diagonal elements into full matrix
@@ -364,11 +435,11 @@ class MVNPosterior(FactorisedPosterior):
         Determinant of a matrix can be calculated from the Cholesky decomposition which may
         be faster and more stable than tf.matrix_determinant
         """
-        return self.log_tf(tf.multiply(2.0, tf.reduce_sum(tf.log(tf.matrix_diag_part(self.cov_chol)), axis=1), name="%s_det_cov" % self.name))
+        return self.log_tf(tf.multiply(tf.reduce_sum(tf.log(tf.matrix_diag_part(self.cov_chol)), axis=1), 2.0, name="%s_det_cov" % self.name))
 
     def sample(self, nsamples):
         # Use the 'reparameterization trick' to return the samples
-        eps = tf.random_normal((self.nvertices, self.nparams, nsamples), 0, 1, dtype=tf.float32, name="eps")
+        eps = self._eps(self.nvertices, self.nparams, nsamples, min([post._idx for post in self.posts]))
 
         # NB self.cov_chol is the Cholesky decomposition of the covariance matrix
         # so plays the role of the std.dev.
@@ -388,3 +459,42 @@ class MVNPosterior(FactorisedPosterior):
         ops = list(FactorisedPosterior.set_state(self, state[:-1]))
         ops += [tf.assign(self.off_diag_vars_base, state[-1], validate_shape=False)]
         return ops
+
+    def natural_gradient_step(self, grads, learning_rate):
+        """
+        With the Cholesky factor ``L`` of the covariance, the precision after the step is
+        ``L^-T (I + lr M) L^-1`` where ``M = 2 L^T G L`` for the gradient ``G`` with respect to
+        the covariance. ``M`` is found from the gradient with respect to the lower triangle
+        of ``L`` as in reverse mode differentiation of the Cholesky decomposition (Murray 2016,
+        arXiv:1602.07527). The eigenvalues of ``I + lr M`` are clipped so the precision remains
+        positive definite and the new Cholesky factor is the decomposition of the new covariance
+        """
+        dtype = float_dtype()
+        chol = self.cov_chol
+
+        # Gradient with respect to the lower triangle of the Cholesky factor. The diagonal
+        # is the standard deviation which is parameterized by the log variance
+        zeros = tf.zeros([self.nvertices], dtype=dtype)
+        log_var_grads = tf.stack([grads.get(post.log_var.name, zeros) for post in self.posts], axis=-1)
+        chol_grad = tf.matrix_set_diag(tf.matrix_band_part(grads.get(self.off_diag_vars_base.name, tf.zeros_like(chol)), -1, 0),
+                                       2 * log_var_grads / tf.matrix_diag_part(chol))
+        phi = tf.matrix_band_part(tf.matmul(chol, chol_grad, transpose_a=True), -1, 0)
+        phi = phi - 0.5 * tf.matrix_diag(tf.matrix_diag_part(phi))
+        scale = tf.eye(self.nparams, dtype=dtype) + learning_rate * (phi + tf.transpose(phi, (0, 2, 1)))
+
+        # New covariance ``L Q D^-1 Q^T L^T`` for the eigendecomposition ``Q D Q^T`` of the scale
+        evals, evecs = tf.self_adjoint_eig(scale)
+        evals = _clip_precision_scale(evals, learning_rate)
+        half = tf.matmul(chol, evecs) * tf.expand_dims(tf.rsqrt(evals), 1)
+        cov = tf.matmul(half, half, transpose_b=True)
+        new_chol = tf.cholesky(cov)
+
+        new_log_var = 2 * tf.log(tf.matrix_diag_part(new_chol))
+        ret = [(new_chol, self.off_diag_vars_base)]
+        ret += [(new_log_var[:, idx], post.log_var) for idx, post in enumerate(self.posts)]
+
+        mean_vars = [post.mean_variable for post in self.posts]
+        mean_grads = tf.stack([grads.get(var.name, zeros) for var in mean_vars], axis=-1)
+        mean = self.mean - learning_rate * tf.reduce_sum(cov * tf.expand_dims(mean_grads, 1), axis=-1)
+        ret += [(mean[:, idx], var) for idx, var in enumerate(mean_vars)]
+        return ret
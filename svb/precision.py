@@ -0,0 +1,61 @@
+"""
+SVB - Numeric precision policy
+
+The precision policy defines the floating point types used when building the graph:
+
+ - ``float32`` uses single precision throughout
+ - ``float64`` uses double precision throughout
+ - ``mixed`` keeps the large tensors which scale with the number of samples and
+   time points, e.g. the data, posterior samples and model predictions of shape
+   [V, S, B], in single precision. The squared residuals are summed over each batch
+   in single precision. The posterior and prior variables, variances and costs are
+   held and accumulated in double precision
+
+The policy is global and is set by ``SvbFit`` before it builds its graph, so priors,
+posteriors and noise models pick up the types from here rather than having them
+passed around.
+"""
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+PRECISIONS = ("float32", "float64", "mixed")
+
+# Precision name : (float type, compute type)
+_DTYPES = {
+    "float32" : (tf.float32, tf.float32),
+    "float64" : (tf.float64, tf.float64),
+    "mixed" : (tf.float64, tf.float32),
+}
+
+_precision = "float32"
+
+def set_precision(precision):
+    """
+    Set the precision policy used for graphs built from now on
+
+    :param precision: One of ``PRECISIONS``
+    """
+    global _precision
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision: %s (supported: %s)" % (precision, ", ".join(PRECISIONS)))
+    _precision = precision
+
+def get_precision():
+    """
+    :return: Name of the current precision policy
+    """
+    return _precision
+
+def float_dtype():
+    """
+    :return: TensorFlow type for variables, variances and costs
+    """
+    return _DTYPES[_precision][0]
+
+def compute_dtype():
+    """
+    :return: TensorFlow type for the data, samples and model predictions
+    """
+    return _DTYPES[_precision][1]
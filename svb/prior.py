@@ -9,10 +9,15 @@ except ImportError:
     import tensorflow as tf
 
 from .utils import LogBase
+from .precision import float_dtype
 from .dist import Normal
 
 PRIOR_TYPE_NONSPATIAL = "N"
 PRIOR_TYPE_SPATIAL_MRF = "M"
+PRIOR_TYPE_ARD = "A"
+
+# Prior types which do not couple parameter vertices to each other
+PRIOR_TYPES_VERTEXWISE = (PRIOR_TYPE_NONSPATIAL, PRIOR_TYPE_ARD)
 
 def get_prior(param, data_model, **kwargs):
     """
@@ -71,8 +76,8 @@ class NormalPrior(Prior):
         self.nvertices = nvertices
         self.scalar_mean = mean
         self.scalar_var = var
-        self.mean = tf.fill([nvertices], mean, name="%s_mean" % self.name)
-        self.var = tf.fill([nvertices], var, name="%s_var" % self.name)
+        self.mean = tf.fill([nvertices], tf.constant(mean, dtype=float_dtype()), name="%s_mean" % self.name)
+        self.var = tf.fill([nvertices], tf.constant(var, dtype=float_dtype()), name="%s_var" % self.name)
         self.std = tf.sqrt(self.var, name="%s_std" % self.name)
 
     def mean_log_pdf(self, samples):
@@ -164,7 +169,7 @@ class FabberMRFSpatialPrior(NormalPrior):
         term2 = self.log_tf(tf.reduce_sum(swk * self.wK), name="term2") # [1]
 
         gk = 1 / (0.5 * trace_term + 0.5 * term2 + 0.1)
-        hk = tf.multiply(tf.to_float(self.nvertices), 0.5) + 1.0
+        hk = tf.multiply(tf.cast(self.nvertices, float_dtype()), 0.5) + 1.0
         self.ak = self.log_tf(tf.identity(gk * hk, name="ak"))
 
     def _setup_mean_var(self, post, nn, n2):
@@ -193,8 +198,8 @@ class MRFSpatialPrior(Prior):
         Prior.__init__(self)
         self.name = kwargs.get("name", "MRFSpatialPrior")
         self.nvertices = nvertices
-        self.mean = tf.fill([nvertices], mean, name="%s_mean" % self.name)
-        self.var = tf.fill([nvertices], var, name="%s_var" % self.name)
+        self.mean = tf.fill([nvertices], tf.constant(mean, dtype=float_dtype()), name="%s_mean" % self.name)
+        self.var = tf.fill([nvertices], tf.constant(var, dtype=float_dtype()), name="%s_var" % self.name)
         self.std = tf.sqrt(self.var, name="%s_std" % self.name)
 
         # nn is a sparse tensor of shape [W, W]. If nn[A, B] = 1 then A is
@@ -203,7 +208,7 @@ class MRFSpatialPrior(Prior):
 
         # Set up spatial smoothing parameter calculation from posterior and neighbour lists
         # We infer the log of ak.
-        self.logak = tf.Variable(-5.0, name="log_ak", dtype=tf.float32)
+        self.logak = tf.Variable(-5.0, name="log_ak", dtype=float_dtype())
         self.ak = self.log_tf(tf.exp(self.logak, name="ak"))
 
     def mean_log_pdf(self, samples):
@@ -244,7 +249,7 @@ class ARDPrior(NormalPrior):
         self.fixed_var = self.var
         
         # Set up inferred precision parameter phi
-        self.logphi = tf.Variable(tf.log(1/self.fixed_var), name="log_phi", dtype=tf.float32)
+        self.logphi = tf.Variable(tf.log(1/self.fixed_var), name="log_phi", dtype=float_dtype())
         self.phi = self.log_tf(tf.exp(self.logphi, name="phi"))
         self.var = 1/self.phi
         self.std = tf.sqrt(self.var, name="%s_std" % self.name)
@@ -269,8 +274,8 @@ class MRF2SpatialPrior(Prior):
         Prior.__init__(self)
         self.name = kwargs.get("name", "MRF2SpatialPrior")
         self.nvertices = nvertices
-        self.mean = tf.fill([nvertices], mean, name="%s_mean" % self.name)
-        self.var = tf.fill([nvertices], var, name="%s_var" % self.name)
+        self.mean = tf.fill([nvertices], tf.constant(mean, dtype=float_dtype()), name="%s_mean" % self.name)
+        self.var = tf.fill([nvertices], tf.constant(var, dtype=float_dtype()), name="%s_var" % self.name)
         self.std = tf.sqrt(self.var, name="%s_std" % self.name)
 
         # nn is a sparse tensor of shape [W, W]. If nn[A, B] = 1 then A is
@@ -281,7 +286,7 @@ class MRF2SpatialPrior(Prior):
         self.sample_size = kwargs.get("sample_size", 5)
 
         # Set up spatial smoothing parameter calculation from posterior and neighbour lists
-        self.logak = tf.Variable(-5.0, name="log_ak", dtype=tf.float32)
+        self.logak = tf.Variable(-5.0, name="log_ak", dtype=float_dtype())
         self.ak = self.log_tf(tf.exp(self.logak, name="ak"))
 
     def mean_log_pdf(self, samples):
@@ -407,7 +412,7 @@ class FactorisedPrior(Prior):
     def mean_log_pdf(self, samples):
         nvertices = tf.shape(samples)[0]
 
-        mean_log_pdf = tf.zeros([nvertices], dtype=tf.float32)
+        mean_log_pdf = tf.zeros([nvertices], dtype=samples.dtype)
         for idx, prior in enumerate(self.priors):
             param_samples = tf.slice(samples, [0, idx, 0], [-1, 1, -1])
             param_logpdf = prior.mean_log_pdf(param_samples)
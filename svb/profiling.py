@@ -0,0 +1,118 @@
+"""
+SVB - Profiling of training steps
+
+Selected training steps are run with full tracing so the time spent in each TensorFlow
+operation is recorded. For each traced step a timeline is written in the Chrome trace
+format, which can be viewed in ``chrome://tracing`` or Perfetto. When training finishes
+a summary table of the time spent in each type of operation, and in the most costly
+individual operations, is written over all the traced steps.
+
+A training step is a session call which updates the posterior, i.e. one batch, one
+group of epochs run by the in-graph training loop, or one cost evaluation of the SAA
+line search.
+"""
+import os
+import collections
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from .utils import LogBase
+
+# Number of individual operations listed in the summary
+SUMMARY_TOP_OPS = 50
+
+class StepProfiler(LogBase):
+    """
+    Runs training steps, tracing the selected steps
+    """
+
+    def __init__(self, outdir, steps):
+        """
+        :param outdir: Directory to write the timelines and summary to
+        :param steps: Sequence of indices of the training steps to trace, starting at 0
+        """
+        LogBase.__init__(self)
+        self._outdir = outdir
+        self._steps = set(steps)
+        self._step = 0
+        self._traced = []
+        self._op_types = collections.defaultdict(lambda: [0, 0])
+        self._ops = collections.defaultdict(lambda: [0, 0])
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+    def run(self, sess, fetches, feed_dict):
+        """
+        Run a training step in a session
+
+        :param sess: TensorFlow session
+        :param fetches: Fetches for ``Session.run``
+        :param feed_dict: Feed dictionary for ``Session.run``
+        :return: Output of ``Session.run``
+        """
+        step = self._step
+        self._step += 1
+        if step not in self._steps:
+            return sess.run(fetches, feed_dict=feed_dict)
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        outputs = sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        self._record(step, run_metadata.step_stats)
+        return outputs
+
+    def _record(self, step, step_stats):
+        """
+        Write the timeline of a traced step and add its operation times to the summary
+        """
+        trace = timeline.Timeline(step_stats).generate_chrome_trace_format()
+        with open(os.path.join(self._outdir, "timeline_step%06i.json" % step), "w") as trace_file:
+            trace_file.write(trace)
+
+        for dev_stats in step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                # The label has the form ``name = OpType(inputs)`` where OpType is the kernel that was run
+                op_type = node_stats.timeline_label.split(" = ", 1)[-1].split("(", 1)[0]
+                micros = node_stats.all_end_rel_micros
+                for key, totals in ((op_type, self._op_types), ((node_stats.node_name, op_type), self._ops)):
+                    totals[key][0] += 1
+                    totals[key][1] += micros
+        self._traced.append(step)
+
+    def close(self):
+        """
+        Write the summary of the traced steps
+
+        :return: Sequence of (operation type, number of calls, total time in microseconds)
+                 in decreasing order of total time
+        """
+        op_types = sorted([(op_type, calls, micros) for op_type, (calls, micros) in self._op_types.items()],
+                          key=lambda item: -item[2])
+        if not self._traced:
+            self.log.warning("No training steps were traced: %s", sorted(self._steps))
+            return op_types
+
+        ops = sorted([(name, op_type, calls, micros) for (name, op_type), (calls, micros) in self._ops.items()],
+                     key=lambda item: -item[3])
+        total = max(1, sum([micros for _op_type, _calls, micros in op_types]))
+        n_steps = len(self._traced)
+        with open(os.path.join(self._outdir, "op_summary.txt"), "w") as summary_file:
+            summary_file.write("Traced steps: %s\n\n" % " ".join([str(step) for step in self._traced]))
+            summary_file.write("%-40s %8s %14s %14s %8s\n" % ("Op type", "Calls", "Time/step (ms)", "Time/call (us)", "Percent"))
+            for op_type, calls, micros in op_types:
+                summary_file.write("%-40s %8i %14.3f %14.1f %8.2f\n" % (
+                    op_type, calls // n_steps, micros / 1000.0 / n_steps, float(micros) / calls, 100.0 * micros / total))
+
+            summary_file.write("\n%-60s %-24s %14s %8s\n" % ("Op", "Type", "Time/step (ms)", "Percent"))
+            for name, op_type, _calls, micros in ops[:SUMMARY_TOP_OPS]:
+                summary_file.write("%-60s %-24s %14.3f %8.2f\n" % (
+                    name, op_type, micros / 1000.0 / n_steps, 100.0 * micros / total))
+
+        self.log.info("Profile of %i training steps written to %s", n_steps, self._outdir)
+        for op_type, _calls, micros in op_types[:5]:
+            self.log.info(" - %s: %.3f ms/step (%.1f%%)", op_type, micros / 1000.0 / n_steps, 100.0 * micros / total)
+        return op_types
@@ -0,0 +1,131 @@
+"""
+SVB - Sampling modes for the posterior
+
+Posterior samples are formed from standard normal draws ``eps`` using the
+reparameterization trick. The way the draws are generated can be chosen to
+reduce the variance of the cost and gradient estimates:
+
+ - ``random`` draws independent pseudo-random normals at every step
+ - ``qmc`` uses scrambled quasi-Monte Carlo normals. The Sobol sequence is shared
+   between voxels and randomized at every step with an independent uniform shift
+   for each voxel and parameter, so the estimates remain unbiased
+ - ``antithetic`` draws half the samples and uses their negations for the other half.
+   Each draw is followed by its negation, so the first ``2n`` samples are ``n`` pairs
+ - ``crn`` uses common random numbers - the same draws at every step, so the cost
+   is a deterministic function of the posterior. The draws are the same with the
+   session and XLA engines
+
+Each parameter uses its own dimension of the Sobol sequence and its own seed for
+common random numbers, so factorised posteriors sampled one parameter at a time
+get the same draws as a full covariance posterior sampling all the parameters at once.
+
+The number of samples may also be chosen separately for each voxel within a total
+budget, see ``allocate_samples``.
+"""
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+SAMPLING_MODES = ("random", "qmc", "antithetic", "crn")
+
+def standard_normal(nvertices, nparams, nsamples, mode="random", dim=0, seed=None, dtype=tf.float32):
+    """
+    Standard normal draws for sampling from a posterior
+
+    :param nvertices: Number of parameter vertices W, may be a tensor
+    :param nparams: Number of parameters P
+    :param nsamples: Number of samples S, may be a tensor
+    :param mode: One of ``SAMPLING_MODES``
+    :param dim: Index of the first parameter, used to select the dimensions of the
+                Sobol sequence and the common random numbers
+    :param seed: Seed for common random numbers, may be a tensor so the draws can be changed
+    :param dtype: Floating point type of the draws
+
+    :return: Tensor of shape [W, P, S]
+    """
+    if mode == "random":
+        return tf.random_normal((nvertices, nparams, nsamples), 0, 1, dtype=dtype)
+    elif mode == "antithetic":
+        half = tf.random_normal((nvertices, nparams, (nsamples + 1) // 2), 0, 1, dtype=dtype)
+        return tf.reshape(tf.stack([half, -half], axis=-1), [nvertices, nparams, -1])[:, :, :nsamples]
+    elif mode == "qmc":
+        # Sobol points [S, dim + P] with the first point at the origin skipped
+        points = tf.math.sobol_sample(dim + nparams, nsamples, skip=1, dtype=tf.float64)[:, dim:]
+        points = tf.reshape(tf.transpose(points), [1, nparams, nsamples])
+        shift = tf.random_uniform((nvertices, nparams, 1), dtype=tf.float64)
+        uniform = tf.clip_by_value(tf.mod(points + shift, 1.0), 1e-10, 1 - 1e-10)
+        return tf.cast(tf.math.ndtri(uniform), dtype)
+    elif mode == "crn":
+        # The normals are transformed from the raw Philox bits, which are the same in XLA-compiled
+        # code. The normal and uniform generators are implemented differently by XLA so would give
+        # different draws with the XLA engine
+        seed = tf.cast(0 if seed is None else seed, tf.int64)
+        bits = [tf.random.stateless_uniform((nvertices, 1, nsamples), seed=tf.stack([seed, dim + idx]),
+                                            minval=None, maxval=None, dtype=tf.uint32, alg="philox")
+                for idx in range(nparams)]
+        uniform = (tf.cast(tf.concat(bits, axis=1), tf.float64) + 0.5) / 2**32
+        return tf.cast(tf.math.ndtri(uniform), dtype)
+    else:
+        raise ValueError("Unknown sampling mode: %s (supported: %s)" % (mode, ", ".join(SAMPLING_MODES)))
+
+def allocate_samples(std, budget, min_samples=2, max_samples=None, pairs=False):
+    """
+    Allocate a budget of samples between voxels
+
+    The variance of the total Monte Carlo cost estimate, ``sum(var / n)``, is minimized
+    for a fixed total number of samples by giving each voxel a number of samples
+    proportional to the standard deviation of its per-sample cost (Neyman allocation).
+    Well-determined voxels therefore get few samples and uncertain voxels get more.
+
+    :param std: Numpy array [V] containing the standard deviation of the per-sample cost
+                of each voxel
+    :param budget: Total number of samples
+    :param min_samples: Minimum number of samples for each voxel. At least two are needed
+                        to estimate the variance
+    :param max_samples: Optional maximum number of samples for each voxel
+    :param pairs: If True, allocate whole pairs of samples so antithetic pairs are not split.
+                  The budget and maximum are rounded down and the minimum up to even numbers
+
+    :return: Numpy integer array [V] containing the number of samples for each voxel.
+             The total is equal to the budget unless this is not possible within the
+             minimum and maximum
+    """
+    if pairs:
+        max_pairs = None if max_samples is None else max(1, max_samples // 2)
+        return 2 * allocate_samples(std, budget // 2, max(1, (min_samples + 1) // 2), max_pairs)
+
+    n_voxels = len(std)
+    if max_samples is None:
+        max_samples = budget
+    budget = int(np.clip(budget, min_samples * n_voxels, max_samples * n_voxels))
+    std = np.where(np.isfinite(std) & (std > 0), std, 0)
+    if not np.any(std > 0):
+        std = np.ones(n_voxels)
+
+    # Share the budget in proportion to the standard deviation, fixing voxels which
+    # reach the minimum or maximum and sharing the rest between the remaining voxels.
+    # Voxels below the minimum are fixed first, as fixing them can only reduce the
+    # samples of the others, so the fixed voxels never take more than the budget
+    samples = np.zeros(n_voxels)
+    free = np.ones(n_voxels, dtype=bool)
+    while np.any(free):
+        remaining = budget - np.sum(samples[~free])
+        weights = std[free] if np.any(std[free] > 0) else np.ones(np.count_nonzero(free))
+        samples[free] = remaining * weights / np.sum(weights)
+        clipped = free & (samples < min_samples)
+        if not np.any(clipped):
+            clipped = free & (samples > max_samples)
+        if not np.any(clipped):
+            break
+        samples[clipped] = np.clip(samples[clipped], min_samples, max_samples)
+        free &= ~clipped
+
+    # Round down and give the samples left over to the largest remainders
+    counts = np.clip(np.floor(samples), min_samples, max_samples).astype(np.int32)
+    remainder = np.where(counts < max_samples, samples - counts, -1)
+    extra = max(0, budget - int(np.sum(counts)))
+    counts[np.argsort(-remainder, kind="stable")[:extra]] += 1
+    return counts
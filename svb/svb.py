@@ -37,20 +37,28 @@ V and W are currently identical but may not be in the future. For example
 we may want to estimate parameters on a surface (W=number of surface 
 vertices) using data defined on a volume (V=number of voxels).
 
-Ideas for per voxel/vertex convergence:
-
-    - Maintain vertex_mask as member. Initially all ones
-    - Mask vertices when generating samples and evaluating model. The
-      latent cost will be over unmasked vertices only.
-    - PROBLEM: need reconstruction cost defined over full voxel set
-      hence need to project model evaluation onto all voxels. So
-      masked vertices still need to keep their previous model evaluation
-      output
-    - Define criteria for masking vertices after each epoch
-    - PROBLEM: spatial interactions make per-voxel convergence difficult.
-      Maybe only do full set convergence in this case (like Fabber)
+Per voxel convergence:
+
+    - An active voxel set is maintained as a graph variable. Initially all
+      voxels are active
+    - Only active voxels are passed to the model evaluation and likelihood
+      calculation, so the cost of these scales with the number of active
+      voxels. Posterior samples are still drawn for all voxels, the latent
+      loss is still calculated for all voxels and the optimizer still updates
+      the variables of all voxels, so frozen voxels are not free
+    - The reconstruction and latent cost of converged (frozen) voxels is held
+      at its value when they were frozen. This is a constant so frozen voxels
+      have no gradient, and their optimizer momentum is cleared so that their
+      parameters do not change
+    - A voxel is frozen when the relative change in its cost and parameters
+      has been within a tolerance for a number of consecutive epochs
+    - Spatial interactions make per-voxel convergence difficult so in this
+      case we only detect convergence of the full voxel set (like Fabber)
 """
+import os
 import time
+import collections
+import contextlib
 import six
 
 import numpy as np
@@ -59,11 +67,33 @@ try:
 except ImportError:
     import tensorflow as tf
 
+from .checkpoint import Checkpoint
+from .data import StackedDataModel
+from .dist import Identity
+from .history import TrainingHistory
+from .lbfgs import BatchedLbfgs
 from .noise import NoiseParameter
-from .prior import NormalPrior, FactorisedPrior, get_prior
+from .parameter import voxels_independent
+from .precision import set_precision, float_dtype, compute_dtype
+from .profiling import StepProfiler
+from .sampling import allocate_samples
+from .prior import NormalPrior, FactorisedPrior, get_prior, PRIOR_TYPES_VERTEXWISE
 from .posterior import NormalPosterior, FactorisedPosterior, MVNPosterior, get_posterior
 from .utils import LogBase
 
+# Diagnostics which can be reported during training. ``initial`` is the cost and parameters
+# before training, the others are evaluated at the end of each epoch
+DIAGNOSTICS = ("initial", "params", "var", "lr", "ss")
+
+# Training engines. ``session`` runs the training step as a TensorFlow graph, ``xla``
+# compiles it with XLA
+ENGINES = ("session", "xla")
+
+# Optimizers. ``adam`` uses Adam for all variables, ``natgrad`` takes natural gradient
+# steps for the posterior variables and ``saa`` minimizes the sample average approximation
+# of the cost for fixed random draws with L-BFGS
+OPTIMIZERS = ("adam", "natgrad", "saa")
+
 class SvbFit(LogBase):
     """
     Stochastic Bayesian model fitting
@@ -89,25 +119,160 @@ class SvbFit(LogBase):
         self.params.append(self.noise)
         self._nparams = len(self.params)
         self._infer_covar = kwargs.get("infer_covar", False)
+
+        # Stacked data sets are only independent if no quantity is shared between voxels
+        if isinstance(data_model, StackedDataModel) and not voxels_independent(self.params):
+            shared = [param.name for param in self.params
+                      if param.prior_type not in PRIOR_TYPES_VERTEXWISE or param.post_type == "global"]
+            self.log.warning("Stacked data sets share prior hyperparameters or global posteriors of %s - "
+                             "the data sets are not fitted independently", ", ".join(shared))
         self.mean_1, self.covar_1 = None, None
 
-        # Set up the tensorflow graph which will be trained to do the inference
+        # Data the graph is currently targeted at, see reset()
+        self._data, self._tpts, self._post_init = None, None, None
+
+        # Profiler for training steps while training with profiling, see train()
+        self._profiler = None
+
+        # Diagnostics to report during training. Disabled diagnostics are never evaluated
+        disabled = kwargs.get("disable_diagnostics", None) or ()
+        for name in disabled:
+            if name not in DIAGNOSTICS:
+                raise ValueError("Unknown diagnostic: %s (supported: %s)" % (name, ", ".join(DIAGNOSTICS)))
+        self.diagnostics = [name for name in DIAGNOSTICS if name not in disabled]
+
+        # For linear models with Gaussian parameters the expected log-likelihood can be
+        # calculated analytically rather than by sampling the model prediction
+        self.analytic_reconstr_loss = (fwd_model.linear and
+                                       np.all([type(param.post_dist.transform) is Identity for param in fwd_model.params]) and
+                                       not kwargs.get("force_num_reconstr_loss", False))
+        if self.analytic_reconstr_loss:
+            self.log.info("Using analytical expression for reconstruction loss since model is linear")
+
+        # Adaptive per-voxel sample size within a total sample budget. This is not needed
+        # if the reconstruction loss is calculated analytically
+        self._adaptive_ss = kwargs.get("adaptive_ss", False) and not self.analytic_reconstr_loss
+        self._sampling = kwargs.get("sampling", None) or "random"
+
+        # Training engine
+        self._engine = kwargs.get("engine", None) or "session"
+        if self._engine not in ENGINES:
+            raise ValueError("Unknown engine: %s (supported: %s)" % (self._engine, ", ".join(ENGINES)))
+        if self._engine == "xla" and not voxels_independent(self.params):
+            # Spatial priors use sparse operations which XLA cannot compile
+            self.log.warning("XLA engine does not support spatial priors or global posteriors - using session engine")
+            self._engine = "session"
+        if self._engine == "xla" and self._adaptive_ss:
+            # Per-voxel sample sizes give tensor shapes which are only known at runtime
+            self.log.warning("XLA engine does not support adaptive per-voxel sample size - using session engine")
+            self._engine = "session"
+        if self._engine == "xla" and kwargs.get("voxel_conv_tol", None) is not None:
+            # The gather and scatter of the active voxels are not compiled correctly by XLA
+            self.log.warning("XLA engine does not support per-voxel convergence - using session engine")
+            self._engine = "session"
+        if self._engine == "xla" and kwargs.get("sampling", None) == "qmc":
+            # The Sobol sequence generator cannot be compiled by XLA
+            self.log.warning("XLA engine does not support quasi-Monte Carlo sampling - using session engine")
+            self._engine = "session"
+
+        # Optimizer
+        self._optimizer = kwargs.get("optimizer", None) or "adam"
+        if self._optimizer not in OPTIMIZERS:
+            raise ValueError("Unknown optimizer: %s (supported: %s)" % (self._optimizer, ", ".join(OPTIMIZERS)))
+        if self._optimizer == "saa" and not voxels_independent(self.params):
+            # L-BFGS is batched over voxels so each voxel must have its own cost
+            self.log.warning("SAA optimizer does not support spatial priors or global posteriors - using adam")
+            self._optimizer = "adam"
+        if self._optimizer == "saa":
+            # The cost and its gradient are evaluated in the session for each line search step
+            if self._engine == "xla":
+                self.log.warning("SAA optimizer does not support XLA engine - using session engine")
+                self._engine = "session"
+            if self._adaptive_ss:
+                self.log.warning("SAA optimizer does not support adaptive per-voxel sample size - disabling")
+                self._adaptive_ss = False
+            if kwargs.get("loop_epochs", None):
+                self.log.warning("SAA optimizer does not support in-graph training loop - disabling")
+
+        # Numeric precision policy used when building the graph
+        self._precision = kwargs.get("precision", None) or "float32"
+        if self._optimizer == "saa" and self._precision == "float32":
+            # The line search compares costs which differ by less than float32 resolution
+            self.log.warning("SAA optimizer requires costs in double precision - using mixed precision")
+            self._precision = "mixed"
+        set_precision(self._precision)
+
+        # Per-voxel convergence is only possible if voxels are independent - otherwise
+        # only global convergence can be detected
+        self._voxel_conv = (kwargs.get("voxel_conv_tol", None) is not None and
+                            voxels_independent(self.params))
+
+        # Set up the tensorflow graph which will be trained to do the inference. The XLA
+        # engine captures the variables in a compiled function which requires resource variables
         self._graph = tf.Graph()
-        with self._graph.as_default():
+        use_resource = True if self._engine == "xla" else None
+        with self._graph.as_default(), tf.variable_scope(tf.get_variable_scope(), use_resource=use_resource):
+            # Optional graph-level random seed for reproducible sampling
+            if kwargs.get("seed", None) is not None:
+                tf.set_random_seed(kwargs["seed"])
+
             # Create placeholder tensors to store the input data
             self._create_input_tensors()
 
-            # Create voxelwise prior and posterior distribution tensors
+            # With the SAA optimizer posterior samples are generated from common random numbers
+            # with a seed held in the graph, so the draws are fixed until they are redrawn
+            if self._optimizer == "saa":
+                self._saa_seed = tf.Variable(kwargs.get("seed", None) or 0, dtype=tf.int64, trainable=False, name="saa_seed")
+                kwargs = dict(kwargs, sampling="crn", seed=self._saa_seed)
+
+            # Create voxelwise prior and posterior distribution tensors. We keep track
+            # of the variables created so they can be reused by the in-graph training loop
+            n_vars = len(tf.global_variables())
             self._create_prior_post(**kwargs)
+            self._prior_post_vars = tf.global_variables()[n_vars:]
+
+            # Set of active voxels for per-voxel convergence
+            self._create_active_set()
+
+            # Number of samples for each voxel
+            self._create_voxel_sample_size()
 
             # Define loss function based variational upper-bound and corresponding optimizer
             self._create_loss_optimizer()
 
+            # Operation to clear the optimizer momentum of frozen voxels
+            self._create_freeze_op()
+
+            # Operations to get, set and snapshot the posterior state
+            self._create_state_ops()
+
+            # Cost gradients and assignment of the variables for the SAA optimizer
+            if self._optimizer == "saa":
+                self._create_saa_ops()
+
+            # Optional training step compiled with XLA
+            self._compiled_step = None
+            if self._engine == "xla":
+                self._create_compiled_step(**kwargs)
+
+            # Optional training loop which runs multiple epochs in a single session call
+            self._train_loop = None
+            if kwargs.get("loop_epochs", None) and self._optimizer != "saa":
+                self._create_train_loop(**kwargs)
+
+            # Saver for checkpoints of all the graph variables
+            self._saver = tf.train.Saver(max_to_keep=2)
+
             # Variable initializer
             self.init = tf.global_variables_initializer()
 
-            # Tensorflow session for runnning graph
-            self.sess = tf.Session()
+            # Tensorflow session for runnning graph. Thread pool sizes of zero
+            # let TensorFlow choose the number of threads
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads=kwargs.get("intra_op_threads", None) or 0,
+                inter_op_parallelism_threads=kwargs.get("inter_op_threads", None) or 0,
+            )
+            self.sess = tf.Session(config=config)
     
     def _create_input_tensors(self):
         """
@@ -125,15 +290,15 @@ class SvbFit(LogBase):
         self.feed_dict = {}
 
         # Training data - may be mini-batch of full data
-        self.data_train = tf.placeholder(tf.float32, [None, None], name="data_train")
+        self.data_train = tf.placeholder(compute_dtype(), [None, None], name="data_train")
 
         # Time points in training data (not necessarily the full data - may be mini-batch)
-        self.tpts_train = tf.placeholder(tf.float32, [None, None])
+        self.tpts_train = tf.placeholder(compute_dtype(), [None, None])
 
         # Full data - we need this during training to correctly scale contributions
         # to the cost
         #self.data_full = tf.placeholder(tf.float32, [None, None], name="data_full")
-        self.data_full = tf.constant(self.data_model.data_flattened, dtype=tf.float32, name="data_full")
+        self.data_full = tf.constant(self.data_model.data_flattened, dtype=compute_dtype(), name="data_full")
 
         # Number of time points in full data - known at runtime
         #self.nt_full = tf.shape(self.data_full)[1]
@@ -149,31 +314,24 @@ class SvbFit(LogBase):
 
         # Optional learning rate decay - to disable simply set decay rate to 1.0
         self.lr_decay_rate = tf.placeholder(tf.float32, shape=[])
-        self.learning_rate = tf.train.exponential_decay(
-            self.initial_lr,
-            self.global_step,
-            self.num_steps,
-            self.lr_decay_rate,
-            staircase=False,
-        )
+
+        # Learning rate quenching when the cost stops improving. The quenched rate is
+        # a variable so it persists between training steps, and is clamped at the minimum
+        self.lr_scale = tf.Variable(1.0, trainable=False, name="lr_scale")
+        self.lr_quench = tf.placeholder_with_default(1.0, shape=[])
+        self.lr_min = tf.placeholder_with_default(0.0, shape=[])
+        self._quench_lr = tf.assign(self.lr_scale, self.lr_scale * self.lr_quench)
+        self.learning_rate = self._get_learning_rate()
 
         # Amount of weight given to latent loss in cost function (0-1)
-        self.latent_weight = tf.placeholder(tf.float32, shape=[])
+        self.latent_weight = tf.placeholder(float_dtype(), shape=[])
 
         # Initial number of samples per parameter for the sampling of the posterior distribution
         self.initial_ss = tf.placeholder(tf.int32, shape=[])
 
         # Optional increase in the sample size - to disable set factor to 1.0
         self.ss_increase_factor = tf.placeholder(tf.float32, shape=[])
-        self.sample_size = tf.cast(tf.round(tf.train.exponential_decay(
-            tf.to_float(self.initial_ss),
-            self.global_step,
-            self.num_steps,
-            self.ss_increase_factor,
-            staircase=False,
-            #tf.to_float(self.initial_ss) * self.ss_increase_factor,
-            #power=1.0,
-        )), tf.int32)
+        self.sample_size = self._get_sample_size()
 
         # Number of voxels in full data (V) - known at runtime
         #self.nvoxels = tf.shape(self.data_full)[0]
@@ -185,16 +343,55 @@ class SvbFit(LogBase):
 
         # Represent neighbour lists as sparse tensors
         self.nn = tf.SparseTensor(
-            indices=self.data_model.indices_nn,
-            values=np.ones((len(self.data_model.indices_nn),), dtype=np.float32),
+            indices=np.reshape(np.array(self.data_model.indices_nn, dtype=np.int64), (-1, 2)),
+            values=np.ones((len(self.data_model.indices_nn),), dtype=float_dtype().as_numpy_dtype),
             dense_shape=[self.data_model.n_unmasked_voxels, self.data_model.n_unmasked_voxels]
         )
         self.n2 = tf.SparseTensor(
-            indices=self.data_model.indices_n2,
-            values=np.ones((len(self.data_model.indices_n2),), dtype=np.float32),
+            indices=np.reshape(np.array(self.data_model.indices_n2, dtype=np.int64), (-1, 2)),
+            values=np.ones((len(self.data_model.indices_n2),), dtype=float_dtype().as_numpy_dtype),
             dense_shape=[self.data_model.n_unmasked_voxels, self.data_model.n_unmasked_voxels]
         )
 
+        # Optional initial posterior mean [W, P] and covariance [W, P, P]. These default
+        # to the values provided by the data model but may be fed with different values
+        # so the same graph can be initialized for different data
+        self.post_init = None
+        if self.data_model.post_init is not None:
+            init_mean, init_cov = self.data_model.post_init
+            self.post_init = (
+                tf.placeholder_with_default(np.asarray(init_mean, dtype=float_dtype().as_numpy_dtype),
+                                            np.shape(init_mean), name="post_init_mean"),
+                tf.placeholder_with_default(np.asarray(init_cov, dtype=float_dtype().as_numpy_dtype),
+                                            np.shape(init_cov), name="post_init_cov"),
+            )
+
+    def _get_learning_rate(self):
+        """
+        :return: Tensor containing the learning rate at the current global step
+        """
+        return tf.maximum(tf.train.exponential_decay(
+            self.initial_lr,
+            self.global_step,
+            self.num_steps,
+            self.lr_decay_rate,
+            staircase=False,
+        ) * self.lr_scale, self.lr_min)
+
+    def _get_sample_size(self):
+        """
+        :return: Tensor containing the sample size at the current global step
+        """
+        return tf.cast(tf.round(tf.train.exponential_decay(
+            tf.to_float(self.initial_ss),
+            self.global_step,
+            self.num_steps,
+            self.ss_increase_factor,
+            staircase=False,
+            #tf.to_float(self.initial_ss) * self.ss_increase_factor,
+            #power=1.0,
+        )), tf.int32)
+
     def _create_prior_post(self, **kwargs):
         """
         Create voxelwise prior and posterior distribution tensors
@@ -202,8 +399,9 @@ class SvbFit(LogBase):
         self.log.info("Setting up prior and posterior")
         # Create posterior distribution - note this can be initialized using the actual data
         gaussian_posts, nongaussian_posts, all_posts = [], [], []
+        data_full = tf.cast(self.data_full, float_dtype())
         for idx, param in enumerate(self.params):    
-            post = get_posterior(idx, param, self.tpts_train, self.data_model, init=self.data_model.post_init, **kwargs)
+            post = get_posterior(idx, param, self.tpts_train, data_full, self.data_model, init=self.post_init, **kwargs)
             if isinstance(post, NormalPosterior):
                 gaussian_posts.append(post)
                 # FIXME Noise parameter hack
@@ -221,7 +419,7 @@ class SvbFit(LogBase):
                 self.log.info(" - Adding %i non-Gaussian parameters" % len(nongaussian_posts))
                 self.post = FactorisedPosterior([MVNPosterior(gaussian_posts, **kwargs)] + nongaussian_posts, name="post", **kwargs)
             else:
-                self.post = MVNPosterior(gaussian_posts, name="post", init=self.data_model.post_init, **kwargs)
+                self.post = MVNPosterior(gaussian_posts, name="post", init=self.post_init, **kwargs)
 
             # Depending on whether the noise is gaussian or not it may appear in 
             # a different position in the parameter lists
@@ -256,7 +454,83 @@ class SvbFit(LogBase):
             self.log.info("   - Prior: %s %s", param.prior_dist, all_priors[idx])
             self.log.info("   - Posterior: %s %s", param.post_dist, all_posts[idx])
 
-    def _get_model_prediction(self, samples):
+    def _create_active_set(self):
+        """
+        Create variables defining the set of active voxels for per-voxel convergence
+
+        Frozen voxels keep the reconstruction and latent cost they had when they
+        were frozen
+        """
+        self.active_voxels = tf.Variable(tf.ones([self.nvoxels]), trainable=False, name="active_voxels")
+        self.frozen_reconstr = tf.Variable(tf.zeros([self.nvoxels], dtype=float_dtype()), trainable=False, name="frozen_reconstr")
+        self.frozen_latent = tf.Variable(tf.zeros([self.nvoxels], dtype=float_dtype()), trainable=False, name="frozen_latent")
+        self.active_idx = tf.reshape(tf.where(self.active_voxels > 0), [-1])
+
+        # Operation to set the active voxels and the costs of frozen voxels
+        self._active_voxels_in = tf.placeholder(tf.float32, [self.nvoxels])
+        self._frozen_reconstr_in = tf.placeholder(float_dtype(), [self.nvoxels])
+        self._frozen_latent_in = tf.placeholder(float_dtype(), [self.nvoxels])
+        self._set_active = tf.group(
+            tf.assign(self.active_voxels, self._active_voxels_in),
+            tf.assign(self.frozen_reconstr, self._frozen_reconstr_in),
+            tf.assign(self.frozen_latent, self._frozen_latent_in),
+        )
+
+    def _create_voxel_sample_size(self):
+        """
+        Create a variable containing the number of samples used for each voxel
+        with adaptive sample size
+
+        The variable is set by ``SvbFit.train`` from estimates of the variance of
+        the reconstruction cost of each voxel. The posterior is sampled for the largest
+        number of samples and each voxel uses the first ``voxel_ss`` of them
+        """
+        self.voxel_ss = tf.Variable(tf.zeros([self.nvoxels], dtype=tf.int32), trainable=False, name="voxel_ss")
+        self._voxel_ss_in = tf.placeholder(tf.int32, [self.nvoxels])
+        self._set_voxel_ss = tf.assign(self.voxel_ss, self._voxel_ss_in)
+
+    def _create_freeze_op(self):
+        """
+        Create an operation to clear the Adam first moment of frozen voxels
+
+        Frozen voxels have zero gradient, so once the first moment is cleared the
+        optimizer will not update them. All trainable variables are vertexwise when
+        per-voxel convergence is enabled
+        """
+        ops = []
+        if self._voxel_conv:
+            for var in tf.trainable_variables():
+                moment = self.optimizer.get_slot(var, "m")
+                if moment is not None:
+                    mask_shape = tf.concat([[self.nvertices], tf.ones([tf.rank(moment)-1], dtype=tf.int32)], axis=0)
+                    ops.append(tf.assign(moment, moment * tf.cast(tf.reshape(self.active_voxels, mask_shape), moment.dtype),
+                                         validate_shape=False))
+        self._freeze = tf.group(*ops)
+
+    def _create_state_ops(self):
+        """
+        Create operations to set the posterior state and to save and restore the best state
+
+        The best state is kept in shadow variables in the graph so saving and reverting
+        it are in-graph copies rather than transfers to and from NumPy. The shadow variables
+        start empty and take the shape of the posterior state when it is first saved
+        """
+        state = self.post.state()
+        self._state_input = [tf.placeholder(value.dtype, name="state_input%i" % idx)
+                             for idx, value in enumerate(state)]
+        self._set_state = tf.group(*self.post.set_state(self._state_input))
+
+        self._best_state = [
+            tf.Variable(tf.zeros([0], dtype=value.dtype), trainable=False, validate_shape=False,
+                        shape=tf.TensorShape(None), name="best_state%i" % idx)
+            for idx, value in enumerate(state)
+        ]
+        self._save_best_state = tf.group(*[
+            tf.assign(best, value, validate_shape=False) for best, value in zip(self._best_state, state)
+        ])
+        self._restore_best_state = tf.group(*self.post.set_state(self._best_state))
+
+    def _get_model_prediction(self, samples, tpts=None):
         """
         Get a model prediction for the data batch being processed for each
         sample from the posterior
@@ -266,15 +540,17 @@ class SvbFit(LogBase):
         :param samples: Tensor [W x P x S] containing samples from the posterior.
                         S is the number of samples (not always the same
                         as the batch size)
+        :param tpts: Tensor [V x B] or [1 x B] containing time points for the samples.
+                     Defaults to the time points of the data batch
 
         :return Tensor [V x S x B]. B is the batch size, so for each voxel and sample
                 we return a prediction which can be compared with the data batch
         """
-        model_samples, model_means, model_vars = [], [], []
+        # The model is evaluated in the compute precision
+        samples = tf.cast(samples, compute_dtype())
+        model_samples = []
         for idx, param in enumerate(self.params):
             int_samples = samples[:, idx, :]
-            int_means = self.post.mean[:, idx]
-            int_vars = self.post.var[:, idx]
             
             # Transform the underlying Gaussian samples into the values required by the model
             # This depends on each model parameter's underlying distribution
@@ -286,29 +562,20 @@ class SvbFit(LogBase):
                 # Skip the noise parameter for now as the model expects to be passed its own parameters
                 # in order
                 model_samples.append(tf.expand_dims(param.post_dist.transform.ext_values(int_samples), -1))
-                ext_means, ext_vars = param.post_dist.transform.ext_moments(int_means, int_vars)
-                model_means.append(ext_means)
-                model_vars.append(ext_vars)
 
         # Put the noise parameter at the end
         param = self.params[self.noise_idx]
         int_samples = samples[:, self.noise_idx, :]
-        int_means = self.post.mean[:, self.noise_idx]
-        int_vars = self.post.var[:, self.noise_idx]
         model_samples.append(tf.expand_dims(param.post_dist.transform.ext_values(int_samples), -1))
-        ext_means, ext_vars = param.post_dist.transform.ext_moments(int_means, int_vars)
-        model_means.append(ext_means)
-        model_vars.append(ext_vars)
         
-        # Define convenience tensors for querying the model-space sample, means and prediction
+        # Define convenience tensor for querying the model-space samples
         self.model_samples = self.log_tf(tf.identity(model_samples, name="model_samples"))
-        self.model_means = self.log_tf(tf.identity(model_means, name="model_means"))
-        self.model_vars = self.log_tf(tf.identity(model_vars, name="model_vars"))
-        self.modelfit = self.log_tf(tf.identity(self.model.evaluate(tf.expand_dims(self.model_means, -1), self.tpts_train), "modelfit"))
 
         # The timepoints tensor has shape [V x B] or [1 x B]. It needs to be reshaped
         # to [V x 1 x B] or [1 x 1 x B] so it can be broadcast across each of the S samples
-        sample_tpts = self.log_tf(tf.expand_dims(self.tpts_train, 1), name="sample_tpts")
+        if tpts is None:
+            tpts = self.tpts_train
+        sample_tpts = self.log_tf(tf.expand_dims(tpts, 1), name="sample_tpts")
 
         # Evaluate the model using the transformed values
         # Model prediction has shape [W x S x B]
@@ -316,9 +583,85 @@ class SvbFit(LogBase):
                                                           "sample_predictions"), shape=True)
         return self.sample_predictions
 
+    def _create_model_moments(self):
+        """
+        Create tensors for the model-space posterior means and variances of the parameters
+        and the model prediction at the posterior mean
+
+        FIXME assuming noise is last parameter
+        """
+        model_means, model_vars = [], []
+        for idx, param in enumerate(self.params):
+            if idx != self.noise_idx:
+                ext_means, ext_vars = param.post_dist.transform.ext_moments(self.post.mean[:, idx], self.post.var[:, idx])
+                model_means.append(ext_means)
+                model_vars.append(ext_vars)
+
+        # Put the noise parameter at the end
+        param = self.params[self.noise_idx]
+        ext_means, ext_vars = param.post_dist.transform.ext_moments(self.post.mean[:, self.noise_idx], self.post.var[:, self.noise_idx])
+        model_means.append(ext_means)
+        model_vars.append(ext_vars)
+
+        self.model_means = self.log_tf(tf.identity(model_means, name="model_means"))
+        self.model_vars = self.log_tf(tf.identity(model_vars, name="model_vars"))
+        self.modelfit = self.log_tf(tf.identity(self.model.evaluate(tf.expand_dims(tf.cast(self.model_means, compute_dtype()), -1), self.tpts_train), "modelfit"))
+
     def _create_loss_optimizer(self):
         """
         Create the loss optimizer which will minimise the cost function
+        """
+        self._create_loss(self.data_train, self.tpts_train, self.latent_weight)
+
+        # Combine the costs from each voxel and use a single ADAM optimizer to optimize the mean cost
+        # It is also possible to optimize the total cost but this makes it harder to compare with
+        # variable numbers of voxels. The learning rate is passed as a callable so it can be
+        # re-evaluated at each step of the in-graph training loop
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=self._get_learning_rate)
+        self.optimize = self._minimize()
+
+    def _minimize(self):
+        """
+        Create an optimization step for the current cost
+
+        With the ``natgrad`` optimizer the posterior variables take natural gradient steps,
+        see ``Posterior.natural_gradient_step``. Adam would rescale each step and undo the
+        preconditioning. Any other variables, e.g. prior hyperparameters, are still optimized
+        with Adam
+
+        :return: Operation which updates the variables and increments the global step
+        """
+        if self._optimizer != "natgrad":
+            return self.optimizer.minimize(self.mean_cost, global_step=self.global_step)
+
+        # The Fisher information is that of each voxel's posterior, so the natural gradient
+        # is of the voxel cost rather than the mean cost
+        grads_and_vars = self.optimizer.compute_gradients(self.mean_cost)
+        nvoxels = tf.shape(self.cost)[0]
+        learning_rate = tf.minimum(tf.cast(self._get_learning_rate(), float_dtype()), 1)
+        post_updates = self.post.natural_gradient_step(dict([
+            (var.name, grad * tf.cast(nvoxels, grad.dtype)) for grad, var in grads_and_vars if grad is not None
+        ]), learning_rate)
+        post_vars = set([var.name for _value, var in post_updates])
+        hyper_grads = [(grad, var) for grad, var in grads_and_vars
+                       if grad is not None and var.name not in post_vars]
+
+        # All the new values are calculated before any of the variables are updated
+        values = [tf.cast(value, var.dtype) for value, var in post_updates]
+        with tf.control_dependencies(values + [grad for grad, _var in hyper_grads]):
+            ops = [tf.assign(var, value, validate_shape=False) for value, (_value, var) in zip(values, post_updates)]
+            if hyper_grads:
+                ops.append(self.optimizer.apply_gradients(hyper_grads))
+        with tf.control_dependencies(ops):
+            return tf.assign_add(self.global_step, 1)
+
+    def _create_loss(self, data, tpts, latent_weight):
+        """
+        Create the cost function for a batch of data
+
+        :param data: Tensor [V x B] containing the data batch
+        :param tpts: Tensor [V x B] or [1 x B] containing the time points of the data batch
+        :param latent_weight: Tensor containing the weight given to the latent loss
 
         The loss is composed of two terms:
 
@@ -329,11 +672,27 @@ class SvbFit(LogBase):
         2. The latent loss. This is a measure of how closely the posterior fits the
            prior
         """
-        # Generate a set of samples from the posterior [W x P x B]
-        samples = self.post.sample(self.sample_size)
+        # Model-space parameter means and variances
+        self._create_model_moments()
 
-        #samples = tf.boolean_mask(samples, self.voxel_mask)
-        #data = tf.boolean_mask(self.data_train, self.voxel_mask)
+        # Generate a set of samples from the posterior [W x P x B]. With adaptive sample
+        # size enough samples are drawn for the voxel with the most samples
+        if self._adaptive_ss:
+            samples = self.post.sample(tf.reduce_max(self.voxel_ss))
+        else:
+            samples = self.post.sample(self.sample_size)
+
+        # With per-voxel convergence the reconstruction loss is only calculated for
+        # active voxels. The samples above and the latent loss below are still
+        # calculated for all voxels
+        if self._voxel_conv:
+            active_samples = tf.gather(samples, self.active_idx)
+            active_data = tf.gather(data, self.active_idx)
+            active_tpts = tf.cond(tf.shape(tpts)[0] > 1,
+                                  lambda: tf.gather(tpts, self.active_idx),
+                                  lambda: tpts)
+        else:
+            active_samples, active_data, active_tpts = samples, data, tpts
 
         # Part 1: Reconstruction loss
         #
@@ -344,18 +703,27 @@ class SvbFit(LogBase):
         # from the model prediction to the data are within the noise model (with its current
         # parameters)
 
-        # Get the model prediction for the current set of parameters
-        model_prediction = self._get_model_prediction(samples)
-
-        # Unpack noise parameter - this is placed at the end of the list of parameters when
-        # they are converted from internal (transformed) values to real values
-        noise_samples = self.log_tf(tf.identity(tf.squeeze(self.model_samples[-1]), name="noise_samples"))
-
-        # Note that we pass the total number of time points as we need to scale this term correctly
-        # when the batch size is not the full data size
-        model_prediction_voxels = self.data_model.vertices_to_voxels(model_prediction)
-        noise_samples_voxels = self.data_model.vertices_to_voxels(noise_samples)
-        reconstr_loss = self.noise.log_likelihood(self.data_train, model_prediction_voxels, noise_samples_voxels, self.nt_full)
+        if self.analytic_reconstr_loss:
+            reconstr_loss = self._create_analytic_reconstr_loss(active_samples, active_data, active_tpts)
+        elif self._adaptive_ss:
+            reconstr_loss = self._create_adaptive_reconstr_loss(active_samples, active_data, active_tpts)
+        else:
+            # Get the model prediction for the current set of parameters
+            model_prediction = self._get_model_prediction(active_samples, active_tpts)
+
+            # Unpack noise parameter - this is placed at the end of the list of parameters when
+            # they are converted from internal (transformed) values to real values
+            noise_samples = self.log_tf(tf.identity(tf.squeeze(self.model_samples[-1]), name="noise_samples"))
+
+            # Note that we pass the total number of time points as we need to scale this term correctly
+            # when the batch size is not the full data size
+            model_prediction_voxels = self.data_model.vertices_to_voxels(model_prediction)
+            noise_samples_voxels = self.data_model.vertices_to_voxels(noise_samples)
+            reconstr_loss = self.noise.log_likelihood(active_data, model_prediction_voxels, noise_samples_voxels, self.nt_full)
+        if self._voxel_conv:
+            # Frozen voxels keep their previous reconstruction loss
+            active_reconstr = tf.scatter_nd(tf.expand_dims(self.active_idx, -1), reconstr_loss, [self.nvoxels])
+            reconstr_loss = tf.where(self.active_voxels > 0, active_reconstr, self.frozen_reconstr)
         self.reconstr_loss = self.log_tf(tf.identity(reconstr_loss, name="reconstr_loss"))
 
         # Part 2: Latent loss
@@ -371,23 +739,269 @@ class SvbFit(LogBase):
         else:
             latent_loss = tf.subtract(self.post.entropy(samples), self.prior.mean_log_pdf(samples), name="latent_loss")
 
+        if self._voxel_conv:
+            # Frozen voxels keep their previous latent loss
+            latent_loss = tf.where(self.active_voxels > 0, latent_loss, self.frozen_latent)
+
         self.latent_loss = self.log_tf(latent_loss)
 
         # Voxelwise cost is the sum of the latent and reconstruction cost but we have the possibility
         # of gradually introducing the latent loss via the latent_weight variable. This is based on
         # the theory that you should let the model fit the data first and then allow the fit to
         # be perturbed by the priors.
-        if self.latent_weight == 0:
+        if latent_weight == 0:
             self.cost = tf.identity(self.reconstr_loss, name="cost")
         else:
-            self.cost = tf.add(self.reconstr_loss, self.latent_weight * self.latent_loss, name="cost")
-
-        # Combine the costs from each voxel and use a single ADAM optimizer to optimize the mean cost
-        # It is also possible to optimize the total cost but this makes it harder to compare with
-        # variable numbers of voxels
+            self.cost = tf.add(self.reconstr_loss, latent_weight * self.latent_loss, name="cost")
         self.mean_cost = tf.reduce_mean(self.cost, name="mean_cost")
-        self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        self.optimize = self.optimizer.minimize(self.mean_cost, global_step=self.global_step)
+
+    def _create_analytic_reconstr_loss(self, samples, data, tpts):
+        """
+        Create the reconstruction loss for a linear model using the analytic expected
+        sum of squared differences
+
+        For a linear model ``f = X . theta`` with Gaussian model parameters, the expected
+        sum of squared differences given a noise sample is
+        ``||y - X . m||^2 - 2 d . X^T (y - X . m) + d . X^T X . d + tr(X^T X C)`` where
+        ``m + d`` and ``C`` are the mean and covariance of the model parameters conditional
+        on the noise sample. Only the noise parameter is sampled, so there is no Monte Carlo
+        noise from the model parameters and no [V x S x B] prediction
+
+        :param samples: Tensor [V x P x S] containing samples from the posterior, of which
+                        only the noise parameter samples are used
+        :param data: Tensor [V x B] containing the data batch
+        :param tpts: Tensor [V x B] or [1 x B] containing the time points of the data batch
+
+        :return: Tensor [V] containing the reconstruction loss of each voxel
+        """
+        dtype = float_dtype()
+        nparams, noise_idx = self.model.nparams, self.noise_idx
+        mean, cov = self.post.mean, self.post.cov
+        if hasattr(self.post, "cov_chol"):
+            # Covariance of the samples, which are generated as ``mean + L . eps``
+            cov = tf.matmul(self.post.cov_chol, self.post.cov_chol, transpose_b=True)
+        if self._voxel_conv:
+            mean, cov = tf.gather(mean, self.active_idx), tf.gather(cov, self.active_idx)
+
+        # Shift in the model parameter means [V x S x P] and their covariance [V x P x P]
+        # conditional on each noise sample
+        noise_samples = samples[:, noise_idx, :]
+        noise_cov = cov[:, :nparams, noise_idx]
+        gain = noise_cov / tf.expand_dims(cov[:, noise_idx, noise_idx], -1)
+        shift = tf.expand_dims(gain, 1) * tf.expand_dims(noise_samples - tf.expand_dims(mean[:, noise_idx], -1), -1)
+        cond_cov = cov[:, :nparams, :nparams] - tf.expand_dims(gain, -1) * tf.expand_dims(noise_cov, 1)
+
+        # Design matrix [V x B x P] or [1 x B x P] and residuals at the posterior mean [V x B]
+        design = tf.cast(self.model.design_matrix(tf.cast(tpts, compute_dtype())), dtype)
+        data = tf.cast(data, dtype)
+        residuals = data - tf.reduce_sum(design * tf.expand_dims(mean[:, :nparams], 1), axis=-1)
+        xtx = tf.matmul(design, design, transpose_a=True)
+        xtr = tf.reduce_sum(design * tf.expand_dims(residuals, -1), axis=1)
+
+        sum_square_diff = (tf.expand_dims(tf.reduce_sum(tf.square(residuals), axis=-1), -1)
+                           - 2 * tf.reduce_sum(shift * tf.expand_dims(xtr, 1), axis=-1)
+                           + tf.reduce_sum(tf.matmul(shift, xtx) * shift, axis=-1)
+                           + tf.expand_dims(tf.reduce_sum(xtx * cond_cov, axis=[-2, -1]), -1))
+        sum_square_diff = self.log_tf(tf.identity(sum_square_diff, name="ssq"))
+
+        noise_var = self.params[noise_idx].post_dist.transform.ext_values(noise_samples)
+        return self.noise.ssq_log_likelihood(sum_square_diff, noise_var, self.nt_full, tf.shape(data)[1])
+
+    def _create_adaptive_reconstr_loss(self, samples, data, tpts):
+        """
+        Create the reconstruction loss when each voxel has its own number of samples
+
+        The samples used by each voxel are flattened into a list of (voxel, sample) pairs
+        and the model is evaluated once for each pair, so the size of the prediction
+        tensor is set by the total sample budget rather than the largest sample size.
+        The variance of the per-sample reconstruction loss of each voxel is also
+        calculated as ``reconstr_var``
+
+        :param samples: Tensor [V x P x S] containing samples from the posterior, where S
+                        is at least the largest number of samples used by any voxel
+        :param data: Tensor [V x B] containing the data batch
+        :param tpts: Tensor [V x B] or [1 x B] containing the time points of the data batch
+
+        :return: Tensor [V] containing the reconstruction loss of each voxel
+        """
+        voxel_ss = self.voxel_ss
+        if self._voxel_conv:
+            voxel_ss = tf.gather(voxel_ss, self.active_idx)
+        nvoxels = tf.shape(voxel_ss)[0]
+
+        # Voxel and sample index of each pair [N]
+        pair_voxel = tf.repeat(tf.range(nvoxels), voxel_ss)
+        pair_sample = tf.range(tf.shape(pair_voxel)[0]) - tf.gather(tf.cumsum(voxel_ss, exclusive=True), pair_voxel)
+        pair_samples = tf.gather_nd(tf.transpose(samples, (0, 2, 1)), tf.stack([pair_voxel, pair_sample], axis=1))
+        pair_tpts = tf.cond(tf.shape(tpts)[0] > 1,
+                            lambda: tf.gather(tpts, pair_voxel),
+                            lambda: tpts)
+
+        # Each pair is treated as a voxel with a single sample, giving a prediction [N x 1 x B]
+        model_prediction = self._get_model_prediction(tf.expand_dims(pair_samples, -1), pair_tpts)
+        noise_samples = self.log_tf(tf.reshape(self.model_samples[-1], [-1, 1]), name="noise_samples")
+        pair_loss = self.noise.log_likelihood(tf.gather(data, pair_voxel), model_prediction, noise_samples, self.nt_full)
+
+        # Mean and variance of the loss over the samples of each voxel
+        n_samples = tf.cast(voxel_ss, pair_loss.dtype)
+        reconstr_loss = tf.unsorted_segment_sum(pair_loss, pair_voxel, nvoxels) / n_samples
+        mean_square = tf.unsorted_segment_sum(tf.square(pair_loss), pair_voxel, nvoxels) / n_samples
+        reconstr_var = tf.maximum(mean_square - tf.square(reconstr_loss), 0) * n_samples / tf.maximum(n_samples - 1, 1)
+        if self._voxel_conv:
+            reconstr_var = tf.scatter_nd(tf.expand_dims(self.active_idx, -1), reconstr_var, [self.nvoxels])
+        self.reconstr_var = self.log_tf(tf.identity(reconstr_var, name="reconstr_var"))
+        return reconstr_loss
+
+    def _create_train_loop(self, **kwargs):
+        """
+        Create an in-graph training loop which runs a number of epochs of mini-batch
+        training in a single session call
+
+        The prior, posterior and cost are rebuilt inside the loop body, reusing the
+        existing variables, so that they are re-evaluated at every step. Batch selection,
+        the switch to including the latent cost after ``fit_only_epochs`` and the
+        accumulation of the cost over each epoch are done in the graph. Only the
+        voxelwise costs of each epoch and the parameters at the start of each epoch
+        are returned
+        """
+        self.loop_epochs = tf.placeholder(tf.int32, shape=[])
+        self.loop_first_epoch = tf.placeholder(tf.int32, shape=[])
+        self.fit_only_epochs = tf.placeholder(tf.int32, shape=[])
+        self.n_batches = tf.placeholder(tf.int32, shape=[])
+        self.batch_size = tf.placeholder(tf.int32, shape=[])
+        self.sequential_batches = tf.placeholder(tf.bool, shape=[])
+
+        def _write(arrays, idx, values):
+            return tuple([array.write(idx, value) for array, value in zip(arrays, values)])
+
+        def _body(step, total_cost, total_latent, total_reconstr, epoch_costs, epoch_start):
+            epoch, batch = step // self.n_batches, step % self.n_batches
+            data, tpts = self._get_batch(batch)
+            latent_weight = tf.cast(self.loop_first_epoch + epoch >= self.fit_only_epochs, float_dtype())
+            with self._loop_scope(**kwargs):
+                self._create_loss(data, tpts, latent_weight)
+                start_values = tuple(self._epoch_diagnostics().values())
+                with tf.control_dependencies(start_values):
+                    optimize = self._minimize()
+                with tf.control_dependencies([optimize]):
+                    n_batches = tf.cast(self.n_batches, float_dtype())
+                    total_cost += self.cost / n_batches
+                    total_latent += self.latent_loss / n_batches
+                    total_reconstr += self.reconstr_loss / n_batches
+
+            # Record the diagnostics at the start of each epoch and the costs at the end
+            if start_values:
+                epoch_start = tf.cond(tf.equal(batch, 0),
+                                      lambda: _write(epoch_start, epoch, start_values),
+                                      lambda: epoch_start)
+            epoch_end = tf.equal(batch, self.n_batches - 1)
+            totals = (total_cost, total_latent, total_reconstr)
+            epoch_costs = tf.cond(epoch_end,
+                                  lambda: _write(epoch_costs, epoch, totals),
+                                  lambda: epoch_costs)
+            totals = [tf.where(epoch_end, tf.zeros_like(total), total) for total in totals]
+            return (step+1,) + tuple(totals) + (epoch_costs, epoch_start)
+
+        def _cond(step, *_args):
+            return step < self.loop_epochs * self.n_batches
+
+        epoch_costs = tuple([tf.TensorArray(float_dtype(), size=self.loop_epochs) for _idx in range(3)])
+        epoch_start = tuple([tf.TensorArray(tensor.dtype, size=self.loop_epochs)
+                             for tensor in self._epoch_diagnostics().values()])
+        zeros = tf.zeros([self.nvoxels], dtype=float_dtype())
+        loop_vars = (tf.constant(0), zeros, zeros, zeros, epoch_costs, epoch_start)
+        shape_invariants = (tf.TensorShape([]), tf.TensorShape(None), tf.TensorShape(None), tf.TensorShape(None),
+                            tuple([tf.TensorShape(None)] * len(epoch_costs)),
+                            tuple([tf.TensorShape(None)] * len(epoch_start)))
+        _step, _cost, _latent, _reconstr, epoch_costs, epoch_start = tf.while_loop(
+            _cond, _body, loop_vars, shape_invariants=shape_invariants, parallel_iterations=1, back_prop=False
+        )
+        self._train_loop = tuple([array.stack() for array in epoch_costs + epoch_start])
+
+    def _create_saa_ops(self):
+        """
+        Create operations for minimizing the sample average approximation of the cost
+
+        All trainable variables are vertexwise as voxels are independent, so the gradient of
+        the total cost with respect to each voxel's variables is the gradient of that voxel's cost
+        """
+        self._saa_vars = tf.trainable_variables()
+        grads = tf.gradients(tf.reduce_sum(self.cost), self._saa_vars)
+        self._saa_grads = [tf.zeros_like(var) if grad is None else grad for grad, var in zip(grads, self._saa_vars)]
+        self._saa_input = [tf.placeholder(var.dtype, name="saa_input%i" % idx) for idx, var in enumerate(self._saa_vars)]
+        self._saa_set = tf.group(*[tf.assign(var, value, validate_shape=False)
+                                   for var, value in zip(self._saa_vars, self._saa_input)])
+        self._saa_redraw = tf.assign_add(self._saa_seed, 1)
+
+    def _create_compiled_step(self, **kwargs):
+        """
+        Create a training step which is compiled with XLA
+
+        The posterior sampling, model evaluation, likelihood, latent loss and optimizer update
+        for a batch are expressed as a ``tf.function`` compiled with ``jit_compile=True``
+        so they can be fused into a small number of kernels. The prior, posterior and cost
+        are rebuilt inside the function reusing the existing variables, as for the in-graph
+        training loop.
+
+        The sample size is passed in as an argument because XLA requires tensor shapes
+        to be known when compiling. The step is compiled again for each new sample size
+        """
+        @tf.function(jit_compile=True)
+        def _step(data, tpts, latent_weight, sample_size):
+            with self._loop_scope(**kwargs):
+                self.sample_size = sample_size
+                self._create_loss(data, tpts, latent_weight)
+                optimize = self._minimize()
+                with tf.control_dependencies([optimize]):
+                    return tf.identity(self.cost), tf.identity(self.latent_loss), tf.identity(self.reconstr_loss)
+
+        self._compiled_step = _step(self.data_train, self.tpts_train, self.latent_weight, self.sample_size)
+
+    def _get_batch(self, batch):
+        """
+        Select a mini-batch of the training data in the graph
+
+        :param batch: Tensor containing the batch index
+        :return: Tuple of data [V x B] and time points [V x B] or [1 x B] for the batch
+        """
+        def _sequential():
+            # The last batch includes any remaining time points so all of the data is used
+            start = batch * self.batch_size
+            end = tf.where(tf.equal(batch, self.n_batches - 1), tf.shape(self.data_train)[1], start + self.batch_size)
+            return self.data_train[:, start:end], self.tpts_train[:, start:end]
+
+        def _strided():
+            return self.data_train[:, batch::self.n_batches], self.tpts_train[:, batch::self.n_batches]
+
+        return tf.cond(self.sequential_batches, _sequential, _strided)
+
+    @contextlib.contextmanager
+    def _loop_scope(self, **kwargs):
+        """
+        Context in which the prior and posterior are rebuilt for use inside the
+        training loop
+
+        The existing prior and posterior variables are reused in the order in which
+        they were created. The attributes of the instance are restored on exit so
+        tensors created in this context are only available within it
+        """
+        saved_attrs = dict(self.__dict__)
+        variables = iter(self._prior_post_vars)
+        def _reuse_variable(_next_creator, **_kwargs):
+            return next(variables)
+
+        log_disabled = self.log.disabled
+        self.log.disabled = True
+        try:
+            self.learning_rate = self._get_learning_rate()
+            self.sample_size = self._get_sample_size()
+            with tf.variable_creator_scope(_reuse_variable):
+                self._create_prior_post(**kwargs)
+            yield
+        finally:
+            self.log.disabled = log_disabled
+            self.__dict__.clear()
+            self.__dict__.update(saved_attrs)
 
     def fit_batch(self):
         """
@@ -395,9 +1009,111 @@ class SvbFit(LogBase):
 
         :return: Tuple of total cost of mini-batch, latent cost and reconstruction cost
         """
-        _, cost, latent, reconstr = self.evaluate(self.optimize, self.cost, self.latent_loss, self.reconstr_loss)
+        if self._compiled_step is not None:
+            return tuple(self._run(list(self._compiled_step)))
+
+        _, cost, latent, reconstr = self._run([self.optimize, self.cost, self.latent_loss, self.reconstr_loss])
         return cost, latent, reconstr
 
+    def _run(self, fetches):
+        """
+        Run a training step, which is traced if it is one of the steps being profiled
+
+        :param fetches: Fetches for ``Session.run``
+        :return: Output of ``Session.run``
+        """
+        if self._profiler is not None:
+            return self._profiler.run(self.sess, fetches, self.feed_dict)
+        return self.sess.run(fetches, feed_dict=self.feed_dict)
+
+    def fit_saa(self, lbfgs):
+        """
+        Take an L-BFGS iteration on the sample average approximation of the cost for the
+        full data
+
+        :param lbfgs: svb.lbfgs.BatchedLbfgs instance minimizing ``saa_cost``
+        :return: Tuple of total cost, latent cost and reconstruction cost
+        """
+        values = self.sess.run(self._saa_vars, feed_dict=self.feed_dict)
+        self._saa_shapes = [value.shape for value in values]
+        x, cost, _grads, latent, reconstr = lbfgs.step(np.concatenate(
+            [np.reshape(value, [len(value), -1]) for value in values], axis=1
+        ).astype(np.float64))
+        self._set_saa_vars(x)
+        return cost, latent, reconstr
+
+    def saa_cost(self, x):
+        """
+        Evaluate the sample average approximation of the cost for the current random draws
+
+        :param x: Values of the trainable variables for each voxel [V x N], see ``fit_saa``
+        :return: Tuple of total cost [V], its gradient [V x N], latent cost [V] and
+                 reconstruction cost [V]
+        """
+        self._set_saa_vars(x)
+        cost, latent, reconstr, grads = self._run([self.cost, self.latent_loss, self.reconstr_loss, self._saa_grads])
+        grads = np.concatenate([np.reshape(grad, [len(grad), -1]) for grad in grads], axis=1)
+        return cost, grads, latent, reconstr
+
+    def _set_saa_vars(self, x):
+        """
+        Set the trainable variables from their values for each voxel [V x N]
+        """
+        offsets = np.cumsum([int(np.prod(shape[1:])) for shape in self._saa_shapes])[:-1]
+        values = [np.reshape(value, shape) for value, shape in zip(np.split(x, offsets, axis=1), self._saa_shapes)]
+        feed_dict = dict(self.feed_dict)
+        feed_dict.update(zip(self._saa_input, values))
+        self.sess.run(self._saa_set, feed_dict=feed_dict)
+
+    def fit_loop(self, first_epoch, n_epochs):
+        """
+        Train model for a number of epochs using the in-graph training loop
+
+        :param first_epoch: Index of the first epoch to train
+        :param n_epochs: Number of epochs to train
+        :return: Tuple of total cost, latent cost and reconstruction cost [E x V] and a sequence
+                 containing a dictionary of diagnostics at the end of each epoch
+        """
+        self.feed_dict.update({
+            self.loop_first_epoch : first_epoch,
+            self.loop_epochs : n_epochs,
+        })
+        outputs = self._run(self._train_loop)
+        cost, latent, reconstr = outputs[:3]
+
+        # The loop returns the diagnostics at the start of each epoch, so the values at the
+        # end of each epoch are the values at the start of the next epoch
+        names = list(self._epoch_diagnostics().keys())
+        start_values = [dict(zip(names, values)) for values in zip(*outputs[3:])] or [{}] * n_epochs
+        return cost, latent, reconstr, start_values[1:] + [self.epoch_diagnostics()]
+
+    def _epoch_diagnostics(self):
+        """
+        :return: Ordered dictionary of name: tensor for the enabled diagnostics which are
+                 evaluated at the end of each epoch
+        """
+        tensors = {
+            "params" : self.model_means,
+            "var" : self.post.var,
+            "lr" : self.learning_rate,
+            "ss" : self.sample_size,
+        }
+        return collections.OrderedDict([
+            (name, tensors[name]) for name in DIAGNOSTICS if name in self.diagnostics and name in tensors
+        ])
+
+    def epoch_diagnostics(self):
+        """
+        Evaluate the enabled end of epoch diagnostics in a single run
+
+        :return: Dictionary of diagnostic name: value. ``params`` contains the model parameter
+                 means [P x W], ``var`` the posterior variances [W x P], ``lr`` the learning
+                 rate and ``ss`` the sample size
+        """
+        tensors = self._epoch_diagnostics()
+        values = self.sess.run(list(tensors.values()), feed_dict=self.feed_dict)
+        return dict(zip(tensors.keys(), values))
+
     def evaluate(self, *tensors):
         """
         Evaluate tensor values
@@ -417,6 +1133,27 @@ class SvbFit(LogBase):
         else:
             return tuple(out)
 
+    def results(self):
+        """
+        Get the output of the fit evaluated on the full data
+
+        :return: Dictionary of Numpy arrays: ``mean`` and ``var`` with shape [P, W] containing
+                 the model-space parameter means and variances, ``modelfit`` with shape [V, T]
+                 containing the model prediction at the posterior mean, ``post_mean`` with
+                 shape [W, P] and ``post_cov`` with shape [W, P, P] containing the
+                 posterior distribution
+        """
+        mean, var, modelfit, post_mean, post_cov = self.evaluate(
+            self.model_means, self.model_vars, self.modelfit, self.post.mean, self.post.cov
+        )
+        return {
+            "mean" : mean,
+            "var" : var,
+            "modelfit" : modelfit,
+            "post_mean" : post_mean,
+            "post_cov" : post_cov,
+        }
+
     def state(self):
         """
         Get the current state of the optimization.
@@ -424,28 +1161,78 @@ class SvbFit(LogBase):
         This can be used to restart from a previous state if a numerical error occurs
         """
         return self.evaluate(self.post.state())
-        
+
     def set_state(self, state):
         """
         Set the state of the optimization
 
         :param state: State as returned by the ``state()`` method
         """
-        self.evaluate(self.post.set_state(state))
+        feed_dict = dict(self.feed_dict)
+        feed_dict.update(zip(self._state_input, state))
+        self.sess.run(self._set_state, feed_dict=feed_dict)
         
-    def train(self, tpts, data,
+    def reset(self, data, tpts, post_init=None):
+        """
+        Re-target the fit at new data without rebuilding the graph
+
+        All variables are re-initialized, so the posterior is initialized from the new
+        data in the same way as it would be for a new graph. The data must have the same
+        number of voxels and time points as the data the graph was created for.
+
+        :param data: Timeseries data, shape [V, T]
+        :param tpts: Time series values, shape [T] or [V, T]
+        :param post_init: Optional tuple of posterior mean [W, P] and covariance [W, P, P] to initialize
+                          the posterior from, replacing the initial posterior of the data model. This is
+                          only possible if the data model provided an initial posterior when the graph was
+                          created
+        """
+        # Expect tpts to have a dimension for voxelwise variation even if it is the same for all voxels
+        if tpts.ndim == 1:
+            tpts = tpts.reshape(1, -1)
+
+        # Check data and time points are consistent with each other and with the graph
+        n_voxels, n_timepoints = tuple(data.shape)
+        if n_voxels != self.nvoxels or n_timepoints != self.nt_full:
+            raise ValueError("Data has %i voxels and %i volumes, but the graph was created for %i voxels and %i volumes"
+                             % (n_voxels, n_timepoints, self.nvoxels, self.nt_full))
+        if tpts.shape[0] > 1 and tpts.shape[0] != n_voxels:
+            raise ValueError("Time points has %i voxels, but data has %i" % (tpts.shape[0], n_voxels))
+        if tpts.shape[1] != n_timepoints:
+            raise ValueError("Time points has length %i, but data has %i volumes" % (tpts.shape[1], n_timepoints))
+
+        self.feed_dict = {
+            self.data_full : data,
+            self.data_train: data,
+            self.tpts_train : tpts,
+        }
+        if post_init is not None:
+            if self.post_init is None:
+                raise ValueError("Initial posterior provided but the data model did not define one when the graph was created")
+            self.feed_dict[self.post_init[0]] = post_init[0]
+            self.feed_dict[self.post_init[1]] = post_init[1]
+        self.evaluate(self.init)
+        self._data, self._tpts, self._post_init = data, tpts, post_init
+
+    def train(self, tpts=None, data=None,
               batch_size=None, sequential_batches=False,
               epochs=100, fit_only_epochs=0, display_step=1,
               learning_rate=0.1, lr_decay_rate=1.0,
               sample_size=None, ss_increase_factor=1.0,
               revert_post_trials=50, revert_post_final=True,
-              **kwargs):
+              max_trials=None, lr_quench=0.99, lr_min=1e-5, ss_min=2, ss_max=None,
+              post_init=None, voxel_conv_tol=None, voxel_conv_trials=5, loop_epochs=None,
+              conv_tol=None, conv_window=10, time_limit=None,
+              history="full", history_step=1, history_dir=None,
+              checkpoint_dir=None, checkpoint_step=10, resume=False,
+              saa_redraw=None, saa_memory=10, profile_steps=None, profile_dir=None, **kwargs):
         """
         Train the graph to infer the posterior distribution given timeseries data
 
         :param tpts: Time series values. Should have shape [T] or [V, T] depending on whether timeseries is
                   constant or varies voxelwise
-        :param data: Full timeseries data, shape [V, T]
+        :param data: Full timeseries data, shape [V, T]. If the data and time points are not given, the
+                     data from the last call to ``reset()`` is used
 
         Optional arguments:
 
@@ -462,54 +1249,189 @@ class SvbFit(LogBase):
         :param lr_decay_rate: When adjusting the learning rate, the factor to reduce it by
         :param sample_size: Number of samples to use when estimating expectations over the posterior
         :param ss_increase_factor: Factor to increase the sample size by over the epochs
+        :param ss_min: Minimum number of samples for each voxel with adaptive sample size. With adaptive
+                       sample size, which is only possible if ``adaptive_ss`` was given when the graph was
+                       created, the sample size is the mean number of samples per voxel and the total is
+                       shared between voxels in proportion to the standard deviation of their reconstruction
+                       cost at the end of each epoch. With antithetic sampling whole pairs of samples are
+                       allocated, so the numbers of samples are even. Samples are drawn for all voxels
+                       up to the largest number of samples of any voxel and then masked, so the cost of
+                       sampling grows with the largest allocation rather than the total budget
+        :param ss_max: Optional maximum number of samples for each voxel with adaptive sample size. This
+                       also limits the [W x P x ss_max] samples drawn at each step
         :param revert_post_trials: How many epoch to continue for without an improvement in the mean cost before
                                    reverting the posterior to the previous best parameters
         :param revert_post_final: If True, revert to the state giving the best cost achieved after the final epoch
+        :param max_trials: If specified, how many epochs to continue for without an improvement in the mean cost
+                           before quenching the learning rate. If the learning rate is quenched the posterior is
+                           not reverted, so ``max_trials`` must be less than ``revert_post_trials`` or quenching
+                           is disabled with a warning. Once the learning rate reaches ``lr_min`` the posterior is
+                           reverted instead
+        :param lr_quench: Factor to multiply the learning rate by when quenching it
+        :param lr_min: Minimum learning rate when quenching
+        :param post_init: Optional tuple of posterior mean [W, P] and covariance [W, P, P] to initialize
+                          the posterior from, see ``reset()``
+        :param voxel_conv_tol: If specified, relative tolerance on the change in the cost and parameters of each
+                               voxel between epochs for the voxel to be considered converged. Converged voxels
+                               are frozen and excluded from further training. With spatial priors voxels cannot
+                               be frozen individually and training stops once all voxels have converged
+        :param voxel_conv_trials: Number of consecutive epochs a voxel must be within the convergence tolerance
+                                  before it is considered converged
+        :param loop_epochs: If specified, number of epochs to run in each session call using the in-graph
+                            training loop. This is only possible if ``loop_epochs`` was also given when the
+                            graph was created. Saving and reverting the posterior state and freezing converged
+                            voxels only happen at the end of each group of epochs
+        :param conv_tol: If specified, training stops once the relative change in the mean cost and
+                         mean parameters over ``conv_window`` epochs is within this tolerance
+        :param conv_window: Number of epochs over which the change in the mean cost and parameters is
+                            measured for ``conv_tol``
+        :param time_limit: If specified, training stops after the first epoch which ends this number
+                           of seconds after the start of training. With ``loop_epochs`` this is
+                           only checked at the end of each group of epochs. When resuming, the
+                           time limit applies to the resumed training only
+        :param history: Training history to record: ``full`` for voxelwise and mean history, ``mean``
+                         for the mean history only or ``off``. The final values are always recorded
+        :param history_step: Record the history every ``history_step`` epochs
+        :param history_dir: If specified, directory to stream the voxelwise history to rather than
+                            keeping it in memory
+        :param checkpoint_dir: If specified, directory to save checkpoints of the training state to.
+                               The history is streamed to the ``history`` subdirectory unless
+                               ``history_dir`` is given, so checkpoints do not include it
+        :param checkpoint_step: Save a checkpoint every ``checkpoint_step`` epochs. With ``loop_epochs``
+                                checkpoints are only saved at the end of each group of epochs
+        :param resume: If True, resume training from the latest checkpoint in ``checkpoint_dir``. The
+                       data and training options must be the same as when the checkpoint was saved
+        :param saa_redraw: With the SAA optimizer, if specified, the random draws used to generate the
+                           posterior samples are redrawn every ``saa_redraw`` epochs. Each epoch is an
+                           L-BFGS iteration on the full data
+        :param saa_memory: Number of previous steps used by L-BFGS with the SAA optimizer
+        :param profile_steps: If specified, sequence of indices of training steps, starting at 0, to run with
+                              full tracing. Each batch is a training step, or each group of epochs with
+                              ``loop_epochs``, or each cost evaluation with the SAA optimizer. A timeline of
+                              each traced step and a summary of the time spent in each operation are
+                              written to ``profile_dir``, see ``svb.profiling``
+        :param profile_dir: Directory to write the profile to
+
+        :return: Training history dictionary, see ``svb.history.TrainingHistory.close``
         """
-        # Expect tpts to have a dimension for voxelwise variation even if it is the same for all voxels
-        if tpts.ndim == 1:
-            tpts = tpts.reshape(1, -1)
-
-        # Determine number of voxels and timepoints and check consistent
+        # Initialize the variables for the data being fitted
+        if data is None and tpts is None:
+            if self._data is None:
+                raise ValueError("No data given and reset() has not been called")
+            data, tpts = self._data, self._tpts
+            if post_init is None:
+                post_init = self._post_init
+        elif data is None or tpts is None:
+            raise ValueError("Data and time points must be given together")
+        self.reset(data, tpts, post_init)
+        data, tpts = self._data, self._tpts
         n_voxels, n_timepoints = tuple(data.shape)
-        if tpts.shape[0] > 1 and tpts.shape[0] != n_voxels:
-            raise ValueError("Time points has %i voxels, but data has %i" % (tpts.shape[0], n_voxels))
-        if tpts.shape[1] != n_timepoints:
-            raise ValueError("Time points has length %i, but data has %i volumes" % (tpts.shape[1], n_timepoints))
 
-        # Determine number of batches and sample size
+        # Determine number of batches and sample size. The SAA optimizer always uses the
+        # full data so the cost is deterministic
+        lbfgs = None
+        if self._optimizer == "saa":
+            if batch_size is not None and batch_size < n_timepoints:
+                self.log.warning("SAA optimizer uses the full data - ignoring batch size")
+            batch_size, loop_epochs = None, None
+            lbfgs = BatchedLbfgs(self.saa_cost, memory=saa_memory)
         if batch_size is None:
             batch_size = n_timepoints
         n_batches = int(np.ceil(float(n_timepoints) / batch_size))
         if sample_size is None:
             sample_size = batch_size
 
+        # Quenching is checked before reversion, so reversion would never happen if
+        # max_trials was not less than revert_post_trials
+        if max_trials and revert_post_trials > 0 and max_trials >= revert_post_trials:
+            self.log.warning("max_trials (%i) must be less than revert_post_trials (%i) - disabling learning rate quenching",
+                             max_trials, revert_post_trials)
+            max_trials = None
+
         # Cost and parameter histories, mean and voxelwise
-        training_history = {
-            "mean_cost" : np.zeros([epochs+1]),
-            "voxel_cost" : np.zeros([n_voxels, epochs+1]),
-            "mean_params" : np.zeros([epochs+1, self._nparams]),
-            "voxel_params" : np.zeros([n_voxels, epochs+1, self._nparams]),
-            "runtime" : np.zeros([epochs+1]),
-        }
+        if resume and not checkpoint_dir:
+            raise ValueError("Resuming training requires a checkpoint directory")
+        if checkpoint_dir and not history_dir:
+            history_dir = os.path.join(checkpoint_dir, "history")
+        training_history = TrainingHistory(n_voxels, self._nparams, epochs, mode=history,
+                                           step=history_step, outdir=history_dir, resume=resume)
+
+        # Optional tracing of selected training steps
+        if profile_steps and not profile_dir:
+            raise ValueError("Profiling training steps requires a profile directory")
+        self._profiler = StepProfiler(profile_dir, profile_steps) if profile_steps else None
 
         # Training cycle
-        self.feed_dict = {
-            self.data_full : data,
+        self.feed_dict.update({
             self.num_steps : epochs*n_batches,
             self.initial_lr : learning_rate,
             self.lr_decay_rate : lr_decay_rate,
             self.initial_ss : sample_size,
             self.ss_increase_factor : ss_increase_factor,
-            self.data_train: data,
-            self.tpts_train : tpts,
             self.latent_weight : 1.0,
-        }
-        self.evaluate(self.init)
-
-        trials, best_cost, best_state = 0, 1e12, None
+        })
+        if max_trials:
+            self.feed_dict.update({
+                self.lr_quench : lr_quench,
+                self.lr_min : lr_min,
+            })
+        else:
+            # Remove quenching options from any previous training run
+            self.feed_dict.pop(self.lr_quench, None)
+            self.feed_dict.pop(self.lr_min, None)
+        if loop_epochs:
+            if self._train_loop is None:
+                raise ValueError("In-graph training loop requested but loop_epochs was not given when the graph was created")
+            self.feed_dict.update({
+                self.fit_only_epochs : fit_only_epochs,
+                self.n_batches : n_batches,
+                self.batch_size : batch_size,
+                self.sequential_batches : sequential_batches,
+            })
+
+        # With adaptive sample size, the sample budget is initially shared equally between voxels
+        if self._adaptive_ss:
+            self._set_voxel_sample_size(allocate_samples(np.ones([n_voxels]), sample_size * n_voxels, ss_min, ss_max,
+                                                         pairs=self._sampling == "antithetic"))
+
+        # The best posterior state is saved in the graph
+        trials, best_cost, has_best_state = 0, 1e12, False
         latent_weight = 0
 
+        # Per-voxel convergence state
+        conv_trials = np.zeros([n_voxels], dtype=np.int32)
+        active = np.ones([n_voxels], dtype=bool)
+        prev_cost, prev_params = None, None
+        last_epoch = epochs - 1
+
+        # Mean cost and parameters over the window used for convergence, and the reason
+        # training stopped
+        window = collections.deque(maxlen=conv_window+1)
+        stop_reason = "epochs"
+
+        # Continue from the latest checkpoint if there is one
+        first_epoch, runtime = 0, 0
+        checkpoint = None
+        if checkpoint_dir:
+            checkpoint = Checkpoint(checkpoint_dir, self._saver)
+        train_state = checkpoint.restore(self.sess) if resume else None
+        if train_state is not None:
+            if (train_state["n_voxels"], train_state["n_timepoints"], train_state["epochs"]) != (n_voxels, n_timepoints, epochs):
+                raise ValueError("Checkpoint was saved training %i voxels of %i time points for %i epochs"
+                                 % (train_state["n_voxels"], train_state["n_timepoints"], train_state["epochs"]))
+            first_epoch, runtime = train_state["epoch"] + 1, train_state["runtime"]
+            trials, best_cost, has_best_state = train_state["trials"], train_state["best_cost"], train_state["has_best_state"]
+            latent_weight, conv_trials, active = train_state["latent_weight"], train_state["conv_trials"], train_state["active"]
+            prev_cost, prev_params = train_state["prev_cost"], train_state["prev_params"]
+            if train_state["stop_reason"] != "time_limit":
+                # The time limit applies to each run so training continues after it
+                last_epoch, stop_reason = train_state["last_epoch"], train_state["stop_reason"]
+            window.extend(train_state["window"])
+            training_history.set_state(train_state["history"])
+        elif resume:
+            self.log.info("No checkpoint found in %s - starting training from the beginning", checkpoint_dir)
+        last_checkpoint = first_epoch
+
         # Each epoch passes through the whole data but it may do this in 'batches' so there may be
         # multiple training iterations per epoch, one for each batch
         self.log.info("Training model...")
@@ -517,136 +1439,357 @@ class SvbFit(LogBase):
         self.log.info(" - %i voxels of %i time points (processed in %i batches of target size %i)" , n_voxels, n_timepoints, n_batches, batch_size)
         self.log.info(" - Initial learning rate: %.5f (decay rate %.3f)", learning_rate, lr_decay_rate)
         self.log.info(" - Initial sample size: %i (increase factor %.3f)", sample_size, ss_increase_factor)
+        if loop_epochs:
+            self.log.info(" - In-graph training loop of %i epochs", loop_epochs)
+        if lbfgs is not None:
+            self.log.info(" - Sample average approximation with L-BFGS (memory %i)%s", saa_memory,
+                          ", redrawing samples every %i epochs" % saa_redraw if saa_redraw else "")
         if revert_post_trials > 0:
             self.log.info(" - Posterior reversion after %i trials", revert_post_trials)
-
-        initial_means = np.mean(self.evaluate(self.model_means), axis=1)
-        initial_vars = np.mean(self.evaluate(self.post.var), axis=0)
-        initial_cost = np.mean(self.evaluate(self.cost))
-        initial_latent = np.mean(self.evaluate(self.latent_loss))
-        initial_reconstr = np.mean(self.evaluate(self.reconstr_loss))
-        start_time = time.time()
-        self.log.info(" - Start 0000: mean cost=%f (latent=%f, reconstr=%f) mean params=%s mean_var=%s", 
-                      initial_cost, initial_latent, initial_reconstr, initial_means, initial_vars)
-        for epoch in range(epochs):
-            try:
-                err = False
-                total_cost = np.zeros([n_voxels])
-                total_latent = np.zeros([n_voxels])
-                total_reconstr = np.zeros([n_voxels])
-
-                if epoch == fit_only_epochs:
-                    # Once we have completed fit_only_epochs of training we will allow the latent cost to have
-                    # an impact and reset the best cost accordingly. By default this happens on the first epoch
-                    latent_weight = 1.0
-                    trials, best_cost = 0, 1e12
-
-                # Iterate over training batches - note that there may be only one
-                for i in range(n_batches):
-                    #print(i)
-                    if sequential_batches:
-                        # Batches are defined by sequential data time points
-                        index = i*batch_size
-                        if i == n_batches - 1:
-                            # Batch size may not be an exact factor of the number of time points
-                            # so make the last batch the right size so all of the data is used
-                            batch_size += n_timepoints - n_batches * batch_size
-                        batch_data = data[:, index:index+batch_size]
-                        batch_tpts = tpts[:, index:index+batch_size]
-                    else:
-                        # Batches are defined by constant strides through the data time points
-                        # This automatically handles case where number of time point does not
-                        # exactly divide into batches
-                        batch_data = data[:, i::n_batches]
-                        batch_tpts = tpts[:, i::n_batches]
-
-                    # Perform a training iteration using batch data
+        if max_trials:
+            self.log.info(" - Learning rate quenching by %.3f after %i trials (minimum %g)", lr_quench, max_trials, lr_min)
+        if voxel_conv_tol is not None:
+            self.log.info(" - %s convergence with tolerance %g after %i trials",
+                          "Per-voxel" if self._voxel_conv else "Global", voxel_conv_tol, voxel_conv_trials)
+        if conv_tol is not None:
+            self.log.info(" - Stopping when mean cost and parameters change within tolerance %g over %i epochs",
+                          conv_tol, conv_window)
+        if time_limit is not None:
+            self.log.info(" - Time limit: %.1fs", time_limit)
+        if checkpoint is not None:
+            self.log.info(" - Checkpoints saved to %s every %i epochs", checkpoint_dir, checkpoint_step)
+        if self._profiler is not None:
+            self.log.info(" - Tracing training steps %s to %s", ", ".join([str(step) for step in profile_steps]), profile_dir)
+        if first_epoch > 0:
+            self.log.info(" - Resuming after epoch %i", first_epoch)
+
+        if "initial" in self.diagnostics and first_epoch == 0:
+            # Evaluated in a single run so all values are calculated from the same samples
+            initial_means, initial_vars, initial_cost, initial_latent, initial_reconstr = self.evaluate(
+                self.model_means, self.post.var, self.cost, self.latent_loss, self.reconstr_loss
+            )
+            self.log.info(" - Start 0000: mean cost=%f (latent=%f, reconstr=%f) mean params=%s mean_var=%s",
+                          np.mean(initial_cost), np.mean(initial_latent), np.mean(initial_reconstr),
+                          np.mean(initial_means, axis=1), np.mean(initial_vars, axis=0))
+        run_start_time = time.time()
+        start_time = run_start_time - runtime
+        block_start, block_end = first_epoch, first_epoch - 1
+        for epoch in range(first_epoch, last_epoch + 1):
+            if epoch == fit_only_epochs:
+                # Once we have completed fit_only_epochs of training we will allow the latent cost to have
+                # an impact and reset the best cost accordingly. By default this happens on the first epoch
+                latent_weight = 1.0
+                trials, best_cost = 0, 1e12
+                window.clear()
+                if lbfgs is not None:
+                    lbfgs.reset()
+
+            if loop_epochs:
+                if epoch > block_end:
+                    # Train the next group of epochs in the graph
+                    block_start, block_end = epoch, min(epoch + loop_epochs, epochs) - 1
+                    try:
+                        err = False
+                        loop_outputs = self.fit_loop(block_start, block_end - block_start + 1)
+                    except tf.OpError:
+                        self.log.exception("Numerical error in training loop")
+                        err, block_end = True, epoch
+
+                if err:
+                    total_cost, total_latent, total_reconstr = [np.zeros([n_voxels]) for _idx in range(3)]
+                    diagnostics = self.epoch_diagnostics()
+                else:
+                    total_cost, total_latent, total_reconstr, diagnostics = [
+                        output[epoch - block_start] for output in loop_outputs
+                    ]
+            elif lbfgs is not None:
+                block_start, block_end = epoch, epoch
+                try:
+                    err = False
+                    if saa_redraw and epoch > 0 and epoch % saa_redraw == 0:
+                        # New sample average approximation of the cost
+                        self.evaluate(self._saa_redraw)
+                        lbfgs.reset()
                     self.feed_dict.update({
-                        self.data_train: batch_data,
-                        self.tpts_train : batch_tpts,
+                        self.data_train: data,
+                        self.tpts_train : tpts,
                         self.latent_weight : latent_weight,
                     })
-                    batch_cost, batch_latent, batch_reconstr = self.fit_batch()
-                    total_cost += batch_cost / n_batches
-                    total_latent += batch_latent / n_batches
-                    total_reconstr += batch_reconstr / n_batches
-
-            except tf.OpError:
-                self.log.exception("Numerical error fitting batch")
-                err = True
-
-            # Record the cost and parameter values at the end of each epoch.
-            params = self.evaluate(self.model_means) # [P, W]
-            var = self.evaluate(self.post.var) # [W, P]
-            current_lr, current_ss = self.evaluate(self.learning_rate, self.sample_size)
-            mean_params = np.mean(params, axis=1)
-            mean_var = np.mean(var, axis=0)
+                    total_cost, total_latent, total_reconstr = self.fit_saa(lbfgs)
+                except tf.OpError:
+                    self.log.exception("Numerical error in L-BFGS iteration")
+                    err = True
+                    total_cost, total_latent, total_reconstr = [np.zeros([n_voxels]) for _idx in range(3)]
+
+                diagnostics = self.epoch_diagnostics()
+            else:
+                block_start, block_end = epoch, epoch
+                try:
+                    err = False
+                    total_cost = np.zeros([n_voxels])
+                    total_latent = np.zeros([n_voxels])
+                    total_reconstr = np.zeros([n_voxels])
+
+                    # Iterate over training batches - note that there may be only one
+                    for i in range(n_batches):
+                        #print(i)
+                        if sequential_batches:
+                            # Batches are defined by sequential data time points
+                            index = i*batch_size
+                            if i == n_batches - 1:
+                                # Batch size may not be an exact factor of the number of time points
+                                # so make the last batch the right size so all of the data is used
+                                batch_size += n_timepoints - n_batches * batch_size
+                            batch_data = data[:, index:index+batch_size]
+                            batch_tpts = tpts[:, index:index+batch_size]
+                        else:
+                            # Batches are defined by constant strides through the data time points
+                            # This automatically handles case where number of time point does not
+                            # exactly divide into batches
+                            batch_data = data[:, i::n_batches]
+                            batch_tpts = tpts[:, i::n_batches]
+
+                        # Perform a training iteration using batch data
+                        self.feed_dict.update({
+                            self.data_train: batch_data,
+                            self.tpts_train : batch_tpts,
+                            self.latent_weight : latent_weight,
+                        })
+                        batch_cost, batch_latent, batch_reconstr = self.fit_batch()
+                        total_cost += batch_cost / n_batches
+                        total_latent += batch_latent / n_batches
+                        total_reconstr += batch_reconstr / n_batches
+
+                except tf.OpError:
+                    self.log.exception("Numerical error fitting batch")
+                    err = True
+
+                diagnostics = self.epoch_diagnostics()
+
+            # Record the cost and parameter values at the end of each epoch. The parameter
+            # values are only available if the params diagnostic is enabled
+            params = diagnostics.get("params", None) # [P, W]
+            mean_params = np.zeros([self._nparams]) if params is None else np.mean(params, axis=1)
 
             mean_total_cost = np.mean(total_cost)
             mean_total_latent = np.mean(total_latent)
             mean_total_reconst = np.mean(total_reconstr)
-            
-            training_history["mean_cost"][epoch] = mean_total_cost
-            training_history["voxel_cost"][:, epoch] = total_cost
-            training_history["mean_params"][epoch, :] = mean_params
-            training_history["voxel_params"][:, epoch, :] = params.transpose()
 
-            if err or np.isnan(mean_total_cost) or np.any(np.isnan(mean_params)):
+            if voxel_conv_tol is not None:
+                # Count the consecutive epochs in which each voxel has been within the
+                # convergence tolerance. This only starts once the latent cost is included
+                if epoch > fit_only_epochs and not err:
+                    voxel_conv = np.abs(total_cost - prev_cost) <= voxel_conv_tol * np.abs(prev_cost)
+                    if params is not None:
+                        voxel_conv &= np.all(np.abs(params - prev_params) <= voxel_conv_tol * np.abs(prev_params), axis=0)
+                    conv_trials = np.where(voxel_conv, conv_trials + 1, 0)
+                prev_cost, prev_params = total_cost, params
+
+            if epoch < block_end:
+                # The posterior state is only available at the end of each group of epochs
+                # trained in the graph
+                outcome = "In graph"
+            elif err or np.isnan(mean_total_cost) or np.any(np.isnan(mean_params)):
                 # Numerical errors while processing this epoch. Revert to best saved params if possible
-                if best_state is not None:
-                    self.set_state(best_state)
+                if has_best_state:
+                    self.evaluate(self._restore_best_state)
+                    active = self._reset_convergence(active, conv_trials)
                 outcome = "Revert - Numerical errors"
             elif mean_total_cost < best_cost:
                 # There was an improvement in the mean cost - save the current state of the posterior
                 outcome = "Saving"
                 best_cost = mean_total_cost
-                best_state = self.state()
+                self.evaluate(self._save_best_state)
+                has_best_state = True
                 trials = 0
             else:
-                # The mean cost did not improve. 
-                if revert_post_trials > 0:
-                    # Continue until it has not improved for revert_post_trials epochs and then revert 
-                    trials += 1
-                    if trials < revert_post_trials:
-                        outcome = "Trial %i" % trials
-                    elif best_state is not None:
-                        self.set_state(best_state)
+                # The mean cost did not improve. Continue until it has not improved for max_trials
+                # epochs and then quench the learning rate, or for revert_post_trials epochs and
+                # then revert
+                trials += 1
+                if max_trials and trials >= max_trials and np.greater(*self.evaluate(self.learning_rate, self.lr_min)):
+                    self.evaluate(self._quench_lr)
+                    outcome = "Quench"
+                    trials = 0
+                elif revert_post_trials > 0 and trials >= revert_post_trials:
+                    if has_best_state:
+                        self.evaluate(self._restore_best_state)
+                        active = self._reset_convergence(active, conv_trials)
                         outcome = "Revert"
-                        trials = 0
                     else:
                         outcome = "Continue - No best state"
-                        trials = 0
+                    trials = 0
+                elif revert_post_trials > 0 or max_trials:
+                    outcome = "Trial %i" % trials
                 else:
                     outcome = "Not saving"
 
-            if epoch % display_step == 0:
-                state_str = "mean cost=%f (latent=%f, reconstr=%f) mean params=%s mean_var=%s lr=%f, ss=%i" % (
-                    mean_total_cost, mean_total_latent, mean_total_reconst, mean_params, mean_var, current_lr, current_ss)
+            converged = conv_trials >= voxel_conv_trials
+            if epoch < block_end:
+                # Voxels can only be frozen at the end of each group of epochs trained in the graph
+                pass
+            elif voxel_conv_tol is not None and np.all(converged):
+                outcome += " - Converged"
+                last_epoch, stop_reason = epoch, "converged"
+            elif self._voxel_conv and np.any(converged & active):
+                # Freeze newly converged voxels
+                active = ~converged
+                self._set_active_voxels(active, total_reconstr, total_latent)
+
+            if self._adaptive_ss and epoch == block_end and not err:
+                # Share the sample budget between voxels based on the variance of their
+                # reconstruction cost
+                budget = int(round(self.evaluate(self.sample_size) * n_voxels))
+                voxel_std = np.sqrt(self.evaluate(self.reconstr_var))
+                self._set_voxel_sample_size(allocate_samples(voxel_std, budget, ss_min, ss_max,
+                                                             pairs=self._sampling == "antithetic"))
+
+            # Change in the mean cost and parameters over the convergence window. Epochs with
+            # numerical errors restart the window
+            if err or np.isnan(mean_total_cost) or np.any(np.isnan(mean_params)):
+                window.clear()
+            elif epoch >= fit_only_epochs:
+                window.append((mean_total_cost, mean_params))
+
+            if epoch < block_end or last_epoch == epoch:
+                # Training can only stop at the end of each group of epochs trained in the graph
+                pass
+            elif conv_tol is not None and len(window) == window.maxlen and self._window_converged(window, conv_tol):
+                outcome += " - Converged"
+                last_epoch, stop_reason = epoch, "converged"
+            elif time_limit is not None and time.time() - run_start_time >= time_limit:
+                outcome += " - Time limit"
+                last_epoch, stop_reason = epoch, "time_limit"
+
+            if epoch % display_step == 0 or last_epoch == epoch:
+                state_str = "mean cost=%f (latent=%f, reconstr=%f)" % (
+                    mean_total_cost, mean_total_latent, mean_total_reconst)
+                if params is not None:
+                    state_str += " mean params=%s" % mean_params
+                if "var" in diagnostics:
+                    state_str += " mean_var=%s" % np.mean(diagnostics["var"], axis=0)
+                if "lr" in diagnostics:
+                    state_str += " lr=%f" % diagnostics["lr"]
+                if "ss" in diagnostics:
+                    state_str += " ss=%i" % diagnostics["ss"]
+                if self._voxel_conv:
+                    state_str += " active=%i" % np.count_nonzero(active)
+                if self._adaptive_ss:
+                    voxel_ss = self.evaluate(self.voxel_ss)
+                    state_str += " voxel_ss=%i-%i" % (np.min(voxel_ss), np.max(voxel_ss))
                 self.log.info(" - Epoch %04d: %s - %s", (epoch+1), state_str, outcome)
 
             epoch_end_time = time.time()
-            training_history["runtime"][epoch] = float(epoch_end_time - start_time)
-
-        if revert_post_final and best_state is not None:
+            training_history.record(epoch, total_cost, params, float(epoch_end_time - start_time),
+                                    last=(last_epoch == epoch))
+
+            # Checkpoints are saved at the end of each group of epochs trained in the graph
+            if checkpoint is not None and epoch == block_end and not err and (
+                    epoch + 1 - last_checkpoint >= checkpoint_step or last_epoch == epoch):
+                checkpoint.save(self.sess, epoch, {
+                    "epoch" : epoch,
+                    "n_voxels" : n_voxels,
+                    "n_timepoints" : n_timepoints,
+                    "epochs" : epochs,
+                    "runtime" : float(epoch_end_time - start_time),
+                    "trials" : trials,
+                    "best_cost" : best_cost,
+                    "has_best_state" : has_best_state,
+                    "latent_weight" : latent_weight,
+                    "conv_trials" : conv_trials,
+                    "active" : active,
+                    "prev_cost" : prev_cost,
+                    "prev_params" : prev_params,
+                    "window" : list(window),
+                    "last_epoch" : last_epoch,
+                    "stop_reason" : stop_reason,
+                    "history" : training_history.state(),
+                })
+                last_checkpoint = epoch + 1
+
+            if last_epoch == epoch:
+                break
+
+        if self._profiler is not None:
+            self._profiler.close()
+            self._profiler = None
+
+        if (revert_post_final or stop_reason != "epochs") and has_best_state:
             # At the end of training we revert to the state with best mean cost and write a final history step
             # with these values. Note that the cost may not be as reported earlier as this was based on a
             # mean over the training batches whereas here we recalculate the cost for the whole data set.
+            # This is always done when training stops early
             self.log.info("Reverting to best batch-averaged cost")
-            self.set_state(best_state)
+            self.evaluate(self._restore_best_state)
+
+        if not np.all(active):
+            # Final cost is calculated for all voxels
+            self._reset_convergence(active, conv_trials)
 
         self.feed_dict[self.data_train] = data
         self.feed_dict[self.tpts_train] = tpts
-        cost = self.evaluate(self.cost) # [W]
-        params = self.evaluate(self.model_means) # [P, W]
+        cost, params = self.evaluate(self.cost, self.model_means) # [W], [P, W]
         
         self.log.info(" - Best batch-averaged cost: %f", best_cost)
         self.log.info(" - Final cost across full data: %f", np.mean(cost))
         self.log.info(" - Final params: %s", np.mean(params, axis=1))
 
-        training_history["mean_cost"][-1] = np.mean(cost)
-        training_history["voxel_cost"][:, -1] = cost
-        training_history["mean_params"][-1, :] = np.mean(params, axis=1)
-        training_history["voxel_params"][:, -1, :] = params.transpose()
+        if last_epoch < epochs - 1:
+            # The history of the remaining epochs repeats the last epoch
+            self.log.info(" - Training stopped after %i epochs: %s", last_epoch+1, stop_reason)
+        training_history.final(cost, params, float(time.time() - start_time), stop_reason=stop_reason)
 
         # Return training history
-        return training_history
+        return training_history.close()
+
+    def _window_converged(self, window, tol):
+        """
+        :param window: Sequence of (mean cost, mean parameters) tuples for consecutive epochs
+        :param tol: Relative tolerance
+
+        :return: True if the mean cost and parameters at the end of the window are within the
+                 relative tolerance of their values at the start
+        """
+        start_cost, start_params = window[0]
+        end_cost, end_params = window[-1]
+        return (np.abs(end_cost - start_cost) <= tol * np.abs(start_cost) and
+                np.all(np.abs(end_params - start_params) <= tol * np.abs(start_params)))
+
+    def _set_active_voxels(self, active, reconstr, latent):
+        """
+        Set the active voxels, freezing inactive voxels at the given costs
+
+        :param active: Boolean Numpy array [V], True for active voxels
+        :param reconstr: Numpy array [V] of reconstruction cost to hold frozen voxels at
+        :param latent: Numpy array [V] of latent cost to hold frozen voxels at
+        """
+        feed_dict = dict(self.feed_dict)
+        feed_dict.update({
+            self._active_voxels_in : active.astype(np.float32),
+            self._frozen_reconstr_in : np.where(active, 0, reconstr),
+            self._frozen_latent_in : np.where(active, 0, latent),
+        })
+        self.sess.run(self._set_active, feed_dict=feed_dict)
+        self.sess.run(self._freeze)
+
+    def _set_voxel_sample_size(self, voxel_ss):
+        """
+        Set the number of samples used for each voxel with adaptive sample size
+
+        :param voxel_ss: Numpy integer array [V]
+        """
+        feed_dict = dict(self.feed_dict)
+        feed_dict[self._voxel_ss_in] = voxel_ss
+        self.sess.run(self._set_voxel_ss, feed_dict=feed_dict)
+
+    def _reset_convergence(self, active, conv_trials):
+        """
+        Make all voxels active again, e.g. after the posterior has been reverted
+
+        :return: New active voxel array
+        """
+        conv_trials[:] = 0
+        active = np.ones_like(active)
+        if self._voxel_conv:
+            self._set_active_voxels(active, np.zeros(active.shape), np.zeros(active.shape))
+        return active
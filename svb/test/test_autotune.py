@@ -0,0 +1,52 @@
+"""
+Tests for automatic tuning of training throughput
+"""
+import json
+
+import numpy as np
+
+from svb import DataModel
+from svb.models.exp import ExpModel
+from svb.autotune import candidate_configs, subsample, autotune, _run_trials, BATCH_SIZES, SAMPLE_SIZES
+
+def test_candidates():
+    """ Candidates include the requested sizes and batch sizes smaller than the data """
+    threads, sizes = candidate_configs(30, batch_size=15, sample_size=7)
+    assert threads[0] == 1
+    assert sorted(set([batch_size for batch_size, _sample_size in sizes]), key=lambda size: size or 0) == [None, 10, 15, 20]
+    assert sorted(set([sample_size for _batch_size, sample_size in sizes])) == sorted(SAMPLE_SIZES + (7,))
+
+def test_candidates_options():
+    """ SAA uses the full data and threads are not tuned with multiple workers """
+    threads, sizes = candidate_configs(1000, optimizer="saa", workers=4)
+    assert threads == [None]
+    assert sizes == [(None, sample_size) for sample_size in SAMPLE_SIZES]
+    assert len(candidate_configs(1000)[1]) == (len(BATCH_SIZES) + 1) * len(SAMPLE_SIZES)
+
+def test_subsample():
+    """ The subsample is a contiguous block from the middle of the voxels """
+    assert list(subsample(10, 4)) == [3, 4, 5, 6]
+    assert list(subsample(3, 4)) == [0, 1, 2]
+
+def test_cache(tmp_path):
+    """ A configuration in the cache is used without tuning """
+    cache = str(tmp_path / "tuned.json")
+    config = {"batch_size" : 10, "sample_size" : 5, "intra_op_threads" : 2}
+    with open(cache, "w") as cache_file:
+        json.dump({"key" : config}, cache_file)
+    assert autotune(None, ExpModel, None, cache=cache, key="key") == config
+
+def test_trials():
+    """ Trials measure the rate of cost reduction of each configuration """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.1, size=(4, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    kwargs = {"dt" : 0.25, "epochs" : 3, "display_step" : 3, "history" : "mean", "log_level" : "WARNING", "v1_graph_mode" : False,
+              "sampling" : "crn", "seed" : 1}
+    trials = _run_trials((data_model, ExpModel, tpts, 1, [(None, 5), (10, 2)], kwargs))
+    assert [trial["config"] for trial in trials] == [
+        {"batch_size" : None, "sample_size" : 5, "intra_op_threads" : 1},
+        {"batch_size" : 10, "sample_size" : 2, "intra_op_threads" : 1},
+    ]
+    assert all([trial["cost_rate"] is None or trial["cost_rate"] > 0 for trial in trials])
+    assert trials[0]["cost_rate"] is not None
@@ -0,0 +1,50 @@
+"""
+Tests for analytic (linearised) variational Bayes
+"""
+import numpy as np
+import pytest
+
+from svb import DataModel, AvbFit
+from svb.models.misc import PolyModel
+from svb.models.exp import ExpModel
+
+def test_avb_linear():
+    """ For a linear model the posterior converges to the least squares fit """
+    rng = np.random.RandomState(1)
+    tpts = np.arange(50, dtype=np.float32) * 0.1
+    data = 3 + 2 * tpts + rng.normal(0, 0.5, size=(4, 1, 1, 50))
+    data_model = DataModel(data.astype(np.float32))
+    model = PolyModel(data_model, dt=0.1, degree=2)
+    fit = AvbFit(data_model, model)
+    fit.train(model.tpts(), data_model.data_flattened, epochs=10)
+    results = fit.results()
+
+    design = np.stack([np.ones_like(tpts), tpts], axis=1)
+    for voxel in range(4):
+        coeffs, ssq = np.linalg.lstsq(design, data_model.data_flattened[voxel], rcond=None)[:2]
+        assert np.allclose(results["mean"][:2, voxel], coeffs, rtol=1e-3)
+        assert np.allclose(results["post_cov"][voxel, :2, :2], ssq / 48 * np.linalg.inv(design.T.dot(design)), rtol=1e-3)
+    assert np.allclose(results["mean"][-1], 0.25, rtol=0.5)
+
+def test_avb_nonlinear():
+    """ Parameters of a nonlinear model are recovered by iterating the linearised updates """
+    rng = np.random.RandomState(1)
+    tpts = np.arange(50, dtype=np.float32) * 0.1
+    data = 10 * np.exp(-1.5 * tpts) + rng.normal(0, 0.1, size=(4, 1, 1, 50))
+    data_model = DataModel(data.astype(np.float32))
+    model = ExpModel(data_model, dt=0.1)
+    fit = AvbFit(data_model, model)
+    history = fit.train(model.tpts(), data_model.data_flattened, epochs=20, conv_tol=1e-6)
+    results = fit.results()
+    assert np.allclose(results["mean"][0], 10, rtol=0.02)
+    assert np.allclose(results["mean"][1], 1.5, rtol=0.02)
+    assert np.allclose(results["modelfit"], 10 * np.exp(-1.5 * tpts), atol=0.1)
+    assert history["stop_reason"] == "converged"
+    assert history["mean_cost"][-1] < history["mean_cost"][0]
+
+def test_avb_spatial_prior():
+    """ Spatial priors are not supported """
+    data_model = DataModel(np.ones((4, 1, 1, 10), dtype=np.float32))
+    model = ExpModel(data_model, param_overrides={"amp1" : {"prior_type" : "M"}})
+    with pytest.raises(ValueError):
+        AvbFit(data_model, model)
@@ -0,0 +1,118 @@
+"""
+Tests for the benchmark suite
+"""
+import numpy as np
+
+from svb.benchmark import synthetic_data, sweep_configs, compare_results
+from svb.benchmark.scaling import DEFAULT_SWEEP, run_config, _epochs_to_tol
+from svb.benchmark.components import COMPONENTS, component_configs, component_scaling, time_component
+
+def test_synthetic_data():
+    """ Synthetic data has the requested number of unmasked voxels in a square slice """
+    data, mask, dt, params = synthetic_data("biexp", 10, 20, noise_sd=0)
+    assert data.shape == (4, 3, 1, 20)
+    assert np.count_nonzero(mask) == 10
+    assert np.allclose(data[0, 0, 0, 0], params["amp1"] + params["amp2"])
+    assert np.allclose(data[0, 0, 0, 1], 10 * np.exp(-dt) + 10 * np.exp(-10 * dt))
+    assert np.all(data[mask == 0] == 0)
+
+def test_sweep_axis():
+    """ Axis sweeps vary each option in turn from the base configuration """
+    configs = sweep_configs([("n_voxels", [10, 100, 1000]), ("infer_covar", [False, True])])
+    assert len(configs) == 4
+    assert [config["n_voxels"] for config in configs] == [10, 100, 1000, 10]
+    assert [config["infer_covar"] for config in configs] == [False, False, False, True]
+    assert all([config["model"] == DEFAULT_SWEEP[0][1][0] for config in configs])
+
+def test_sweep_grid():
+    """ Grid sweeps include every combination of options """
+    configs = sweep_configs([("n_voxels", [10, 100, 1000]), ("infer_covar", [False, True])], mode="grid")
+    assert len(configs) == 6
+    assert len(set([(config["n_voxels"], config["infer_covar"]) for config in configs])) == 6
+
+def test_epochs_to_tol():
+    """ Epochs to tolerance counts the epochs until the cost is within tolerance of the best cost """
+    assert _epochs_to_tol(np.array([100.0, 50.0, 10.5, 10.0, 10.2]), 0.1) == 3
+    assert _epochs_to_tol(np.array([np.nan, np.nan]), 0.1) is None
+
+def test_compare_results():
+    """ Comparison matches runs by configuration and averages repeats """
+    config = sweep_configs([("n_voxels", [10])])[0]
+    other_config = dict(config, n_voxels=20)
+    old = {"runs" : [
+        {"config" : config, "repeat" : 0, "metrics" : {"steps_per_sec" : 10.0, "peak_memory_mb" : 100.0}},
+        {"config" : config, "repeat" : 1, "metrics" : {"steps_per_sec" : 20.0, "peak_memory_mb" : 100.0}},
+        {"config" : other_config, "repeat" : 0, "metrics" : {"steps_per_sec" : 10.0}},
+    ]}
+    new = {"runs" : [
+        {"config" : config, "repeat" : 0, "metrics" : {"steps_per_sec" : 30.0, "peak_memory_mb" : 200.0}},
+        {"config" : other_config, "repeat" : 0, "metrics" : {"error" : "Out of memory"}},
+    ]}
+    comparison = compare_results(old, new)
+    assert len(comparison) == 1
+    changes = comparison[0][1]
+    assert changes["steps_per_sec"] == (15.0, 30.0, 2.0, True)
+    assert changes["peak_memory_mb"] == (100.0, 200.0, 2.0, False)
+
+def test_run_config():
+    """ A benchmark run reports the throughput metrics """
+    config = sweep_configs([("n_voxels", [4]), ("n_tpts", [10]), ("batch_size", [5]), ("sample_size", [3])])[0]
+    metrics = run_config(config, epochs=3)
+    assert metrics["steps"] == 6
+    assert np.isclose(metrics["voxel_samples_per_sec"], metrics["steps_per_sec"] * 12)
+    assert metrics["peak_memory_mb"] >= metrics["baseline_memory_mb"] > 0
+    assert 1 <= metrics["epochs_to_tol"] <= 3
+
+def test_run_config_optimizer():
+    """ The optimizer is a benchmark option and SAA always takes one step per epoch """
+    assert ("optimizer", ["adam", "natgrad", "saa"]) in DEFAULT_SWEEP
+    config = sweep_configs([("n_voxels", [4]), ("n_tpts", [10]), ("batch_size", [5]), ("sample_size", [3]), ("optimizer", ["saa"])])[0]
+    metrics = run_config(config, epochs=3)
+    assert metrics["steps"] == 3
+    assert np.isfinite(metrics["final_cost"])
+
+def test_run_config_engine():
+    """ The training engine is a benchmark option """
+    assert ("engine", ["session", "xla"]) in DEFAULT_SWEEP
+    config = sweep_configs([("n_voxels", [4]), ("n_tpts", [10]), ("batch_size", [5]), ("sample_size", [3]), ("engine", ["xla"])])[0]
+    metrics = run_config(config, epochs=3)
+    assert metrics["steps"] == 6
+    assert np.isfinite(metrics["final_cost"])
+
+def test_run_config_voxel_conv():
+    """ Per-voxel convergence is a benchmark option and is supported with each engine """
+    assert ("voxel_conv_tol", [0, 0.01]) in DEFAULT_SWEEP
+    for engine in ("session", "xla"):
+        config = sweep_configs([("n_voxels", [4]), ("n_tpts", [10]), ("sample_size", [3]), ("engine", [engine]),
+                                ("voxel_conv_tol", [0.01])])[0]
+        metrics = run_config(config, epochs=3)
+        assert metrics["steps"] == 3
+        assert np.isfinite(metrics["final_cost"])
+
+def test_component_configs():
+    """ Components are only run over the sizes they use """
+    configs = component_configs(["normal_sample", "latent_loss"], [("n_vertices", [10, 100]), ("n_params", [2, 3, 4])])
+    assert [config["component"] for config in configs] == ["normal_sample"] * 4 + ["latent_loss"] * 4
+    assert configs[0] == {"component" : "normal_sample", "n_vertices" : 10, "sample_size" : 5}
+    assert configs[4] == {"component" : "latent_loss", "n_vertices" : 10, "n_params" : 2}
+    assert len(component_configs(["mvn_sample"], [("n_vertices", [10, 100]), ("n_params", [2, 3])], mode="grid")) == 12
+
+def test_component_scaling():
+    """ Scaling exponents are fitted to runs where only one size varies """
+    runs = []
+    for config in component_configs(["mvn_sample"], [("n_vertices", [10, 100, 1000]), ("n_params", [2, 4])], mode="grid"):
+        time_per_call = 1e-6 * config["n_vertices"] * config["n_params"] ** 2 * config["sample_size"] ** 0.5
+        runs.append({"config" : config, "metrics" : {"time_per_call" : time_per_call}})
+    runs.append({"config" : dict(runs[0]["config"], n_vertices=10000), "metrics" : {"error" : "Out of memory"}})
+    scaling = component_scaling(runs)["mvn_sample"]
+    assert np.isclose(scaling["n_vertices"], 1)
+    assert np.isclose(scaling["n_params"], 2)
+    assert np.isclose(scaling["sample_size"], 0.5)
+
+def test_time_components():
+    """ Every component can be timed with and without its gradients """
+    sizes = {"n_vertices" : 9, "n_params" : 2, "sample_size" : 3, "batch_size" : 4}
+    for name in COMPONENTS:
+        for gradients in (False, True):
+            metrics = time_component(name, sizes, calls=2, warmup=1, gradients=gradients)
+            assert metrics["time_per_call"] >= metrics["min_time_per_call"] > 0
@@ -0,0 +1,73 @@
+"""
+Tests for saving and restoring checkpoints
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb import DataModel, SvbFit
+from svb.checkpoint import Checkpoint
+from svb.models.exp import ExpModel
+
+def test_save_restore(tmpdir):
+    """ Graph variables and training state are restored from the latest checkpoint """
+    with tf.Graph().as_default():
+        var = tf.Variable(np.zeros([3], dtype=np.float32))
+        value = tf.placeholder(tf.float32, [3])
+        assign = var.assign(value)
+        saver = tf.train.Saver(max_to_keep=2)
+        with tf.Session() as sess:
+            checkpoint = Checkpoint(str(tmpdir), saver)
+            assert checkpoint.restore(sess) is None
+            for epoch in range(3):
+                sess.run(assign, {value : np.full([3], epoch)})
+                checkpoint.save(sess, epoch, {"epoch" : epoch})
+
+            sess.run(assign, {value : np.full([3], -1)})
+            assert checkpoint.restore(sess) == {"epoch" : 2}
+            assert np.allclose(sess.run(var), 2)
+
+    # Only the training state of the checkpoints kept by the saver remains
+    assert sorted(fname for fname in os.listdir(str(tmpdir)) if fname.endswith(".pkl")) == ["ckpt-2.pkl", "ckpt-3.pkl"]
+
+def test_resume_training(tmpdir):
+    """ Training interrupted and resumed from a checkpoint matches uninterrupted training """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.1, size=(4, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    options = dict(epochs=30, learning_rate=0.1, display_step=30, revert_post_trials=5)
+
+    expected = SvbFit(data_model, ExpModel(data_model, dt=0.25), sampling="crn", seed=1)
+    expected_history = expected.train(tpts, data_model.data_flattened, **options)
+
+    # Interrupt training during epoch 13, after the checkpoint at epoch 10
+    checkpoint_dir = str(tmpdir.join("checkpoint"))
+    svb = SvbFit(data_model, ExpModel(data_model, dt=0.25), sampling="crn", seed=1)
+    fit_batch, calls = svb.fit_batch, []
+    def _fit_batch():
+        calls.append(1)
+        if len(calls) == 13:
+            raise KeyboardInterrupt()
+        return fit_batch()
+    svb.fit_batch = _fit_batch
+    with pytest.raises(KeyboardInterrupt):
+        svb.train(tpts, data_model.data_flattened, checkpoint_dir=checkpoint_dir, checkpoint_step=5, **options)
+    # Checkpoints do not include the history, which is streamed to the checkpoint directory
+    assert os.path.exists(os.path.join(checkpoint_dir, "history", "voxel_cost.npy"))
+    with open(os.path.join(checkpoint_dir, "ckpt-10.pkl"), "rb") as state_file:
+        assert pickle.load(state_file)["history"] == {"rows" : 10}
+
+    resumed = SvbFit(data_model, ExpModel(data_model, dt=0.25), sampling="crn", seed=1)
+    history = resumed.train(tpts, data_model.data_flattened, checkpoint_dir=checkpoint_dir, resume=True, **options)
+    assert np.allclose(resumed.evaluate(resumed.post.mean), expected.evaluate(expected.post.mean))
+    assert np.allclose(resumed.evaluate(resumed.post.var), expected.evaluate(expected.post.var))
+    assert history["stop_reason"] == expected_history["stop_reason"]
+    for key in ("epochs", "mean_cost", "mean_params", "voxel_cost", "voxel_params"):
+        assert np.allclose(history[key], expected_history[key], rtol=1e-5)
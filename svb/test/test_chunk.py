@@ -0,0 +1,121 @@
+"""
+Tests for fitting of voxel chunks
+"""
+import numpy as np
+
+from svb import DataModel, SvbFit
+from svb.models.exp import ExpModel
+from svb.chunk import voxel_chunks, merge, split, train_chunked
+
+def test_voxel_chunks_padded():
+    """ Voxel chunks cover all voxels and the last chunk is padded to the chunk size """
+    chunks = voxel_chunks(10, 4)
+    assert len(chunks) == 3
+    for indices, _n_real in chunks:
+        assert len(indices) == 4
+    assert [n_real for _indices, n_real in chunks] == [4, 4, 2]
+    assert list(chunks[2][0]) == [8, 9, 9, 9]
+    assert list(np.concatenate([indices[:n_real] for indices, n_real in chunks])) == list(range(10))
+
+def test_merge():
+    """ Merged histories and results are in voxel order """
+    histories, results = [], []
+    for start, end in [(0, 3), (3, 5)]:
+        nvoxels = end - start
+        histories.append({
+            "epochs" : np.arange(6),
+            "mean_cost" : np.zeros([6]),
+            "mean_params" : np.zeros([6, 2]),
+            "voxel_cost" : np.arange(start, end, dtype=np.float32).reshape(-1, 1) * np.ones([1, 6]),
+            "voxel_params" : np.arange(start, end, dtype=np.float32).reshape(-1, 1, 1) * np.ones([1, 6, 2]),
+            "runtime" : np.ones([6]),
+        })
+        results.append({
+            "mean" : np.ones([2, nvoxels]) * start,
+            "var" : np.ones([2, nvoxels]),
+            "modelfit" : np.ones([nvoxels, 10]),
+            "post_mean" : np.ones([nvoxels, 2]),
+            "post_cov" : np.ones([nvoxels, 2, 2]),
+        })
+
+    history, result = merge(histories, results)
+    assert np.allclose(history["voxel_cost"][:, 0], range(5))
+    assert np.allclose(history["mean_cost"], 2)
+    assert history["voxel_params"].shape == (5, 6, 2)
+    assert np.allclose(history["runtime"], 2)
+    assert result["mean"].shape == (2, 5)
+    assert np.allclose(result["mean"][0], [0, 0, 0, 3, 3])
+    assert result["post_cov"].shape == (5, 2, 2)
+
+def test_merge_mean_history():
+    """ Mean histories are combined weighted by the number of voxels """
+    histories, results = [], []
+    for start, end in [(0, 3), (3, 4)]:
+        nvoxels = end - start
+        histories.append({
+            "epochs" : np.array([0, 2, 4]),
+            "mean_cost" : np.array([start, start, 0]),
+            "mean_params" : np.ones([3, 2]) * start,
+            "voxel_cost" : np.ones([nvoxels, 1]) * start,
+            "voxel_params" : np.ones([nvoxels, 1, 2]) * start,
+            "runtime" : np.ones([3]),
+        })
+        results.append({
+            "mean" : np.ones([2, nvoxels]),
+            "var" : np.ones([2, nvoxels]),
+            "modelfit" : np.ones([nvoxels, 10]),
+            "post_mean" : np.ones([nvoxels, 2]),
+            "post_cov" : np.ones([nvoxels, 2, 2]),
+        })
+
+    history, _result = merge(histories, results, parallel=True)
+    assert np.allclose(history["epochs"], [0, 2, 4])
+    assert np.allclose(history["mean_cost"], [0.75, 0.75, 0.75])
+    assert np.allclose(history["mean_params"][:, 0], 0.75)
+    assert history["voxel_cost"].shape == (4, 1)
+    assert np.allclose(history["runtime"], 1)
+
+def test_split():
+    """ Split histories and results contain the voxels of each set with their own means """
+    history = {
+        "epochs" : np.arange(6),
+        "mean_cost" : np.zeros([6]),
+        "mean_params" : np.zeros([6, 2]),
+        "voxel_cost" : np.arange(5, dtype=np.float32).reshape(-1, 1) * np.ones([1, 6]),
+        "voxel_params" : np.arange(5, dtype=np.float32).reshape(-1, 1, 1) * np.ones([1, 6, 2]),
+        "runtime" : np.ones([6]),
+    }
+    results = {
+        "mean" : np.arange(5) * np.ones([2, 1]),
+        "var" : np.ones([2, 5]),
+        "modelfit" : np.ones([5, 10]),
+        "post_mean" : np.ones([5, 2]),
+        "post_cov" : np.ones([5, 2, 2]),
+    }
+    outputs = split(history, results, [3, 2])
+    assert len(outputs) == 2
+    history1, results1 = outputs[1]
+    assert np.allclose(history1["voxel_cost"][:, 0], [3, 4])
+    assert np.allclose(history1["mean_cost"], 3.5)
+    assert np.allclose(results1["mean"], [[3, 4], [3, 4]])
+    assert results1["post_cov"].shape == (2, 2, 2)
+    assert outputs[0][1]["modelfit"].shape == (3, 10)
+
+def test_train_chunked():
+    """ Chunked training gives the same posterior means as fitting all voxels together """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.5, size=(6, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    kwargs = {"dt" : 0.25, "sampling" : "crn", "seed" : 1, "epochs" : 200, "display_step" : 200, "sample_size" : 20}
+    _svb, history, results = train_chunked(data_model, ExpModel, tpts, 4, **kwargs)
+    svb = SvbFit(data_model, ExpModel(data_model, **kwargs), **kwargs)
+    svb.train(tpts, data_model.data_flattened, **kwargs)
+    full_results = svb.results()
+
+    assert results["mean"].shape == (3, 6)
+    assert history["voxel_cost"].shape[0] == 6
+    # Voxels in the first chunk have the same common random numbers as in the full fit
+    assert np.allclose(results["mean"][:, :4], full_results["mean"][:, :4], rtol=1e-4)
+    # The draws of voxels in later chunks differ so only the model parameters are compared
+    # within a tolerance. The noise is less well determined
+    assert np.allclose(results["mean"][:2, 4:], full_results["mean"][:2, 4:], rtol=0.02)
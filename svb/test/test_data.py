@@ -0,0 +1,56 @@
+"""
+Tests for the data model
+"""
+import numpy as np
+
+from svb.data import DataModel, StackedDataModel
+
+def test_voxel_subset():
+    """ Voxel subset contains the selected voxel data """
+    data = np.random.normal(size=[2, 3, 4, 10])
+    data_model = DataModel(data)
+    subset = data_model.voxel_subset([3, 4, 5])
+    assert subset.n_unmasked_voxels == 3
+    assert subset.n_vertices == 3
+    assert np.allclose(subset.data_flattened, data_model.data_flattened[3:6])
+    assert subset.n_tpts == 10
+
+def test_voxel_subset_neighbours():
+    """ Neighbour lists of a voxel subset are restricted to the subset and re-indexed """
+    data = np.random.normal(size=[1, 1, 5, 10])
+    data_model = DataModel(data)
+    subset = data_model.voxel_subset([1, 2, 3, 3])
+    assert sorted(subset.indices_nn) == [[0, 1], [1, 0], [1, 2], [2, 1]]
+    assert sorted(subset.indices_n2) == [[0, 2], [2, 0]]
+
+def test_voxel_subset_post_init():
+    """ Initial posterior of a voxel subset is the subset of the initial posterior """
+    data = np.random.normal(size=[1, 1, 5, 10])
+    mean = np.random.normal(size=[5, 2])
+    cov = np.random.normal(size=[5, 2, 2])
+    data_model = DataModel(data, initial_posterior=(mean, cov))
+    subset = data_model.voxel_subset([4, 0])
+    assert np.allclose(subset.post_init[0], mean[[4, 0]])
+    assert np.allclose(subset.post_init[1], cov[[4, 0]])
+
+def test_stacked_neighbours():
+    """ Neighbour lists of stacked data sets are block-diagonal """
+    data = [np.random.normal(size=[1, 1, 3, 10]), np.random.normal(size=[1, 1, 2, 10])]
+    data_model = StackedDataModel(data)
+    assert data_model.n_unmasked_voxels == 5
+    assert data_model.n_subject_voxels == [3, 2]
+    assert np.allclose(data_model.data_flattened[3:], data[1].reshape(-1, 10))
+    assert sorted(data_model.indices_nn) == [[0, 1], [1, 0], [1, 2], [2, 1], [3, 4], [4, 3]]
+    assert sorted(data_model.indices_n2) == [[0, 2], [2, 0]]
+
+def test_stacked_tpts():
+    """ Masked data sets are stacked and time points are stacked voxelwise """
+    data = [np.random.normal(size=[1, 1, 3, 10]), np.random.normal(size=[1, 2, 2, 10])]
+    mask = [None, np.array([[[1.0, 0.0], [1.0, 1.0]]])]
+    data_model = StackedDataModel(data, mask)
+    assert data_model.n_subject_voxels == [3, 3]
+    assert np.allclose(data_model.data_flattened[3:], data_model.subjects[1].data_flattened)
+    tpts = data_model.stack_tpts([np.arange(10), np.arange(10) * 2])
+    assert tpts.shape == (6, 10)
+    assert np.allclose(tpts[4], np.arange(10) * 2)
+    assert data_model.stack_tpts([np.arange(10), np.arange(10)]).shape == (10,)
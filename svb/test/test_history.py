@@ -0,0 +1,92 @@
+"""
+Tests for recording of the training history
+"""
+import numpy as np
+
+from svb.history import TrainingHistory
+
+def _record(history, epochs, n_voxels=4, n_params=2, last=None):
+    for epoch in range(epochs):
+        cost = np.full([n_voxels], epoch, dtype=np.float32)
+        params = np.full([n_params, n_voxels], epoch, dtype=np.float32)
+        history.record(epoch, cost, params, runtime=epoch, last=(epoch == last))
+        if epoch == last:
+            break
+    history.final(np.full([n_voxels], -1), np.full([n_params, n_voxels], -1), runtime=epochs)
+    return history.close()
+
+def test_full_history():
+    """ Full history records voxelwise values for every epoch plus the final values """
+    history = _record(TrainingHistory(4, 2, 5), 5)
+    assert np.allclose(history["epochs"], [0, 1, 2, 3, 4, 5])
+    assert history["voxel_cost"].shape == (4, 6)
+    assert history["voxel_params"].shape == (4, 6, 2)
+    assert np.allclose(history["voxel_cost"][0], [0, 1, 2, 3, 4, -1])
+    assert np.allclose(history["mean_params"][:, 1], [0, 1, 2, 3, 4, -1])
+
+def test_history_step():
+    """ History can be recorded every k epochs """
+    history = _record(TrainingHistory(4, 2, 7, step=3), 7)
+    assert np.allclose(history["epochs"], [0, 3, 6, 7])
+    assert np.allclose(history["voxel_cost"][2], [0, 3, 6, -1])
+    assert np.allclose(history["runtime"], [0, 3, 6, 7])
+
+def test_mean_history():
+    """ Mean history only records the final voxelwise values """
+    history = _record(TrainingHistory(4, 2, 5, mode="mean"), 5)
+    assert np.allclose(history["mean_cost"], [0, 1, 2, 3, 4, -1])
+    assert history["voxel_cost"].shape == (4, 1)
+    assert np.allclose(history["voxel_params"], -1)
+
+def test_history_off():
+    """ With history off only the final values are recorded """
+    history = _record(TrainingHistory(4, 2, 5, mode="off"), 5)
+    assert np.allclose(history["epochs"], [5])
+    assert np.allclose(history["mean_cost"], [-1])
+    assert history["voxel_params"].shape == (4, 1, 2)
+
+def test_history_last_epoch():
+    """ If training stops early the last epoch is repeated for the remaining epochs """
+    history = _record(TrainingHistory(4, 2, 6), 6, last=2)
+    assert np.allclose(history["voxel_cost"][1], [0, 1, 2, 2, 2, 2, -1])
+    assert np.allclose(history["runtime"], [0, 1, 2, 2, 2, 2, 6])
+
+def test_streamed_history(tmpdir):
+    """ Streamed history is written to disk and matches in-memory history """
+    in_memory = _record(TrainingHistory(4, 2, 6, step=2), 6, last=3)
+    streamed = _record(TrainingHistory(4, 2, 6, step=2, outdir=str(tmpdir)), 6, last=3)
+    assert tmpdir.join("voxel_cost.npy").check()
+    assert tmpdir.join("voxel_params.npy").check()
+    assert in_memory.pop("stop_reason") == streamed.pop("stop_reason")
+    for key in in_memory:
+        assert np.allclose(in_memory[key], streamed[key])
+
+def test_stop_reason():
+    """ The reason training stopped is recorded with the final values """
+    history = _record(TrainingHistory(4, 2, 5), 5)
+    assert history["stop_reason"] == "epochs"
+
+    history = TrainingHistory(4, 2, 5)
+    history.record(0, np.zeros([4]), np.zeros([2, 4]), last=True)
+    history.final(np.zeros([4]), np.zeros([2, 4]), stop_reason="time_limit")
+    assert history.close()["stop_reason"] == "time_limit"
+
+def test_resume_history(tmpdir):
+    """ History continued from a saved state matches uninterrupted history """
+    for outdir in (None, str(tmpdir)):
+        expected = _record(TrainingHistory(4, 2, 6, step=2, outdir=outdir), 6)
+
+        history = TrainingHistory(4, 2, 6, step=2, outdir=outdir)
+        for epoch in range(3):
+            history.record(epoch, np.full([4], epoch), np.full([2, 4], epoch), runtime=epoch)
+        state = history.state()
+
+        resumed = TrainingHistory(4, 2, 6, step=2, outdir=outdir, resume=True)
+        resumed.set_state(state)
+        for epoch in range(3, 6):
+            resumed.record(epoch, np.full([4], epoch), np.full([2, 4], epoch), runtime=epoch)
+        resumed.final(np.full([4], -1), np.full([2, 4], -1), runtime=6)
+        resumed = resumed.close()
+        for key in expected:
+            if key != "stop_reason":
+                assert np.allclose(expected[key], resumed[key])
@@ -0,0 +1,46 @@
+"""
+Tests for batched L-BFGS minimization
+"""
+import numpy as np
+
+from svb.lbfgs import BatchedLbfgs
+
+def _rosenbrock(x, a=np.array([1.0, 2.0, 0.5])):
+    f = np.square(a - x[:, 0]) + 100 * np.square(x[:, 1] - np.square(x[:, 0]))
+    g = np.stack([-2 * (a - x[:, 0]) - 400 * x[:, 0] * (x[:, 1] - np.square(x[:, 0])),
+                  200 * (x[:, 1] - np.square(x[:, 0]))], axis=1)
+    return f, g, -x[:, 0]
+
+def test_rosenbrock():
+    """ Each voxel's function is minimized independently """
+    lbfgs = BatchedLbfgs(_rosenbrock)
+    x = np.zeros([3, 2])
+    for _step in range(100):
+        x, f, _g, aux = lbfgs.step(x)
+    assert np.allclose(x, [[1, 1], [2, 4], [0.5, 0.25]], atol=1e-4)
+    assert np.allclose(f, 0, atol=1e-8)
+    assert np.allclose(aux, -x[:, 0])
+
+def test_decrease():
+    """ The function value never increases """
+    lbfgs = BatchedLbfgs(_rosenbrock, memory=3)
+    x = np.zeros([3, 2])
+    prev = _rosenbrock(x)[0]
+    for _step in range(20):
+        x, f, _g, _aux = lbfgs.step(x)
+        assert np.all(f <= prev)
+        prev = f
+
+def test_quadratic():
+    """ A quadratic function is minimized in a few more steps than the number of dimensions """
+    precision = np.array([[4.0, 1.5, 0.5], [1.5, 2.0, 0.3], [0.5, 0.3, 1.0]])
+    def _quadratic(x):
+        diff = x - [1.0, -2.0, 3.0]
+        grad = np.dot(diff, precision)
+        return 0.5 * np.sum(diff * grad, axis=1), grad
+
+    lbfgs = BatchedLbfgs(_quadratic)
+    x = np.zeros([2, 3])
+    for _step in range(8):
+        x, f, _g = lbfgs.step(x)
+    assert np.allclose(x, [1.0, -2.0, 3.0], atol=1e-4)
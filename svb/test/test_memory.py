@@ -0,0 +1,70 @@
+"""
+Tests for the estimation of memory use
+"""
+import numpy as np
+
+from svb import DataModel
+from svb.models.exp import ExpModel
+from svb.memory import estimate_memory, fit_memory_budget, peak_sample_size, MIN_CHUNK_SIZE, MIN_BATCH_SIZE
+
+def _params(prior_type="N"):
+    data_model = DataModel(np.ones((4, 1, 1, 10), dtype=np.float32))
+    overrides = dict([(name, {"prior_type" : prior_type}) for name in ("amp1", "r1")])
+    return ExpModel(data_model, param_overrides=overrides).params
+
+def test_peak_sample_size():
+    """ The peak sample size follows the sample size schedule """
+    assert peak_sample_size(sample_size=10, ss_increase_factor=3) == 30
+    assert peak_sample_size(sample_size=10, ss_increase_factor=0.5) == 10
+    assert peak_sample_size(batch_size=20) == 20
+    assert peak_sample_size(sample_size=10, adaptive_ss=True, ss_max=15) == 15
+
+def test_estimate_scaling():
+    """ The sample and prediction memory scales with the voxels, samples and batch size """
+    params = _params()
+    base = estimate_memory(1000, 100, params, sample_size=10)
+    for kwargs in [{"voxel_chunk_size" : 500}, {"sample_size" : 5}, {"batch_size" : 50}, {"ss_increase_factor" : 0.5}]:
+        estimate = estimate_memory(1000, 100, params, **dict({"sample_size" : 10}, **kwargs))
+        expected = base["predictions"] if kwargs == {"ss_increase_factor" : 0.5} else base["predictions"] / 2
+        assert np.isclose(estimate["predictions"], expected)
+        assert np.isclose(estimate["data"], base["data"])
+    assert np.isclose(estimate_memory(1000, 100, params, sample_size=10, ss_increase_factor=2)["predictions"], base["predictions"] * 2)
+    assert estimate_memory(1000, 100, params, sample_size=10, infer_covar=True)["posterior"] > base["posterior"]
+    assert estimate_memory(1000, 100, params, sample_size=10, precision="float64")["total"] > base["total"]
+    assert np.isclose(estimate_memory(1000, 100, params, sample_size=10, precision="mixed")["predictions"], base["predictions"])
+    assert base["priors"] == 0
+    assert estimate_memory(1000, 100, _params("M"), sample_size=10)["priors"] > 0
+
+def test_budget_fits():
+    """ Options are not changed if the estimate is within the budget """
+    params = _params()
+    estimate = estimate_memory(1000, 100, params, sample_size=10)
+    changes, new_estimate = fit_memory_budget(estimate["total"] + 1, 1000, 100, params, sample_size=10)
+    assert changes == {}
+    assert new_estimate == estimate
+
+def test_budget_chunks():
+    """ Independent voxels are fitted in chunks to meet the budget """
+    params = _params()
+    budget = estimate_memory(100000, 100, params, sample_size=20, voxel_chunk_size=5000)["total"]
+    changes, estimate = fit_memory_budget(budget, 100000, 100, params, sample_size=20)
+    assert changes == {"voxel_chunk_size" : 5000}
+    assert estimate["total"] <= budget
+
+def test_budget_spatial():
+    """ With spatial priors the batch size and then the sample size are reduced """
+    params = _params("M")
+    budget = estimate_memory(10000, 100, params, sample_size=20, ss_increase_factor=2, batch_size=MIN_BATCH_SIZE)["total"] - 1
+    changes, estimate = fit_memory_budget(budget, 10000, 100, params, sample_size=20, ss_increase_factor=2)
+    assert changes["batch_size"] == MIN_BATCH_SIZE
+    assert "voxel_chunk_size" not in changes
+    assert "sample_size" not in changes
+    assert 1 < changes["ss_increase_factor"] < 2
+    assert estimate["total"] <= budget
+
+def test_budget_too_small():
+    """ The smallest options are used if the budget cannot be met """
+    params = _params()
+    changes, estimate = fit_memory_budget(1, 100000, 100, params, sample_size=20, adaptive_ss=True)
+    assert changes == {"voxel_chunk_size" : MIN_CHUNK_SIZE, "batch_size" : MIN_BATCH_SIZE, "ss_max" : 2, "sample_size" : 2}
+    assert estimate["total"] > 1
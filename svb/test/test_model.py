@@ -0,0 +1,67 @@
+"""
+Tests for linear models
+"""
+import numpy as np
+import pytest
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb import DataModel, SvbFit
+from svb.models.misc import PolyModel
+from svb.models.exp import ExpModel
+
+def test_design_matrix():
+    """ The model output is the design matrix applied to the parameters """
+    data_model = DataModel(np.zeros((2, 1, 1, 5), dtype=np.float32))
+    model = PolyModel(data_model, degree=3)
+    tpts = np.tile(np.arange(5, dtype=np.float32), (2, 1))
+    params = np.array([[1.0, 2.0, 3.0, 4.0], [-1.0, 0.5, 0.0, 2.0]], dtype=np.float32)
+    with tf.Session() as sess:
+        design = sess.run(model.design_matrix(tf.constant(tpts)))
+        expected = sess.run(model.evaluate([tf.constant(params[:, idx:idx+1]) for idx in range(4)],
+                                           tf.constant(tpts)))
+    assert design.shape == (2, 5, 4)
+    assert np.allclose(np.einsum("vbp,vp->vb", design, params), expected)
+
+def test_design_matrix_nonlinear():
+    """ Nonlinear models have no design matrix """
+    data_model = DataModel(np.zeros((2, 1, 1, 5), dtype=np.float32))
+    model = ExpModel(data_model)
+    assert not model.linear
+    with pytest.raises(NotImplementedError):
+        model.design_matrix(tf.zeros([1, 5]))
+
+def _poly_fit(data_model, **kwargs):
+    return SvbFit(data_model, PolyModel(data_model, degree=2), sampling="crn", seed=1, **kwargs)
+
+@pytest.mark.parametrize("infer_covar", [False, True])
+@pytest.mark.parametrize("batch_size", [None, 5])
+def test_analytic_reconstr_loss(infer_covar, batch_size):
+    """ The analytic reconstruction loss of a linear model matches the Monte Carlo estimate """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 1 + 0.5 * tpts + np.random.RandomState(0).normal(0, 0.3, size=(4, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    analytic = _poly_fit(data_model, infer_covar=infer_covar)
+    numerical = _poly_fit(data_model, infer_covar=infer_covar, force_num_reconstr_loss=True)
+    assert analytic.analytic_reconstr_loss and not numerical.analytic_reconstr_loss
+
+    # Compare the losses on a batch of data at a trained posterior. With common random
+    # numbers the noise samples are the same so only the model parameters add Monte Carlo noise
+    for svb in (analytic, numerical):
+        svb.train(tpts, data_model.data_flattened, epochs=20, batch_size=batch_size, learning_rate=0.05, display_step=20)
+    numerical.set_state(analytic.state())
+
+    # The parameter covariance contributes most of the expected sum of squares, so the
+    # tolerance allows for the Monte Carlo error but not for a missing covariance term
+    losses = []
+    for svb in (analytic, numerical):
+        svb.feed_dict.update({
+            svb.data_train : data_model.data_flattened[:, ::4] if batch_size else data_model.data_flattened,
+            svb.tpts_train : tpts[::4].reshape(1, -1) if batch_size else tpts.reshape(1, -1),
+            svb.initial_ss : 100000,
+        })
+        losses.append(svb.evaluate(svb.reconstr_loss))
+    assert np.allclose(losses[0], losses[1], rtol=2e-2)
@@ -0,0 +1,83 @@
+"""
+Tests for natural gradient steps of the posterior
+"""
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+import numpy as np
+import pytest
+
+from svb import DataModel, SvbFit
+from svb.models.exp import ExpModel
+from svb.posterior import NormalPosterior, FactorisedPosterior, MVNPosterior
+
+# Quadratic cost with a Gaussian optimal posterior
+PRECISION = np.array([[4.0, 1.5, 0.5], [1.5, 2.0, 0.3], [0.5, 0.3, 1.0]], dtype=np.float32)
+OPTIMUM = np.array([1.0, -2.0, 3.0], dtype=np.float32)
+
+def _fit(post_class, steps=10):
+    posts = [NormalPosterior(idx, tf.zeros([2]), tf.fill([2], 100.0), name="post%i" % idx,
+                             sampling="crn", seed=1)
+             for idx in range(3)]
+    post = post_class(posts, name="post", sampling="crn", seed=1)
+    diff = post.sample(5000) - OPTIMUM[np.newaxis, :, np.newaxis]
+    energy = 0.5 * tf.reduce_mean(tf.reduce_sum(diff * tf.einsum("ij,wjs->wis", PRECISION, diff), axis=1), axis=-1)
+    cost = tf.reduce_sum(energy + post.entropy())
+
+    variables = tf.trainable_variables()
+    grads = dict([(var.name, grad) for grad, var in zip(tf.gradients(cost, variables), variables)
+                  if grad is not None])
+    updates = post.natural_gradient_step(grads, 1.0)
+    values = [tf.identity(value) for value, _var in updates]
+    with tf.control_dependencies(values):
+        step = tf.group(*[tf.assign(var, value, validate_shape=False)
+                          for value, (_value, var) in zip(values, updates)])
+
+    cov = tf.matmul(post.cov_chol, post.cov_chol, transpose_b=True) if hasattr(post, "cov_chol") else post.cov
+    with tf.Session() as session:
+        session.run(tf.global_variables_initializer())
+        for _step in range(steps):
+            session.run(step)
+        return session.run([post.mean, cov])
+
+def test_natgrad_factorised():
+    """ Natural gradient steps with unit learning rate find the mean field optimum """
+    with tf.Graph().as_default():
+        mean, cov = _fit(FactorisedPosterior)
+    assert np.allclose(mean, OPTIMUM, atol=0.1)
+    assert np.allclose(np.diagonal(cov, axis1=1, axis2=2), 1 / np.diag(PRECISION), rtol=0.1)
+
+def test_natgrad_mvn():
+    """ Natural gradient steps with unit learning rate find the full covariance optimum """
+    with tf.Graph().as_default():
+        mean, cov = _fit(MVNPosterior)
+    assert np.allclose(mean, OPTIMUM, atol=0.1)
+    assert np.allclose(cov, np.linalg.inv(PRECISION), atol=0.05)
+
+def _train(optimizer, learning_rate, infer_covar, param_overrides):
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.1, size=(4, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    svb = SvbFit(data_model, ExpModel(data_model, dt=0.25, param_overrides=param_overrides),
+                 optimizer=optimizer, infer_covar=infer_covar, sampling="crn", seed=1)
+    history = svb.train(tpts, data_model.data_flattened, epochs=1000, learning_rate=learning_rate,
+                        conv_tol=1e-3, history="mean", display_step=1000)
+    assert history["stop_reason"] == "converged"
+    # Epochs after training stops repeat the runtime of the last epoch
+    epochs = int(np.argmax(history["runtime"][:-1])) + 1
+    return svb.evaluate(svb.post.mean), svb.evaluate(svb.post.var), epochs
+
+@pytest.mark.parametrize("infer_covar, param_overrides", [
+    (False, {}),
+    (True, {}),
+    (False, {"r1" : {"post_type" : "global"}}),
+])
+def test_natgrad_svb(infer_covar, param_overrides):
+    """ Training with natural gradient steps converges to the same posterior as Adam in fewer epochs """
+    natgrad_mean, natgrad_var, natgrad_epochs = _train("natgrad", 0.25, infer_covar, param_overrides)
+    adam_mean, adam_var, adam_epochs = _train("adam", 0.1, infer_covar, param_overrides)
+    assert np.allclose(natgrad_mean[:, :2], adam_mean[:, :2], atol=0.01)
+    assert np.allclose(natgrad_var[:, :2], adam_var[:, :2], rtol=0.5, atol=1e-5)
+    assert natgrad_epochs * 2 < adam_epochs
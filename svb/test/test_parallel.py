@@ -0,0 +1,41 @@
+"""
+Tests for parallel fitting of voxel shards
+"""
+import numpy as np
+
+from svb import DataModel, SvbFit
+from svb.models.exp import ExpModel
+from svb.parallel import shards, thread_budget, train_parallel
+
+def test_shards():
+    """ Shards are contiguous, cover all voxels and omit empty shards """
+    voxel_shards = shards(10, 3)
+    assert [len(indices) for indices in voxel_shards] == [4, 3, 3]
+    assert list(np.concatenate(voxel_shards)) == list(range(10))
+    assert len(shards(2, 4)) == 2
+
+def test_thread_budget():
+    """ Threads are shared between workers with at least one each """
+    assert thread_budget(4, 16) == 4
+    assert thread_budget(3, 16) == 5
+    assert thread_budget(8, 4) == 1
+
+def test_train_parallel():
+    """ Shards are fitted with the base seed plus the shard index and merged in voxel order """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.5, size=(5, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    kwargs = {"dt" : 0.25, "sampling" : "crn", "seed" : 3, "epochs" : 10, "display_step" : 10, "sample_size" : 5}
+    history, results = train_parallel(data_model, ExpModel, tpts, 2, **kwargs)
+    assert results["mean"].shape == (3, 5)
+    assert history["voxel_cost"].shape[0] == 5
+
+    for shard_idx, indices in enumerate(shards(5, 2)):
+        shard_means = []
+        for seed in (3 + shard_idx, 3 + 1 - shard_idx):
+            subset = data_model.voxel_subset(indices)
+            svb = SvbFit(subset, ExpModel(subset, **kwargs), **dict(kwargs, seed=seed))
+            svb.train(tpts, subset.data_flattened, **kwargs)
+            shard_means.append(svb.results()["mean"])
+        assert np.allclose(results["mean"][:, indices], shard_means[0])
+        assert not np.allclose(results["mean"][:, indices], shard_means[1])
@@ -0,0 +1,17 @@
+"""
+Tests for model parameters
+"""
+from svb.parameter import get_parameter, voxels_independent
+
+def test_voxels_independent():
+    """ Non-spatial priors and voxelwise posteriors can be fitted voxel by voxel """
+    params = [get_parameter("a", dist="Normal", mean=0, var=1, prior_type="N"),
+              get_parameter("b", dist="Normal", mean=0, var=1, prior_type="A")]
+    assert voxels_independent(params)
+
+def test_voxels_not_independent():
+    """ Spatial priors and global posteriors couple voxels together """
+    spatial = get_parameter("a", dist="Normal", mean=0, var=1, prior_type="M")
+    glob = get_parameter("b", dist="Normal", mean=0, var=1, post_type="global")
+    assert not voxels_independent([spatial])
+    assert not voxels_independent([glob])
@@ -0,0 +1,92 @@
+"""
+Tests for the numeric precision policy
+"""
+import numpy as np
+import pytest
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb import DataModel, SvbFit
+from svb.models.exp import ExpModel
+from svb.precision import set_precision, get_precision, float_dtype, compute_dtype
+from svb.noise import NoiseParameter
+
+def test_mixed():
+    """ Mixed precision computes in float32 and accumulates in float64 """
+    try:
+        set_precision("mixed")
+        assert get_precision() == "mixed"
+        assert float_dtype() == tf.float64
+        assert compute_dtype() == tf.float32
+    finally:
+        set_precision("float32")
+
+def test_float64():
+    """ Double precision throughout """
+    try:
+        set_precision("float64")
+        assert float_dtype() == tf.float64
+        assert compute_dtype() == tf.float64
+    finally:
+        set_precision("float32")
+
+def test_unknown():
+    """ Unknown precision is rejected """
+    with pytest.raises(ValueError):
+        set_precision("float16")
+    assert get_precision() == "float32"
+
+def test_mixed_log_likelihood():
+    """ With mixed precision the squared residuals are summed before conversion to float64 """
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=[3, 10]).astype(np.float32)
+    pred = rng.normal(size=[3, 4, 10]).astype(np.float32)
+    noise_var = np.ones([3, 4])
+    try:
+        set_precision("mixed")
+        with tf.Graph().as_default() as graph:
+            log_likelihood = NoiseParameter().log_likelihood(tf.constant(data), tf.constant(pred), tf.constant(noise_var), 10)
+            casts = [op for op in graph.get_operations() if op.type == "Cast" and op.outputs[0].dtype == tf.float64]
+            assert all([op.outputs[0].shape.ndims < 3 for op in casts])
+            with tf.Session() as sess:
+                value = sess.run(log_likelihood)
+    finally:
+        set_precision("float32")
+    assert value.dtype == np.float64
+    expected = 0.5 * np.mean(np.sum(np.square(data[:, np.newaxis, :] - pred), axis=-1), axis=-1)
+    assert np.allclose(value, expected, rtol=1e-5)
+
+def _train(precision):
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 0.1, size=(4, 1, 1, 20))
+    data_model = DataModel(data.astype(np.float32))
+    svb = SvbFit(data_model, ExpModel(data_model, dt=0.25), precision=precision, sampling="crn", seed=1)
+    svb.train(tpts, data_model.data_flattened, epochs=100, learning_rate=0.1, display_step=100)
+    return svb
+
+@pytest.mark.parametrize("precision", ["float64", "mixed"])
+def test_train_precision(precision):
+    """ Training in double or mixed precision uses the expected types and gives the same fit as single precision """
+    try:
+        svb = _train(precision)
+        expected = _train("float32")
+    finally:
+        set_precision("float32")
+
+    with svb.sess.graph.as_default():
+        variables = tf.trainable_variables()
+    assert variables and all([var.dtype.base_dtype == tf.float64 for var in variables])
+    assert svb.cost.dtype == tf.float64
+    assert svb.mean_cost.dtype == tf.float64
+    compute = tf.float32 if precision == "mixed" else tf.float64
+    assert svb.data_train.dtype == compute
+    assert svb.modelfit.dtype == compute
+
+    cost = svb.evaluate(svb.cost)
+    assert cost.dtype == np.float64
+    assert np.allclose(cost, expected.evaluate(expected.cost), rtol=1e-3)
+    assert np.allclose(svb.evaluate(svb.model_means), expected.evaluate(expected.model_means), rtol=1e-3, atol=1e-4)
+    assert np.allclose(svb.evaluate(svb.post.var), expected.evaluate(expected.post.var), rtol=0.05, atol=1e-6)
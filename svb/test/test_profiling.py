@@ -0,0 +1,40 @@
+"""
+Tests for profiling of training steps
+"""
+import os
+
+import numpy as np
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb.profiling import StepProfiler
+
+def test_profile_steps(tmpdir):
+    """ Only the selected steps are traced and the summary includes the operations run """
+    outdir = str(tmpdir.join("profile"))
+    with tf.Graph().as_default():
+        data = tf.placeholder(tf.float32, [None, 10])
+        output = tf.reduce_sum(tf.tile(tf.matmul(data, tf.ones([10, 10])), [1, 3]))
+        profiler = StepProfiler(outdir, [1, 3])
+        with tf.Session() as sess:
+            values = [profiler.run(sess, output, {data : np.ones((5, 10))}) for _step in range(4)]
+        op_types = profiler.close()
+
+    assert np.allclose(values, 1500)
+    assert sorted(os.listdir(outdir)) == ["op_summary.txt", "timeline_step000001.json", "timeline_step000003.json"]
+    assert "Tile" in [op_type for op_type, _calls, _micros in op_types]
+    with open(os.path.join(outdir, "op_summary.txt")) as summary_file:
+        assert summary_file.readline().strip() == "Traced steps: 1 3"
+
+def test_profile_no_steps(tmpdir):
+    """ No summary is written if none of the selected steps are run """
+    outdir = str(tmpdir.join("profile"))
+    with tf.Graph().as_default():
+        profiler = StepProfiler(outdir, [5])
+        with tf.Session() as sess:
+            profiler.run(sess, tf.constant(1.0), {})
+        assert profiler.close() == []
+    assert os.listdir(outdir) == []
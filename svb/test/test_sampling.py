@@ -0,0 +1,84 @@
+"""
+Tests for the posterior sampling modes
+"""
+import numpy as np
+import pytest
+
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb.sampling import SAMPLING_MODES, standard_normal, allocate_samples
+
+def _draws(mode, nvertices=50, nparams=3, nsamples=16, **kwargs):
+    with tf.Graph().as_default():
+        eps = standard_normal(nvertices, nparams, nsamples, mode=mode, **kwargs)
+        with tf.Session() as sess:
+            return sess.run(eps), sess.run(eps)
+
+def test_shape():
+    """ All modes give draws of shape [W, P, S] """
+    for mode in SAMPLING_MODES:
+        eps, _eps = _draws(mode, nsamples=7)
+        assert eps.shape == (50, 3, 7)
+        assert np.all(np.isfinite(eps))
+
+def test_antithetic():
+    """ Antithetic draws come in adjacent pairs of opposite sign """
+    eps, _eps = _draws("antithetic")
+    assert np.allclose(eps[..., 0::2], -eps[..., 1::2])
+
+def test_crn():
+    """ Common random numbers are the same at every step and depend on the parameter """
+    eps1, eps2 = _draws("crn", seed=1)
+    assert np.allclose(eps1, eps2)
+    offset, _eps = _draws("crn", nparams=2, dim=1, seed=1)
+    assert np.allclose(offset, eps1[:, 1:])
+
+def test_crn_redraw():
+    """ Common random numbers can be redrawn by changing a seed variable """
+    with tf.Graph().as_default():
+        seed = tf.Variable(1, dtype=tf.int64)
+        eps = standard_normal(50, 3, 16, mode="crn", seed=seed)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            eps1 = sess.run(eps)
+            sess.run(tf.assign_add(seed, 1))
+            eps2 = sess.run(eps)
+    assert np.allclose(eps1, _draws("crn", seed=1)[0])
+    assert not np.allclose(eps1, eps2)
+
+def test_qmc():
+    """ Quasi-Monte Carlo draws vary between steps and have less error in the sample mean """
+    eps1, eps2 = _draws("qmc", nvertices=200)
+    assert not np.allclose(eps1, eps2)
+    random, _eps = _draws("random", nvertices=200)
+    assert np.mean(np.square(np.mean(eps1, axis=2))) < np.mean(np.square(np.mean(random, axis=2)))
+
+def test_unknown_mode():
+    """ Unknown sampling modes are rejected """
+    with pytest.raises(ValueError):
+        _draws("sobol")
+
+def test_allocate_samples():
+    """ Samples are allocated in proportion to the standard deviation within the budget """
+    assert np.all(allocate_samples(np.ones(4), 20) == 5)
+    samples = allocate_samples(np.array([0.01, 1, 3, 10]), 20)
+    assert np.sum(samples) == 20
+    assert np.all(np.diff(samples) >= 0)
+    assert samples[0] == 2
+
+def test_allocate_samples_limits():
+    """ The minimum and maximum number of samples per voxel are respected """
+    samples = allocate_samples(np.random.RandomState(0).rand(100)**3, 500, min_samples=3, max_samples=10)
+    assert np.sum(samples) == 500
+    assert np.min(samples) >= 3 and np.max(samples) <= 10
+    assert np.all(allocate_samples(np.ones(4), 100, max_samples=10) == 10)
+
+def test_allocate_samples_pairs():
+    """ Antithetic pairs are allocated whole so each voxel gets an even number of samples """
+    samples = allocate_samples(np.random.RandomState(0).rand(100)**3, 501, min_samples=3, max_samples=11, pairs=True)
+    assert np.all(samples % 2 == 0)
+    assert np.sum(samples) == 500
+    assert np.min(samples) >= 4 and np.max(samples) <= 10
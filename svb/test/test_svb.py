@@ -0,0 +1,238 @@
+"""
+Tests for training of the stochastic VB fit
+"""
+import logging
+
+import numpy as np
+try:
+    import tensorflow.compat.v1 as tf
+except ImportError:
+    import tensorflow as tf
+
+from svb import DataModel, StackedDataModel, SvbFit
+from svb.models.exp import ExpModel
+
+def _data_model(n_voxels=4, n_tpts=20, noise=0.1):
+    tpts = np.arange(n_tpts, dtype=np.float32) * 0.25
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, noise, size=(n_voxels, 1, 1, n_tpts))
+    return DataModel(data.astype(np.float32)), tpts
+
+def _fit(data_model, **kwargs):
+    """ Fit with common random numbers so the cost is a deterministic function of the posterior """
+    kwargs = dict(kwargs, sampling=kwargs.get("sampling", "crn"), seed=kwargs.get("seed", 1))
+    return SvbFit(data_model, ExpModel(data_model, dt=0.25), **kwargs)
+
+def _outcomes(caplog):
+    return [record.getMessage().rsplit(" - ", 1)[-1] for record in caplog.records
+            if record.getMessage().startswith(" - Epoch")]
+
+def _epochs_trained(history):
+    # Epochs after training stops repeat the runtime of the last epoch
+    return int(np.argmax(history["runtime"][:-1])) + 1
+
+def test_quench_and_revert(caplog):
+    """ The learning rate is quenched down to its minimum and then the posterior is reverted """
+    caplog.set_level(logging.INFO)
+    data_model, tpts = _data_model()
+    svb = _fit(data_model)
+    svb.train(tpts, data_model.data_flattened, epochs=200, learning_rate=1.0, display_step=1,
+              max_trials=2, revert_post_trials=5, lr_quench=0.5, lr_min=0.2)
+    outcomes = _outcomes(caplog)
+    assert outcomes.count("Quench") == 3
+    assert "Revert" in outcomes
+    assert outcomes.index("Revert") > max([idx for idx, outcome in enumerate(outcomes) if outcome == "Quench"])
+    assert np.isclose(svb.evaluate(svb.learning_rate), 0.2)
+
+def test_quench_disabled(caplog):
+    """ Quenching is disabled if max_trials is not less than revert_post_trials """
+    caplog.set_level(logging.INFO)
+    data_model, tpts = _data_model()
+    svb = _fit(data_model)
+    svb.train(tpts, data_model.data_flattened, epochs=50, learning_rate=1.0, display_step=1,
+              max_trials=5, revert_post_trials=5, lr_quench=0.5, lr_min=0.2)
+    outcomes = _outcomes(caplog)
+    assert "Quench" not in outcomes
+    assert "Revert" in outcomes
+    assert np.isclose(svb.evaluate(svb.learning_rate), 1.0)
+
+def test_quench_converges_faster():
+    """ Quenching the learning rate converges in fewer epochs than a fixed decay """
+    data_model, tpts = _data_model()
+    epochs = {}
+    for name, options in [("quench", {"max_trials" : 2, "lr_quench" : 0.5}), ("decay", {"lr_decay_rate" : 0.1})]:
+        svb = _fit(data_model)
+        history = svb.train(tpts, data_model.data_flattened, epochs=300, learning_rate=0.5, revert_post_trials=5,
+                            conv_tol=1e-3, history="mean", display_step=300, **options)
+        assert history["stop_reason"] == "converged"
+        epochs[name] = _epochs_trained(history)
+    assert epochs["quench"] < epochs["decay"]
+
+def test_stacked_shared_warning(caplog):
+    """ Stacking data sets warns if they share a spatial prior hyperparameter """
+    data = [np.ones((2, 2, 1, 10), dtype=np.float32), np.ones((2, 1, 1, 10), dtype=np.float32)]
+    data_model = StackedDataModel(data)
+    SvbFit(data_model, ExpModel(data_model))
+    # ARD priors are inferred separately for each voxel
+    SvbFit(data_model, ExpModel(data_model, param_overrides={"amp1" : {"prior_type" : "A"}}))
+    assert "not fitted independently" not in caplog.text
+    SvbFit(data_model, ExpModel(data_model, param_overrides={"amp1" : {"prior_type" : "A"}, "r1" : {"prior_type" : "M"}}))
+    assert "share prior hyperparameters or global posteriors of r1 -" in caplog.text
+
+def test_xla_engine(caplog):
+    """ The XLA-compiled step gives the same fit as the session step with common random numbers """
+    data_model, tpts = _data_model()
+    for voxel_conv_tol in (None, 1e-2):
+        means = {}
+        for engine in ("session", "xla"):
+            svb = _fit(data_model, engine=engine, voxel_conv_tol=voxel_conv_tol)
+            svb.train(tpts, data_model.data_flattened, epochs=20, batch_size=10, sample_size=5, display_step=20,
+                      voxel_conv_tol=voxel_conv_tol)
+            means[engine] = svb.evaluate(svb.model_means)
+        assert np.allclose(means["xla"], means["session"], rtol=1e-3, atol=1e-4)
+    # Per-voxel convergence falls back to the session engine
+    assert "XLA engine does not support per-voxel convergence" in caplog.text
+
+def test_voxel_convergence_frozen():
+    """ Converged voxels are frozen and their posterior does not change in later epochs """
+    tpts = np.arange(20, dtype=np.float32) * 0.25
+    noise = np.array([0.01] * 4 + [1.0] * 4).reshape(8, 1, 1, 1)
+    data = 10 * np.exp(-tpts) + np.random.RandomState(0).normal(0, 1, size=(8, 1, 1, 20)) * noise
+    data_model = DataModel(data.astype(np.float32))
+    svb = _fit(data_model, voxel_conv_tol=1e-3)
+    history = svb.train(tpts, data_model.data_flattened, epochs=200, learning_rate=0.05, display_step=200,
+                        voxel_conv_tol=1e-3)
+    voxel_params = history["voxel_params"][:, :-1] # [V, E, P]
+    unchanged = np.all(voxel_params[:, 1:] == voxel_params[:, :-1], axis=-1) # [V, E-1]
+    # Noisy voxels converge first and are frozen for the rest of training while the
+    # other voxels are still being trained
+    frozen = np.all(unchanged[:, -20:], axis=1)
+    assert np.count_nonzero(frozen[4:]) >= 2
+    assert not np.any(frozen[:4])
+    assert not np.any(unchanged[:, :10])
+
+def test_voxel_convergence_stops():
+    """ Training stops once all voxels have converged """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model, voxel_conv_tol=0.1)
+    history = svb.train(tpts, data_model.data_flattened, epochs=100, display_step=100, voxel_conv_tol=0.1)
+    assert history["stop_reason"] == "converged"
+    assert _epochs_trained(history) < 100
+
+def test_train_loop():
+    """ The in-graph training loop gives the same fit as the Python epoch loop """
+    data_model, tpts = _data_model()
+    means = []
+    for loop_epochs in (None, 5):
+        svb = _fit(data_model, loop_epochs=loop_epochs)
+        svb.train(tpts, data_model.data_flattened, epochs=20, batch_size=10, sample_size=5, display_step=20,
+                  revert_post_trials=0, revert_post_final=False, loop_epochs=loop_epochs)
+        means.append(svb.evaluate(svb.model_means))
+    assert np.allclose(means[0], means[1], rtol=1e-4, atol=1e-5)
+
+def test_fused_diagnostics():
+    """ Disabled diagnostics are never evaluated and enabled ones are evaluated in a single run """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model, disable_diagnostics=["initial", "var", "lr"])
+
+    fetches = []
+    session_run = svb.sess.run
+    def _run(run_fetches, *args, **kwargs):
+        fetches.append(run_fetches if isinstance(run_fetches, (list, tuple)) else [run_fetches])
+        return session_run(run_fetches, *args, **kwargs)
+    svb.sess.run = _run
+    try:
+        svb.train(tpts, data_model.data_flattened, epochs=3, display_step=1)
+        assert not any([tensor is svb.post.var or tensor is svb.learning_rate
+                        for run_fetches in fetches for tensor in run_fetches])
+        del fetches[:]
+        diagnostics = svb.epoch_diagnostics()
+    finally:
+        del svb.sess.run
+
+    assert len(fetches) == 1
+    assert sorted(diagnostics) == ["params", "ss"]
+    assert np.allclose(diagnostics["params"], svb.evaluate(svb.model_means))
+    assert diagnostics["ss"] == svb.evaluate(svb.sample_size)
+
+def test_reset():
+    """ A fit reset to new data trains as a freshly built fit """
+    data_model, tpts = _data_model()
+    new_data = data_model.data_flattened * 0.5
+    svb = _fit(data_model)
+    svb.train(tpts, data_model.data_flattened, epochs=10, display_step=10)
+    svb.reset(new_data, tpts)
+    svb.train(epochs=10, display_step=10)
+
+    fresh = _fit(data_model)
+    fresh.train(tpts, new_data, epochs=10, display_step=10)
+    assert np.allclose(svb.evaluate(svb.model_means), fresh.evaluate(fresh.model_means))
+    assert np.allclose(svb.evaluate(svb.post.var), fresh.evaluate(fresh.post.var))
+
+def test_conv_tol():
+    """ Training stops when the mean cost and parameters stop changing """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model)
+    history = svb.train(tpts, data_model.data_flattened, epochs=500, learning_rate=0.2, display_step=500,
+                        conv_tol=1e-2, conv_window=5)
+    assert history["stop_reason"] == "converged"
+    epochs = _epochs_trained(history)
+    assert 5 < epochs < 500
+    # The history of the remaining epochs repeats the last epoch
+    assert np.all(history["mean_cost"][epochs-1:-1] == history["mean_cost"][epochs-1])
+
+def test_time_limit():
+    """ Training stops at the end of the epoch in which the time limit is reached """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model)
+    history = svb.train(tpts, data_model.data_flattened, epochs=50, display_step=50, time_limit=0)
+    assert history["stop_reason"] == "time_limit"
+    assert _epochs_trained(history) == 1
+
+def test_revert_no_graph_growth(caplog):
+    """ Saving and reverting the posterior state does not add operations to the graph """
+    caplog.set_level(logging.INFO)
+    data_model, tpts = _data_model()
+    svb = _fit(data_model)
+    n_ops = len(svb.sess.graph.get_operations())
+    svb.sess.graph.finalize()
+    svb.train(tpts, data_model.data_flattened, epochs=100, learning_rate=1.0, display_step=1, revert_post_trials=5)
+    assert "Revert" in _outcomes(caplog)
+    assert len(svb.sess.graph.get_operations()) == n_ops
+
+def test_adaptive_ss_antithetic():
+    """ With antithetic sampling the adaptive sample size does not split pairs of samples """
+    data_model, tpts = _data_model(noise=np.array([0.01, 0.1, 1.0, 3.0]).reshape(4, 1, 1, 1))
+    svb = _fit(data_model, adaptive_ss=True, sampling="antithetic")
+    svb.train(tpts, data_model.data_flattened, epochs=5, sample_size=5, ss_min=3, display_step=5)
+    voxel_ss = svb.evaluate(svb.voxel_ss)
+    assert np.all(voxel_ss % 2 == 0)
+    assert np.min(voxel_ss) >= 4
+    assert np.sum(voxel_ss) == 20
+
+def test_saa(caplog):
+    """ The SAA optimizer reduces the cost at every iteration and converges to the same posterior as adam """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model, optimizer="saa")
+    # The line search needs costs in double precision
+    assert "using mixed precision" in caplog.text
+    assert svb.cost.dtype == tf.float64
+    history = svb.train(tpts, data_model.data_flattened, epochs=20, sample_size=10, display_step=20)
+    voxel_cost = history["voxel_cost"][:, :-1]
+    assert np.all(np.diff(voxel_cost, axis=1) <= 0)
+    assert svb.evaluate(svb._saa_seed) == 1
+
+    adam = _fit(data_model)
+    adam.train(tpts, data_model.data_flattened, epochs=300, learning_rate=0.1, display_step=300)
+    assert np.allclose(svb.evaluate(svb.model_means)[:2], adam.evaluate(adam.model_means)[:2], rtol=0.02)
+
+def test_saa_redraw():
+    """ The SAA draws are redrawn at the requested interval and the cost only decreases between redraws """
+    data_model, tpts = _data_model()
+    svb = _fit(data_model, optimizer="saa", precision="float64")
+    assert svb.cost.dtype == tf.float64
+    history = svb.train(tpts, data_model.data_flattened, epochs=20, sample_size=10, display_step=20, saa_redraw=5)
+    assert svb.evaluate(svb._saa_seed) == 4
+    cost_change = np.diff(history["voxel_cost"][:, :-1], axis=1)
+    redraws = np.arange(4, 19, 5)
+    assert np.all(np.delete(cost_change, redraws, axis=1) <= 0)
+    assert np.any(cost_change[:, redraws] > 0)